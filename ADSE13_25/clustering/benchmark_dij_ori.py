@@ -0,0 +1,57 @@
+from __future__ import absolute_import, division, print_function
+from six.moves import range
+import sys
+import time
+import numpy as np
+
+message = '''
+Benchmark of the orientational distance matrix of IOTA consensus clustering. Fills the Dij_ori
+matrix of N synthetic crystal models (default 200) once pair by pair with get_dij_ori, as
+get_uc_consensus used to, and once with get_dij_ori_matrix, then reports both timings and the
+largest difference between the two matrices.
+Usage: libtbx.python benchmark_dij_ori.py [N] [nproc]
+'''
+
+def synthetic_crystal_models(n_models, seed=0):
+  ''' n_models P 1 21 1 crystal models scattered around two orientations of the LS49 myoglobin
+      cell, with 1% cell noise, and a third of them given in another (unimodular) setting '''
+  from dxtbx.model import Crystal
+  from scitbx.matrix import col
+  from cctbx import uctbx
+  from exafel_project.ADSE13_25.clustering.consensus_functions import unimodular_matrices
+  rng = np.random.RandomState(seed)
+  orthogonalization = np.array(uctbx.unit_cell((63.6, 28.8, 35.6, 90, 106.5, 90)).orthogonalization_matrix()).reshape(3,3)
+  settings = unimodular_matrices(1)[0]
+  orientations = [np.eye(3), np.array(col((1,1,0)).normalize().axis_and_angle_as_r3_rotation_matrix(40, deg=True)).reshape(3,3)]
+  crystals = []
+  for k in range(n_models):
+    noise = np.eye(3) + rng.normal(0, 0.01, (3,3))
+    direct = orthogonalization.dot(noise).T.dot(orientations[k%2].T) # rows a, b, c
+    if k%3 == 2:
+      direct = settings[rng.randint(len(settings))].dot(direct)
+    crystals.append(Crystal(tuple(direct[0]), tuple(direct[1]), tuple(direct[2]), 'P 1 21 1'))
+  return crystals
+
+def run(n_models=200, nproc=1):
+  from scitbx.array_family import flex
+  from exafel_project.ADSE13_25.clustering.consensus_functions import get_dij_ori, get_dij_ori_matrix
+  crystals = synthetic_crystal_models(n_models)
+  t0 = time.time()
+  Dij_pairwise = flex.double(flex.grid(n_models, n_models))
+  for i in range(n_models-1):
+    for j in range(i+1, n_models):
+      Dij_pairwise[n_models*i+j] = Dij_pairwise[n_models*j+i] = get_dij_ori(crystals[i], crystals[j])
+  t1 = time.time()
+  Dij_matrix = get_dij_ori_matrix(crystals, nproc=nproc)
+  t2 = time.time()
+  print('%d crystal models, %d pairs'%(n_models, n_models*(n_models-1)//2))
+  print('get_dij_ori pair by pair : %8.3f s'%(t1-t0))
+  print('get_dij_ori_matrix nproc=%d : %8.3f s'%(nproc, t2-t1))
+  print('speedup %.1fx, largest difference %.3g'%((t1-t0)/(t2-t1), flex.max(flex.abs(Dij_matrix-Dij_pairwise))))
+
+if __name__ == '__main__':
+  if '--help' in sys.argv[1:] or '-h' in sys.argv[1:]:
+    print(message)
+    exit()
+  args = [int(arg) for arg in sys.argv[1:3]]
+  run(*args)
@@ -3,6 +3,7 @@ from six.moves import range
 from cctbx.array_family import flex
 from libtbx import group_args
 from libtbx.phil import parse
+import numpy as np
 import os
 #
 # List of consensus functions to be implemented
@@ -31,6 +32,10 @@ clustering {
     .type = int
     .help = Minimum number of datapoints in each cluster to be able to be considered \
             for further indexing
+  nproc = 1
+    .type = int
+    .help = Number of processes filling the orientational distance matrix of each unit cell \
+            cluster. Worth raising when clusters hold hundreds of crystal models
 }
 
 '''
@@ -61,6 +66,95 @@ def get_dij_ori(cryst1, cryst2, is_reciprocal=True):
   #print 'difference z-score = ', cryst1_ori.difference_Z_score(cryst2_ori_best)
   return cryst1_ori.difference_Z_score(cryst2_ori_best)
 
+_unimodular_matrices = {}
+
+def unimodular_matrices(generator_range=1):
+  '''
+  The 3x3 integer matrices with elements within +/- generator_range and determinant 1, i.e. the
+  change of basis operators tried by crystal_orientation.best_similarity_transformation, and for
+  each of their rows the index of that row in the list of all possible rows. Cached
+  '''
+  if generator_range not in _unimodular_matrices:
+    values = np.arange(-generator_range, generator_range+1)
+    rows = np.array(np.meshgrid(values, values, values, indexing='ij')).reshape(3, -1).T
+    row_index = np.array(np.meshgrid(*[np.arange(len(rows))]*3, indexing='ij')).reshape(3, -1).T
+    grid = rows[row_index].astype(float)
+    unimodular = np.round(np.linalg.det(grid)) == 1
+    _unimodular_matrices[generator_range] = grid[unimodular], row_index[unimodular], rows.astype(float)
+  return _unimodular_matrices[generator_range]
+
+def direct_matrices(crystals, is_reciprocal=True):
+  ''' (N,3,3) array of the direct space matrices (rows a, b, c) of N dxtbx crystal models '''
+  from cctbx_orientation_ext import crystal_orientation
+  return np.array([crystal_orientation(cryst.get_A(), is_reciprocal).direct_matrix()
+                   for cryst in crystals], dtype=float).reshape(-1, 3, 3)
+
+def difference_Z_scores(this, other):
+  ''' crystal_orientation.difference_Z_score of direct matrices, broadcast over leading axes '''
+  diff_lengths = np.sqrt(((this - other)**2).sum(axis=-1))
+  return (diff_lengths/(0.01*np.sqrt((this**2).sum(axis=-1)))).sum(axis=-1)
+
+def dij_ori_rows(direct, rows, fractional_length_tolerance=50.0, unimodular_generator_range=1, chunk=256):
+  '''
+  get_dij_ori(crystal i, crystal j) for every i in rows and every j > i, given the direct matrices
+  of the crystals. Returns arrays i, j, dij.
+  best_similarity_transformation of crystal j onto crystal i picks the unimodular U minimizing
+  the Z-score of crystal i in basis U against crystal j. Every basis vector of crystal i in any
+  basis U is one of the few integer combinations of its a, b, c, so the Z-score terms of those
+  combinations are computed once per pair and the Z-score of every U is the sum of three of them.
+  '''
+  U, row_index, combinations = unimodular_matrices(unimodular_generator_range)
+  U_inverse = np.round(np.linalg.inv(U))
+  all_i, all_j, all_dij = [], [], []
+  for i in rows:
+    vectors = np.dot(combinations, direct[i]) # basis vectors of crystal i in any basis
+    for first in range(i+1, len(direct), chunk):
+      j = np.arange(first, min(first+chunk, len(direct)))
+      lengths = np.sqrt((direct[j]**2).sum(axis=-1))
+      terms = np.sqrt(((direct[j][:,:,None] - vectors[None,None])**2).sum(axis=-1))/(0.01*lengths[:,:,None])
+      Z = terms[:,0,row_index[:,0]] + terms[:,1,row_index[:,1]] + terms[:,2,row_index[:,2]]
+      best = np.argmin(Z, axis=1)
+      found = Z[np.arange(len(j)), best] < fractional_length_tolerance
+      direct_j = direct[j].copy()
+      direct_j[found] = np.matmul(U_inverse[best[found]], direct_j[found])
+      all_i.append(np.full(len(j), i))
+      all_j.append(j)
+      all_dij.append(difference_Z_scores(direct[i], direct_j))
+  if not all_i:
+    return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+  return np.concatenate(all_i), np.concatenate(all_j), np.concatenate(all_dij)
+
+def _dij_ori_rows(args):
+  return dij_ori_rows(*args)
+
+def get_dij_ori_matrix(crystals, is_reciprocal=True, nproc=1):
+  '''
+  Symmetric N x N flex.double of get_dij_ori between every pair of N dxtbx crystal models.
+  Only the upper triangle is evaluated. With nproc > 1 the rows are shared out to a process pool
+  '''
+  direct = direct_matrices(crystals, is_reciprocal)
+  NN = len(direct)
+  Dij = np.zeros((NN, NN))
+  rows = list(range(NN-1))
+  nproc = min(nproc, len(rows))
+  if nproc > 1:
+    from multiprocessing import Pool
+    # interleaved rows give every process about the same number of pairs
+    pool = Pool(nproc)
+    try:
+      results = pool.map(_dij_ori_rows, [(direct, rows[k::nproc]) for k in range(nproc)])
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    results = [dij_ori_rows(direct, rows)]
+  for i, j, dij in results:
+    Dij[i, j] = dij
+    Dij[j, i] = dij
+  Dij_flex = flex.double(Dij.ravel())
+  Dij_flex.reshape(flex.grid(NN, NN))
+  return Dij_flex
+
 def estimate_d_c(Dij):
   ''' Estimate the value of d_c using the assumption that each cluster will be gaussian distributed in it's dij values.
       If we can find out how many of those gaussians are there in the Dij distribution, we can get an estimate of the d_c
@@ -89,6 +183,62 @@ def estimate_d_c(Dij):
       break
   return d_c
 
+def decision_graph_z_scores(values):
+  ''' Z-scores of the rho or delta values of a decision graph and their standard deviation '''
+  values = values.as_double()
+  stdev = flex.mean_and_variance(values).unweighted_sample_standard_deviation()
+  if stdev == 0.0:
+    return None, stdev
+  return ((values-flex.mean(values))/stdev).as_numpy_array(), stdev
+
+def default_centers(delta_z, rho_order):
+  '''
+  Use idea quoted in Rodriguez Laio 2014 paper
+  " Thus, cluster centers are recognized as points for which the value of delta is anomalously large."
+  rho_order[0] is always a center. Other points with a significant delta are taken as centers in
+  decreasing order of delta while their delta Z-score is more than 1 below that of rho_order[0]
+  (and, from the third one on, the previous one is more than 1 below the top one)
+  '''
+  delta_z_cutoff = min(1.0, delta_z.max())
+  candidates = np.flatnonzero((delta_z >= delta_z_cutoff) | (delta_z <= -delta_z_cutoff))
+  i_sorted = np.argsort(-delta_z[candidates], kind='stable')
+  candidates = candidates[i_sorted]
+  candidate_delta_z = delta_z[candidates]
+  delta_z_of_rho_order_0 = delta_z[rho_order[0]]
+  others = candidates != rho_order[0]
+  too_close = others & ~(delta_z_of_rho_order_0-candidate_delta_z > 1.0)
+  n_scanned = np.argmax(too_close) if too_close.any() else len(candidates)
+  position = np.arange(n_scanned)
+  gap_above = np.ones(n_scanned, dtype=bool)
+  gap_above[2:] = candidate_delta_z[0] - candidate_delta_z[1:n_scanned][:-1] > 1.0
+  return np.r_[rho_order[0], candidates[:n_scanned][others[:n_scanned] & ((position <= 1) | gap_above)]]
+
+def strategy_3_centers(product, z_critical=3.0, n_sorted=3):
+  '''
+  use product of delta and rho and pick out top candidates
+  have to use a significance z_score to filter out the very best
+  The top point is always a center, the next n_sorted-1 ones are while their Z-score exceeds z_critical
+  basically there won't be more than 2-3 lattices on an image realistically
+  '''
+  iid_sorted = np.argsort(-product, kind='stable')
+  z_score = (product[iid_sorted[1:n_sorted]]-np.mean(product))/np.std(product)
+  n_significant = np.logical_and.accumulate(z_score > z_critical).sum()
+  return iid_sorted[:1+n_significant]
+
+def percentile_centers(delta, rho_order, max_percentile_rho):
+  '''
+  Points in decreasing order of delta whose delta is above a quarter of the largest one and
+  whose rank in rho is within max_percentile_rho of the points
+  '''
+  NN = len(delta)
+  delta_order = np.argsort(-delta, kind='stable')
+  rho_rank = np.empty(NN, dtype=int)
+  rho_rank[rho_order] = np.arange(NN) # inverse permutation of rho_order
+  high_delta = delta[delta_order] > 0.25*delta[delta_order[0]]
+  high_delta[0] = True
+  return delta_order[high_delta & (rho_rank[delta_order]/NN < max_percentile_rho)]
+
+
 class clustering_manager(group_args):
   def __init__(self, **kwargs):
     group_args.__init__(self, **kwargs)
@@ -100,169 +250,47 @@ class clustering_manager(group_args):
     if hasattr(self, 'strategy') is False:
       self.strategy='default'
     self.rho = rho = R.get_rho()
-    ave_rho = flex.mean(rho.as_double())
     NN = self.Dij.focus()[0]
     i_max = flex.max_index(rho)
-    delta_i_max = flex.max(flex.double([self.Dij[i_max,j] for j in range(NN)]))
+    delta_i_max = flex.max(self.Dij.as_1d()[i_max*NN:(i_max+1)*NN])
     rho_order = flex.sort_permutation(rho, reverse=True)
-    rho_order_list = list(rho_order)
     self.delta = delta = R.get_delta(rho_order=rho_order, delta_i_max=delta_i_max)
     cluster_id = flex.int(NN, -1) # -1 means no cluster
-    delta_order = flex.sort_permutation(delta, reverse=True)
-    MAX_PERCENTILE_RHO = self.max_percentile_rho # cluster centers have to be in the top percentile
-    n_cluster = 0
+    rho_np = rho.as_double().as_numpy_array()
+    delta_np = delta.as_numpy_array()
+    rho_order_np = rho_order.as_numpy_array().astype(int)
 #
 #
     print ('Z_DELTA = ',self.Z_delta)
 
-
-    pick_top_solution=False
-    rho_stdev = flex.mean_and_variance(rho.as_double()).unweighted_sample_standard_deviation()
-    delta_stdev = flex.mean_and_variance(delta).unweighted_sample_standard_deviation()
-    if rho_stdev !=0.0 and delta_stdev !=0:
-      rho_z=(rho.as_double()-flex.mean(rho.as_double()))/(rho_stdev)
-      delta_z=(delta-flex.mean(delta))/(delta_stdev)
-    else:
-      pick_top_solution=True
-      if rho_stdev == 0.0:
-        centroids = [flex.first_index(delta,flex.max(delta))]
-      elif delta_stdev == 0.0:
-        centroids = [flex.first_index(rho,flex.max(rho))]
-
-    significant_delta = []
-    significant_rho = []
-    # Define strategy to decide cluster center here. Only one should be true
-    debug_fix_clustering = True
+    # Strategy deciding the cluster centers on the decision graph
     if self.strategy=='one_cluster':
-        debug_fix_clustering=False
-        strategy2=True
-    if self.strategy=='strategy_3':
-        debug_fix_clustering=False
-        strategy3=True
-        strategy2=False
-
-    if debug_fix_clustering:
-      if not pick_top_solution:
-        delta_z_cutoff = min(1.0, max(delta_z))
-        rho_z_cutoff = min(1.0, max(rho_z))
-        for ic in range(NN):
-          # test the density & rho
-          if delta_z[ic] >= delta_z_cutoff or delta_z[ic] <= -delta_z_cutoff:
-            significant_delta.append(ic)
-          if rho_z[ic] >= rho_z_cutoff or rho_z[ic] <= -rho_z_cutoff:
-            significant_rho.append(ic)
-        if True:
-          # Use idea quoted in Rodriguez Laio 2014 paper
-          # " Thus, cluster centers are recognized as points for which the value of delta is anomalously large."
-          centroid_candidates=list(significant_delta)
-          candidate_delta_z=flex.double()
-          for ic in centroid_candidates:
-            if ic == rho_order[0]:
-              delta_z_of_rho_order_0=delta_z[ic]
-            candidate_delta_z.append(delta_z[ic])
-          i_sorted=flex.sort_permutation(candidate_delta_z, reverse=True)
-          # Check that once sorted the top one is not equal to the 2nd or 3rd position
-          # If there is a tie, assign centroid to the first one in rho order
-          centroids=[]
-          # rho_order[0] has to be a centroid
-          centroids.append(rho_order[0])
-          
-          #centroids.append(centroid_candidates[i_sorted[0]])
-          for i in range(0, len(i_sorted[:])):
-            if centroid_candidates[i_sorted[i]] == rho_order[0]:
-              continue
-            if delta_z_of_rho_order_0-candidate_delta_z[i_sorted[i]] > 1.0:
-              if i>1:
-                if -candidate_delta_z[i_sorted[i-1]]+candidate_delta_z[i_sorted[0]] > 1.0:
-                  centroids.append(centroid_candidates[i_sorted[i]])
-              else:
-                centroids.append(centroid_candidates[i_sorted[i]])
-            else:
-              break
-        if False:
-          centroid_candidates = list(set(significant_delta).intersection(set(significant_rho)))
-          # Now compare the relative orders of the max delta_z and max rho_z to make sure they are within 1 stdev
-          centroids = []
-          max_delta_z_candidates = -999.9
-          max_rho_z_candidates = -999.9
-          for ic in centroid_candidates:
-            if delta_z[ic] > max_delta_z_candidates:
-              max_delta_z_candidates = delta_z[ic]
-            if rho_z[ic] > max_rho_z_candidates:
-              max_rho_z_candidates = rho_z[ic]
-          for ic in centroid_candidates:
-            if max_delta_z_candidates - delta_z[ic] < 1.0 and max_rho_z_candidates - rho_z[ic] < 1.0:
-              centroids.append(ic)
-
-      #item_idxs = [delta_order[ic] for ic,centroid in enumerate(centroids)]
-      item_idxs=centroids
-      for item_idx in item_idxs:
-        cluster_id[item_idx] = n_cluster
-        print ('CLUSTERING_STATS',item_idx,cluster_id[item_idx] )
-        n_cluster +=1
-        ####
-    elif strategy2:
       # Go through list of clusters, see which one has highest joint rank in both rho and delta lists
       # This will only assign one cluster center based on highest product of rho and delta ranks
-      product_list_of_ranks=[]
-      for ic in range(NN):
-        rho_tmp=self.rho[ic]
-        delta_tmp=self.delta[ic]
-        product_list_of_ranks.append(rho_tmp*delta_tmp)
-      import numpy as np
-      item_idx=np.argmax(product_list_of_ranks)
-      cluster_id[item_idx]=n_cluster # Only cluster assigned
-      print ('CLUSTERING_STATS',item_idx,cluster_id[item_idx])
-      n_cluster +=1
-    elif strategy3:
-      # use product of delta and rho and pick out top candidates
-      # have to use a significance z_score to filter out the very best
-      product_list_of_ranks=flex.double()
-      for ic in range(NN):
-        rho_tmp=self.rho[ic]
-        delta_tmp=self.delta[ic]
-        product_list_of_ranks.append(rho_tmp*delta_tmp)
-      import numpy as np
-      iid_sorted=flex.sort_permutation(product_list_of_ranks, reverse=True)
-      cluster_id[iid_sorted[0]]=n_cluster # first point always a cluster
-      n_cluster +=1
-      print ('CLUSTERING_STATS S3',iid_sorted[0],cluster_id[iid_sorted[0]])
-      #product_list_of_ranks[iid_sorted[0]]=0.0 # set this to 0.0 so that the mean/stdev does not get biased by one point
-      stdev=np.std(product_list_of_ranks)
-      mean=np.mean(product_list_of_ranks)
-      n_sorted=3
-      #if stdev == 0.0:
-      #  n_sorted=1
-      
-      z_critical = 3.0 # 2 sigma significance ?
-      # Only go through say 3-4 datapoints 
-      # basically there won't be more than 2-3 lattices on an image realistically
-      for iid in iid_sorted[1:n_sorted]:
-        z_score=(product_list_of_ranks[iid]-mean)/stdev
-        if z_score > z_critical:
-          cluster_id[iid]=n_cluster
-          n_cluster +=1
-          print ('CLUSTERING_STATS S3',iid,cluster_id[iid])
-        else:
-          break # No point going over all points once below threshold z_score
-
+      centers = [np.argmax(rho_np*delta_np)]
+    elif self.strategy=='strategy_3':
+      centers = strategy_3_centers(rho_np*delta_np)
+    elif self.strategy=='percentile':
+      centers = percentile_centers(delta_np, rho_order_np, self.max_percentile_rho)
     else:
-      for ic in range(NN):
-        item_idx = delta_order[ic]
-        if ic != 0:
-          if delta[item_idx] <= 0.25*delta[delta_order[0]]: # too low to be a medoid
-            continue
-        item_rho_order = rho_order_list.index(item_idx)
-        if (item_rho_order)/NN < MAX_PERCENTILE_RHO:
-          cluster_id[item_idx] = n_cluster
-          print ('CLUSTERING_STATS',ic,item_idx,item_rho_order,cluster_id[item_idx])
-          n_cluster +=1
+      _, rho_stdev = decision_graph_z_scores(rho)
+      delta_z, delta_stdev = decision_graph_z_scores(delta)
+      if rho_stdev == 0.0:
+        centers = [np.argmax(delta_np)]
+      elif delta_stdev == 0.0:
+        centers = [np.argmax(rho_np)]
+      else:
+        centers = default_centers(delta_z, rho_order_np)
+    centers = flex.size_t([int(c) for c in centers])
+    cluster_id.set_selected(centers, flex.int(range(len(centers))))
+    for item_idx in centers:
+      print ('CLUSTERING_STATS S3' if self.strategy=='strategy_3' else 'CLUSTERING_STATS', item_idx, cluster_id[item_idx])
+    n_cluster = len(centers)
     ###
 #
     print ('Found %d clusters'%n_cluster)
-    for x in range(NN):
-      if cluster_id[x] >= 0:
-        print ("XC", x,cluster_id[x], rho[x], delta[x])
+    for x in np.flatnonzero(cluster_id.as_numpy_array() >= 0):
+      print ("XC", x,cluster_id[x], rho[x], delta[x])
     self.cluster_id_maxima = cluster_id.deep_copy()
     R.cluster_assignment(rho_order, cluster_id, rho)
     self.cluster_id_full = cluster_id.deep_copy()
@@ -432,17 +460,9 @@ def get_uc_consensus(experiments_list, show_plot=False, save_plot=False, return_
       # Make sure there are atleast a minimum number of samples in the cluster
       if uc_cluster_count[cluster] < clustering_params.min_datapts:
         continue
-      Dij_ori[cluster] = flex.double([[0.0]*uc_cluster_count[cluster]]*uc_cluster_count[cluster])
-    # Now populate the Dij_ori array
-      N_samples_in_cluster = len(uc_experiments_list[cluster])
-      for i in range(N_samples_in_cluster-1):
-        for j in range(i+1, N_samples_in_cluster):
-          dij_ori = get_dij_ori(uc_experiments_list[cluster][i].crystals()[0],uc_experiments_list[cluster][j].crystals()[0])
-          A_direct_i = sqr(uc_experiments_list[cluster][i].crystals()[0].get_A()).transpose().inverse()
-          A_direct_j = sqr(uc_experiments_list[cluster][j].crystals()[0].get_A()).transpose().inverse()
-          #print ("Direct A matrix 1st element = %12.6f %12.6f %12.6f %12.6f %12.6f %12.6f %12.6f"%(dij_ori, A_direct_i[0], A_direct_j[0], A_direct_i[1],A_direct_j[1], A_direct_i[2], A_direct_j[2] ))
-          Dij_ori[cluster][N_samples_in_cluster*i+j] = dij_ori
-          Dij_ori[cluster][N_samples_in_cluster*j+i] = dij_ori
+      # Now populate the Dij_ori array
+      Dij_ori[cluster] = get_dij_ori_matrix([expt.crystals()[0] for expt in uc_experiments_list[cluster]],
+                                            nproc=clustering_params.nproc)
 
     # Now do the orientational cluster analysis
     d_c_ori = clustering_params.d_c_ori # 0.13
@@ -4,6 +4,7 @@ import sys,os
 from iotbx.detectors.cspad_detector_formats import reverse_timestamp
 from libtbx.phil import parse
 from libtbx.utils import Sorry
+from exafel_project.kpp_utils.weather_monitor import WeatherMonitor
 
 message = ''' script to get a sense of the computational performance of every rank while processing xtc streams
               End product is a plot of wall time vs MPI rank number with every data point being that of a frame
@@ -38,6 +39,29 @@ phil_scope = parse('''
   pickle_filename = fig_object.pickle
     .type = str
     .help = Default name of pickled matplotlib plot saved to disk
+  live {
+    enable = False
+      .type = bool
+      .help = If True, follow the per-rank logs while the job runs instead of plotting, \
+              and keep a rolling summary of throughput, idle time and stragglers \
+              as done by kpp_utils/weather_monitor.py
+    interval = 30
+      .type = float
+      .help = Seconds between updates of the summary
+    window = 60
+      .type = float
+      .help = Seconds over which the current throughput is measured
+    straggler_factor = 3
+      .type = float
+      .help = A rank silent for this many median times per image is reported as a straggler
+    summary = weather_summary.json
+      .type = str
+      .help = Rolling summary file. The read offsets are checkpointed next to it, so that \
+              a restarted monitor resumes where it stopped
+    stop_after = None
+      .type = float
+      .help = Stop when no log grew for this many seconds, e.g. after the job ended
+  }
 ''')
 
 def params_from_phil(args):
@@ -53,6 +77,11 @@ def params_from_phil(args):
   params = phil_scope.fetch(sources=user_phil).extract()
   return params
 
+def run_live(params):
+  monitor = WeatherMonitor([os.path.join(params.input_path,'out','debug','debug_*.txt')], params.live.summary,
+                           window=params.live.window, straggler_factor=params.live.straggler_factor)
+  monitor.run(interval=params.live.interval, stop_after=params.live.stop_after)
+
 def run(params):
   counter = 0
   reference = None
@@ -98,4 +127,7 @@ if __name__ == '__main__':
     print (message)
     exit()
   params = params_from_phil(sys.argv[1:])
-  run(params)
+  if params.live.enable:
+    run_live(params)
+  else:
+    run(params)
@@ -6,7 +6,10 @@ It also prints out a combined experiment list and reflection table
 MPI option available
 '''
 
-import os,sys,math
+import heapq
+import itertools
+import os,sys
+import numpy as np
 from libtbx.phil import parse
 from libtbx.utils import Sorry
 from exafel_project.ADSE13_25.command_line.indexing_analytics import params_from_phil
@@ -14,7 +17,6 @@ from dxtbx.model.experiment_list import ExperimentList,ExperimentListFactory
 from dials.array_family import flex
 from libtbx.easy_pickle import load
 from dials.algorithms.refinement.prediction.managed_predictors import ExperimentsPredictorFactory
-from scitbx.matrix import col
 
 rmsd_phil_scope = parse('''
   input_path = None
@@ -41,30 +43,76 @@ rmsd_phil_scope = parse('''
             appended to the name
 ''')
 
-def find_rmsd_from_refl_tables(experiments, reflections, num_images):
-  rmsd = flex.double()
-  all_refl = []
-  for ii, expt in enumerate(experiments):
-    refl_now = reflections.select(reflections['id'] == ii)
-    dR = flex.double()
-    for refl in refl_now:
-      dR.append((col(refl['xyzcal.mm']) - col(refl['xyzobs.mm.value'])).length())
-    rmsd.append(1000.0*math.sqrt(dR.dot(dR)/len(dR)))
-  idx_list = list(flex.sort_permutation(rmsd, reverse=True)[0:num_images])
+def grouped_rmsd(ids, xyzcal, xyzobs, n_experiments):
+  """RMSD in microns between calculated and observed positions of the
+  reflections of every experiment, nan for experiments without any.
+  Reflections are sorted by id once; the rows of experiment i are
+  order[starts[i]:starts[i+1]]. Returns rmsd, order, starts."""
+  ids = np.asarray(ids)
+  keep = np.flatnonzero((ids >= 0) & (ids < n_experiments))
+  order = keep[np.argsort(ids[keep], kind='stable')]
+  starts = np.searchsorted(ids[order], np.arange(n_experiments + 1))
+  d = np.asarray(xyzcal)[order] - np.asarray(xyzobs)[order]
+  dR = np.sqrt((d * d).sum(axis=1))
+  counts = np.diff(starts)
+  rmsd = np.full(n_experiments, np.nan)
+  filled = counts > 0
+  if filled.any():
+    sums = np.add.reduceat(dR * dR, starts[:-1][filled])
+    rmsd[filled] = 1000.0 * np.sqrt(sums / counts[filled])
+  return rmsd, order, starts
+
+
+def highest(rmsd, num_images):
+  """Indices of the num_images largest finite rmsd values, largest first"""
+  candidates = np.flatnonzero(~np.isnan(rmsd))
+  if num_images <= 0:
+    return candidates[:0]
+  if num_images < len(candidates):
+    candidates = candidates[np.argpartition(-rmsd[candidates], num_images - 1)[:num_images]]
+  return candidates[np.argsort(-rmsd[candidates], kind='stable')]
+
+
+def rmsd_of_experiments(experiments, reflections):
+  return grouped_rmsd(reflections['id'].as_numpy_array(), reflections['xyzcal.mm'].as_numpy_array(),
+                      reflections['xyzobs.mm.value'].as_numpy_array(), len(experiments))
+
+
+def select_experiments(experiments, reflections, idx_list, order, starts):
+  """Experiments idx_list and their reflections, renumbered 0..len(idx_list)-1"""
   reqd_expt = ExperimentList()
-  reqd_refl = flex.reflection_table()
-  for ii,idx in enumerate(idx_list):
-    reqd_expt.append(experiments[idx])
-    refl = reflections.select(reflections['id'] == idx)
-    refl['id'].set_selected(flex.size_t(range(len(refl['id']))),ii)
-    reqd_refl.extend(refl)
+  for idx in idx_list:
+    reqd_expt.append(experiments[int(idx)])
+  rows = [order[starts[idx]:starts[idx + 1]] for idx in idx_list]
+  reqd_refl = reflections.select(flex.size_t(np.concatenate(rows + [order[:0]]).astype(np.uint64)))
+  reqd_refl['id'] = flex.int(np.repeat(np.arange(len(rows)), [len(r) for r in rows]).astype(np.int32))
   return reqd_expt, reqd_refl
 
 
+def concatenate_experiments(results):
+  """One experiment list and reflection table from (experiments, reflections)
+  pairs whose reflection ids each count from 0"""
+  all_experiments = ExperimentList()
+  all_reflections = flex.reflection_table()
+  for expt_list, refl_list in results:
+    refl = refl_list.select(refl_list['id'] >= 0)
+    refl['id'] = flex.int(refl['id'].as_numpy_array() + len(all_experiments))
+    all_experiments.extend(expt_list)
+    all_reflections.extend(refl)
+  return all_experiments, all_reflections
+
+
+def find_rmsd_from_refl_tables(experiments, reflections, num_images):
+  rmsd, order, starts = rmsd_of_experiments(experiments, reflections)
+  idx_list = highest(rmsd, num_images)
+  return select_experiments(experiments, reflections, idx_list, order, starts)
+
+
 def find_rmsd_from_files(filenames, root, num_images, rank=0):
-  rmsd = flex.double()
-  all_expt = []
-  all_refl = []
+  """Top num_images experiments by RMSD over all files, kept in a heap of at
+  most num_images candidates while reading"""
+  heap = []
+  sequence = itertools.count()  # orders candidates of equal rmsd by arrival
   for filename in filenames:
     fjson=os.path.join(root, filename)
     experiments = ExperimentListFactory.from_json_file(fjson)
@@ -72,26 +120,18 @@ def find_rmsd_from_files(filenames, root, num_images, rank=0):
     reflections = load(fpickle)
     ref_predictor = ExperimentsPredictorFactory.from_experiments(experiments, force_stills=experiments.all_stills())
     reflections = ref_predictor(reflections)
-    for ii,expt in enumerate(experiments):
-      cbf_now = experiments[ii].imageset.get_image_identifier(0).split('/')[-1]
-      refl_now = reflections.select(reflections['id'] == ii)
-      dR = flex.double()
-      for refl in refl_now:
-        dR.append((col(refl['xyzcal.mm']) - col(refl['xyzobs.mm.value'])).length())
-      rmsd.append(1000.0*math.sqrt(dR.dot(dR)/len(dR)))
-      all_expt.append(expt)
-      all_refl.append(refl_now)
-  # Now sort it
-  reqd_expt = ExperimentList()
-  reqd_refl = flex.reflection_table()
-  idx_list = list(flex.sort_permutation(rmsd, reverse=True)[0:num_images])
-  print (idx_list)
-  for ii,idx in enumerate(idx_list):
-    reqd_expt.append(all_expt[idx])
-    refl = all_refl[idx]
-    refl['id'].set_selected(flex.size_t(range(len(refl['id']))),ii)
-    reqd_refl.extend(refl)
-  return (reqd_expt, reqd_refl)
+    rmsd, order, starts = rmsd_of_experiments(experiments, reflections)
+    for idx in highest(rmsd, num_images):
+      if len(heap) == num_images and rmsd[idx] <= heap[0][0]:
+        continue
+      candidate = (rmsd[idx], next(sequence), select_experiments(experiments, reflections, [idx], order, starts))
+      if len(heap) < num_images:
+        heapq.heappush(heap, candidate)
+      else:
+        heapq.heapreplace(heap, candidate)
+  candidates = sorted(heap, key=lambda c: -c[0])
+  print ([round(c[0], 3) for c in candidates])
+  return concatenate_experiments([c[2] for c in candidates])
 
 
 def assign_work(root, mpi=False):
@@ -151,17 +191,7 @@ if __name__ == '__main__':
     comm.barrier()
     if rank == 0:
     # stitch together refl tables and experiment lists
-      all_experiments = ExperimentList()
-      all_reflections = flex.reflection_table()
-      expt_counter = -1
-      for result in results:
-        expt_list,refl_list = result
-        for ii,expt in enumerate(expt_list):
-          expt_counter +=1
-          all_experiments.append(expt)
-          refl = refl_list.select(refl_list['id'] == ii)
-          refl['id'].set_selected(flex.size_t(range(len(refl['id']))),expt_counter)
-          all_reflections.extend(refl)
+      all_experiments, all_reflections = concatenate_experiments(results)
       experiments, reflections = find_rmsd_from_refl_tables(all_experiments, all_reflections, num_images)
       if params.dump_files:
         from dxtbx.model.experiment_list import ExperimentListDumper
@@ -181,16 +211,8 @@ if __name__ == '__main__':
     results = find_rmsd_from_files(iterable2, root, num_images, rank=0)
     #from IPython import embed; embed(); exit()
     if True:
-    # stitch together refl tables and experiment lists
-      all_experiments = ExperimentList()
-      all_reflections = flex.reflection_table()
-      expt_list,refl_list = results
-      for ii,expt in enumerate(expt_list):
-        all_experiments.append(expt)
-        refl = refl_list.select(refl_list['id'] == ii)
-        refl['id'].set_selected(flex.size_t(range(len(refl['id']))),ii)
-        all_reflections.extend(refl)
-      experiments, reflections = find_rmsd_from_refl_tables(all_experiments, all_reflections, num_images)
+      # find_rmsd_from_files already returns the top num_images, highest first
+      experiments, reflections = results
       if params.dump_files:
         from dxtbx.model.experiment_list import ExperimentListDumper
         from libtbx.easy_pickle import dump
@@ -1,99 +1,73 @@
-import sys, os
-from iotbx.detectors.cspad_detector_formats import reverse_timestamp
+from __future__ import absolute_import, division, print_function
+from argparse import ArgumentParser
+import glob
+import os
 import numpy as np
-from matplotlib import pyplot as plt
+from exafel_project.kpp_utils.log_index import load_events
 
-# Run this script in the debug directory as 
-# libtbx.python histogram_timings.py .       #NOTE THE DOT !!!
+message = '''
+Histograms of the time spent in every processing step, read from the debug
+files (debug_<rank>.txt) of an xfel processing job. The debug files are
+indexed in parallel by kpp_utils/log_index.py, every line becoming a
+"debug:<step>" event, and the time between two lines of a rank is counted
+for the step of the first one.
+Example usage, in the debug directory:
+  libtbx.python mpi_histogram_timings.py . --nproc 32 --event_table debug_events.h5 --plot
+'''
 
+DEBUG_EVENT = "debug:"
 
 
-root = os.getcwd() #sys.argv[1]
-
-
-def add_step(step, duration, steps_d,ts,fname,now_step):
-  step = step.strip()
-  my_step = step
+def step_name(step):
+  ''' Step a duration is histogrammed under: the debug step without its
+      _start suffix or the outcome of indexing '''
   if step.endswith("_start"):
     step = "_".join(step.split('_')[:-1])
   if any([s in step for s in ['_ok_','_failed_']]):
     step = "_".join(step.split('_')[:-1])
   if 'not_enough_spots' in step:
     step = "_".join(step.split('_')[:-1])
+  return step
 
-  if step not in steps_d:
-    steps_d[step] = []
-  steps_d[step].append(duration)
-  if 'indexing_failed' in my_step:
-    #print 'psanagpu999,%s,%s,fail'%(ts,ts)
-    #print 'psanagpu999',ts,ts,'fail'
-    print 'F_D_B',ts,' ',duration,fname,my_step.strip()
-  return steps_d
-  
 
-def get_timing_info(root, rank=0, size=1):
+def get_timing_info(events):
+  ''' {step: list of durations} from the debug events of a log_index table '''
+  debug = events[events["event"].astype(str).str.startswith(DEBUG_EVENT)]
   steps_d = {}
-  for ii,filename in enumerate(os.listdir(root)):
-    if os.path.splitext(filename)[1] != ".txt": continue
-    if (ii+rank)%size !=0: continue
-    current_ts = ""
-    prev_step = ""
-    prev_time = None
-    with open(os.path.join(root, filename)) as logfile:
-      for line in logfile:
-        try:
-          hostname, ts, now, status, step = line.split(',')
-        except ValueError:
-          print 'ERROR',line; raise
-        now_s, now_ms = reverse_timestamp(now)
-        now = now_s + (1e-3 * now_ms)
-        #from IPython import embed; embed(); exit()
-        if step.strip() == 'start':
-          if prev_time is not None:
-            #print prev_step.strip(), "took", now - prev_time, "seconds"
-  	    steps_d=add_step(prev_step, now-prev_time,steps_d,ts,filename,step)
-        else:
-          #print prev_step.strip(), "took", now - prev_time, "seconds"
-  	  steps_d=add_step(prev_step, now-prev_time,steps_d,ts,filename,step)
-        current_ts = ts
-        prev_step = step
-        prev_time = now
-    #if 'index' in step:
-    #  print 'FWWWWW',step,filename,ts
-  
-  #print steps_d.keys()
+  for rank, group in debug.groupby("rank", sort=False):
+    steps = [event[len(DEBUG_EVENT):] for event in group["event"].astype(str)]
+    times = group["timestamp"].to_numpy()
+    for prev_step, duration, now in zip(steps[:-1], np.diff(times), times[1:]):
+      steps_d.setdefault(step_name(prev_step), []).append(duration)
+      if 'indexing_failed' in prev_step:
+        print('F_D_B', now, ' ', duration, 'debug_%d.txt'%rank, prev_step)
   return steps_d
 
-def run(root):
-  comm=None
-  rank=0
-  if True:
-    try:
-      from mpi4py import MPI
-    except ImportError:
-      raise Sorry("MPI not found")
-    comm=MPI.COMM_WORLD
-    rank = comm.Get_rank()
-    size = comm.Get_size()
-    #print (rank, size)
 
-    steps_d_mpi=get_timing_info(root,rank=rank,size=size) 
-    steps_d_mpi=comm.gather(steps_d_mpi, root=0)
-    if rank !=0: return
-    #from IPython import embed; embed(); exit()
-    steps_d = {}
-    for entry in steps_d_mpi:
-      for key in entry:
-        if key not in steps_d:
-          steps_d[key] = []
-        steps_d[key].extend(entry[key])
-
-  exit()
+def run(root, nproc=1, event_table=None, plot=False):
+  paths = sorted(glob.glob(os.path.join(root, "*.txt")))
+  events = load_events(paths, table=event_table, nproc=nproc)
+  steps_d = get_timing_info(events)
+  for key in sorted(steps_d):
+    durations = np.array(steps_d[key])
+    print('%-40s %8d steps, median %10.3f s, mean %10.3f s, max %10.3f s'%(
+          key, len(durations), np.median(durations), durations.mean(), durations.max()))
+  if not plot:
+    return steps_d
+  from matplotlib import pyplot as plt
   for key in steps_d:
     plt.figure()
     plt.title(key)
     plt.hist(steps_d[key], bins=100)
   plt.show()
+  return steps_d
+
 
 if __name__=='__main__':
-  run(root)
+  parser = ArgumentParser(description=message)
+  parser.add_argument("root", nargs="?", default=".", help="debug directory of the processing job")
+  parser.add_argument("--nproc", type=int, default=1, help="number of worker processes indexing the debug files")
+  parser.add_argument("--event_table", default=None, help="HDF5 event table of the debug files, reused while they are unchanged")
+  parser.add_argument("--plot", action="store_true", help="show a histogram of the durations of every step")
+  args = parser.parse_args()
+  run(args.root, nproc=args.nproc, event_table=args.event_table, plot=args.plot)
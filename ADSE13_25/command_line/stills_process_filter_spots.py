@@ -100,6 +100,7 @@ iota {
   }
   include scope exafel_project.ADSE13_25.clustering.consensus_functions.clustering_iota_scope
   include scope exafel_project.ADSE13_25.refinement.iota_refiner.iota_refiner_scope
+  include scope exafel_project.ADSE13_25.indexing.iota_trials.trials_iota_scope
 }
 '''
 
@@ -500,9 +501,10 @@ class Processor_iota(Processor):
         ''' Conventional indexing that is with refinement of basis vectors and outlier rejection done'''
         return super(Processor_iota, self).index(experiments, reflections)
 
-    def index_with_iota(self, experiments, reflections):
+    def index_with_iota(self, experiments, reflections, rlp_mapped=False):
         ''' Special indexing code where no refinement and outlier rejection is done; 
-            HKL frac values are determined for all the spots considered '''
+            HKL frac values are determined for all the spots considered.
+            rlp_mapped: reflections already mapped to reciprocal space for these experiments '''
         from exafel_project.ADSE13_25.indexing.indexer_iota import iota_indexer
         from time import time
         import copy
@@ -526,7 +528,7 @@ class Processor_iota(Processor):
         if params.indexing.stills.method_list is None:
             idxr = iota_indexer.from_parameters(
               reflections, experiments, known_crystal_models=known_crystal_models,
-              params=params)
+              params=params, rlp_mapped=rlp_mapped)
             idxr.index()
         else:
             indexing_error = None
@@ -535,7 +537,7 @@ class Processor_iota(Processor):
                 try:
                     idxr = iota_indexer.from_parameters(
                       reflections, experiments,
-                      params=params)
+                      params=params, rlp_mapped=rlp_mapped)
                     idxr.index()
                 except Exception as e:
                     logger.info("Couldn't index using method %s"%method)
@@ -651,6 +653,49 @@ class Processor_iota(Processor):
 
         return experiments, indexed
 
+    def sub_sample_size(self, n_observed):
+        ''' Number of spots indexed in each random sub-sampling trial, None if there are too few spots '''
+        rss_params = self.params.iota.random_sub_sampling
+        if rss_params.auto_select_Nspots:
+            LS49_five_number_summary_strong_spots = (16,21,30,39,157) # from run 222
+            lucky_number = 100 # number of spots to be left out !!
+            if n_observed <= lucky_number:
+                return int(n_observed*0.75)
+            #nfrac = 0.7-(n_observed-30)/(240)
+            nfrac=0.6
+            return int(n_observed*nfrac)
+        if rss_params.Nspots_sub_sample is not None:
+            if n_observed > rss_params.Nspots_sub_sample:
+                return rss_params.Nspots_sub_sample
+            return None
+        return int(n_observed*rss_params.fraction_sub_sample)
+
+    def index_trial(self, experiments, observed_sample):
+        ''' Index one random sub-sample of the strong spots, mapped to reciprocal space by map_trial_spots '''
+        if self.params.iota.random_sub_sampling.finalize_method == 'union_and_reindex':
+            return self.index_with_iota(experiments, observed_sample, rlp_mapped=True)
+        return self.conventional_index(experiments, observed_sample)
+
+    def map_trial_spots(self, experiments, observed):
+        ''' Map the strong spots to reciprocal space once for all the trials of the frame,
+            instead of in the setup of every trial indexer '''
+        if 'imageset_id' not in observed:
+            observed['imageset_id'] = observed['id']
+        observed.centroid_px_to_mm(experiments)
+        observed.map_centroids_to_reciprocal_space(experiments)
+
+    def trial_consensus(self, trial_results):
+        ''' Consensus crystal models of the trials indexed so far, used to stop the trials early '''
+        from dxtbx.model.experiment_list import ExperimentList
+        experiments_list = [ExperimentList([expt]) for _, _, experiments_tmp, _ in trial_results for expt in experiments_tmp]
+        if self.params.iota.random_sub_sampling.finalize_method == 'reindex_with_known_crystal_models':
+            from exafel_project.ADSE13_25.clustering.old_consensus_functions import get_uc_consensus as get_consensus
+            known_crystal_models, _ = get_consensus(experiments_list, show_plot=False, return_only_first_indexed_model=True, finalize_method=None, clustering_params=None)
+        else:
+            from exafel_project.ADSE13_25.clustering.consensus_functions import get_uc_consensus as get_consensus
+            known_crystal_models, _ = get_consensus(experiments_list, show_plot=False, return_only_first_indexed_model=False, finalize_method=self.params.iota.random_sub_sampling.finalize_method, clustering_params=self.params.iota.clustering)
+        return known_crystal_models
+
     def index(self, experiments, observed):
         ''' Override the index function of Script with this one. The conventional index function is above'''
         if self.params.iota.filter_spots:
@@ -699,49 +744,38 @@ class Processor_iota(Processor):
             expt_id=-1
             debug_mode=self.params.iota.random_sub_sampling.debug_mode
             load_pickle_flag=self.params.iota.random_sub_sampling.load_pickle_flag
-            for trial in range(self.params.iota.random_sub_sampling.ntrials):
-                if not debug_mode and load_pickle_flag:
-                    continue
-                flex.set_random_seed(trial+1001)
-
-                if self.params.iota.random_sub_sampling.auto_select_Nspots: 
-                    LS49_five_number_summary_strong_spots = (16,21,30,39,157) # from run 222
-                    lucky_number = 100 # number of spots to be left out !!
-                    if len(observed) <= lucky_number:
-                        #
-                        Nspots = int(len(observed)*0.75)
-                    else:
-                        #
-                        #nfrac = 0.7-(len(observed)-30)/(240)
-                        nfrac=0.6
-                        Nspots = int(len(observed)*nfrac)
-                    observed_sample = observed.select(flex.random_selection(len(observed),Nspots))
-                elif self.params.iota.random_sub_sampling.Nspots_sub_sample is not None:
-                    if len(observed) > self.params.iota.random_sub_sampling.Nspots_sub_sample:
-                        observed_sample =  observed.select(flex.random_selection(len(observed),self.params.iota.random_sub_sampling.Nspots_sub_sample)) 
+            if not debug_mode and load_pickle_flag:
+                trial_results = []
+            else:
+                from exafel_project.ADSE13_25.indexing.iota_trials import TrialExecutor, draw_subsamples
+                Nspots = self.sub_sample_size(len(observed))
+                if Nspots is None:
+                    print('IOTA: not sub-sampling, only %d strong spots'%len(observed))
+                    selections = []
                 else:
-                    observed_sample = observed.select(flex.random_selection(len(observed), int(len(observed)*self.params.iota.random_sub_sampling.fraction_sub_sample)))
-                try:
-                    print ('IOTA: SUM_INTENSITY_VALUE',sum(observed_sample['intensity.sum.value']), ' ',trial, len(observed_sample))
-                    if self.params.iota.random_sub_sampling.finalize_method == 'union_and_reindex':
-                        experiments_tmp, indexed_tmp = self.index_with_iota(experiments, observed_sample)
-                        for ii,expt_tmp in enumerate(experiments_tmp):
-                            expt_id +=1
-                            refl=indexed_tmp.select(indexed_tmp['id']==ii)
-                            refl['id'].set_selected(flex.bool([True]*len(refl['id'])), expt_id)
-                            dump_refls.extend(refl)
-                            dump_expts.append(expt_tmp)
-                    elif self.params.iota.random_sub_sampling.finalize_method == 'reindex_with_known_crystal_models':
-                        experiments_tmp, indexed_tmp = self.conventional_index(experiments, observed_sample)
-
+                    selections = draw_subsamples(len(observed), Nspots, self.params.iota.random_sub_sampling.ntrials)
+                    self.map_trial_spots(experiments, observed)
+                executor = TrialExecutor(self.index_trial, experiments, observed, self.params.iota.trials,
+                                         consensus=self.trial_consensus)
+                trial_results = executor.run(selections)
+            for trial, selection, experiments_tmp, indexed_tmp in trial_results:
+                if experiments_tmp is None:
+                    print('Indexing failed for some reason', indexed_tmp)
+                    continue
+                observed_sample = observed.select(selection)
+                if self.params.iota.random_sub_sampling.finalize_method == 'union_and_reindex':
                     for ii,expt_tmp in enumerate(experiments_tmp):
-                        # Appending each experiment separately to experiments_list 
-                        # and corresponding observation separately to observerd_samples_list
-                        experiments_list.append(ExperimentList([expt_tmp]))
-                        observed_samples_list.append(observed_sample)
-                except Exception as e:
-                    print('Indexing failed for some reason', str(e))
-
+                        expt_id +=1
+                        refl=indexed_tmp.select(indexed_tmp['id']==ii)
+                        refl['id'].set_selected(flex.bool([True]*len(refl['id'])), expt_id)
+                        dump_refls.extend(refl)
+                        dump_expts.append(expt_tmp)
+
+                for ii,expt_tmp in enumerate(experiments_tmp):
+                    # Appending each experiment separately to experiments_list 
+                    # and corresponding observation separately to observerd_samples_list
+                    experiments_list.append(ExperimentList([expt_tmp]))
+                    observed_samples_list.append(observed_sample)
 
             from libtbx.easy_pickle import dump,load
             if not load_pickle_flag and self.tag is not None:
@@ -385,6 +385,7 @@ xtc_phil_str = '''
 
     }
     include scope exafel_project.ADSE13_25.clustering.consensus_functions.clustering_iota_scope
+    include scope exafel_project.ADSE13_25.indexing.iota_trials.trials_iota_scope
   }
 
 '''
@@ -1248,20 +1249,15 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
             self.params.indexing.stills.refine_all_candidates=False
 
           observed_samples_list = []
-          for trial in range(self.params.iota.random_sub_sampling.ntrials):
-            flex.set_random_seed(trial+1001)
-            observed_sample = observed.select(flex.random_selection(len(observed), int(len(observed)*self.params.iota.random_sub_sampling.fraction_sub_sample)))
-            try:
-              print ('IOTA: SUM_INTENSITY_VALUE',sum(observed_sample['intensity.sum.value']), ' ',trial)
-              if self.params.iota.random_sub_sampling.finalize_method == 'union_and_reindex':
-                experiments_tmp, indexed_tmp = self.index_with_iota(datablock, observed_sample)
-              elif self.params.iota.random_sub_sampling.finalize_method == 'reindex_with_known_crystal_models':
-                experiments_tmp, indexed_tmp = self.index(datablock, observed_sample)
-
-              experiments_list.append(experiments_tmp)
-              observed_samples_list.append(observed_sample)
-            except Exception:
+          from exafel_project.ADSE13_25.indexing.iota_trials import TrialExecutor, draw_subsamples
+          selections = draw_subsamples(len(observed), int(len(observed)*self.params.iota.random_sub_sampling.fraction_sub_sample), self.params.iota.random_sub_sampling.ntrials)
+          executor = TrialExecutor(self.index_trial, datablock, observed, self.params.iota.trials)
+          for trial, selection, experiments_tmp, indexed_tmp in executor.run(selections):
+            if experiments_tmp is None:
               print('Indexing failed for some reason')
+              continue
+            experiments_list.append(experiments_tmp)
+            observed_samples_list.append(observed.select(selection))
           #from libtbx.easy_pickle import dump,load
           #dump('experiments_list.pickle', experiments_list)
           #dump('observed_samples_list.pickle', observed_samples_list)
@@ -1582,6 +1578,12 @@ class InMemScript(DialsProcessScript, DialsProcessorWithLogging):
 
     return dest_path
 
+  def index_trial(self, datablock, observed_sample):
+    """ Index one random sub-sample of the strong spots """
+    if self.params.iota.random_sub_sampling.finalize_method == 'union_and_reindex':
+      return self.index_with_iota(datablock, observed_sample)
+    return self.index(datablock, observed_sample)
+
   def index_with_iota(self, datablock, reflections):
     from exafel_project.ADSE13_25.indexing.indexer_iota import iota_indexer
     from time import time
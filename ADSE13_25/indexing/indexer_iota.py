@@ -1,6 +1,7 @@
 from __future__ import absolute_import, division
 from __future__ import print_function
 import logging
+import math
 logger = logging.getLogger(__name__)
 
 from dials.util import log
@@ -36,9 +37,11 @@ import pkg_resources
 
 class iota_indexer(StillsIndexer):
 
-  def __init__(self, reflections, experiments, params=None):
+  def __init__(self, reflections, experiments, params=None, rlp_mapped=False):
     '''Init function for iota_indexer is different from indexer_base in that
-       _setup_symmetry function is not called. All features only work for stills'''
+       _setup_symmetry function is not called. All features only work for stills.
+       rlp_mapped: the reflections already have their xyzobs.mm and rlp columns
+       for these experiments, e.g. mapped once for all the IOTA trials of a frame'''
 
 
     # FIXME this should not be called the stills_indexer __init__ method
@@ -46,6 +49,7 @@ class iota_indexer(StillsIndexer):
     #stills_indexer.__init__(self, reflections, imagesets, params)
     self.reflections = reflections
     self.experiments = experiments
+    self.rlp_mapped = rlp_mapped
     #if params is None: params = master_params
     self.params = params.indexing
     self.all_params = params
@@ -83,9 +87,26 @@ class iota_indexer(StillsIndexer):
     self.d_min = None
     self.setup_indexing()
 
+  def setup_indexing(self):
+    ''' Indexer.setup_indexing, without mapping the centroids to reciprocal
+        space again when that was done by the caller (rlp_mapped) '''
+    if not self.rlp_mapped:
+      return super(iota_indexer, self).setup_indexing()
+    if len(self.reflections) == 0:
+      raise Sorry("No reflections left to index!")
+    if "imageset_id" not in self.reflections:
+      self.reflections["imageset_id"] = self.reflections["id"]
+    self.reflections.calculate_entering_flags(self.experiments)
+    self.find_max_cell()
+    if self.params.sigma_phi_deg is not None:
+      var_x, var_y, _ = self.reflections['xyzobs.mm.variance'].parts()
+      var_phi_rad = flex.double(var_x.size(), (math.pi/180*self.params.sigma_phi_deg)**2)
+      self.reflections['xyzobs.mm.variance'] = flex.vec3_double(var_x, var_y, var_phi_rad)
+    self.reflections["id"] = flex.int(len(self.reflections), -1)
+
   @staticmethod
   def from_parameters(reflections, experiments,
-                      known_crystal_models=None, params=None):
+                      known_crystal_models=None, params=None, rlp_mapped=False):
     '''Sets up indexer object that will be used for indexing '''
 #    if params is None:
 #      params = master_params
@@ -157,7 +178,7 @@ class iota_indexer(StillsIndexer):
       #  reflections, experiments, params, known_crystal_models)
     for entry_point in pkg_resources.iter_entry_points("dials.index.basis_vector_search"):
       if params.indexing.method==entry_point.name:
-        idxr=IOTA_StillsIndexerBasisVectorSearch(reflections, experiments, params=params)
+        idxr=IOTA_StillsIndexerBasisVectorSearch(reflections, experiments, params=params, rlp_mapped=rlp_mapped)
         return idxr
           
     #elif params.indexing.method == "fft3d":
@@ -397,9 +418,10 @@ class IOTA_StillsIndexerKnownOrientation(IndexerKnownOrientation, iota_indexer):
 
 
 class IOTA_StillsIndexerBasisVectorSearch(iota_indexer, BasisVectorSearch):
-    def __init__(self, reflections, experiments, params):
+    def __init__(self, reflections, experiments, params, rlp_mapped=False):
+      self.rlp_mapped = rlp_mapped
       BasisVectorSearch.__init__(self,reflections, experiments, params)
-      iota_indexer.__init__(self,reflections, experiments, params)
+      iota_indexer.__init__(self,reflections, experiments, params, rlp_mapped)
     #pass
 
 
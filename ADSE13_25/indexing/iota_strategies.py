@@ -37,6 +37,22 @@ def compute_functional(vector, reciprocal_lattice_vectors):
   #from IPython import embed; embed(); exit()
   return flex.sum(flex.cos(two_pi_S_dot_v))
 
+# Process-level cache of the coarse SimpleSamplerTool hemisphere grids. The grid only depends on the
+# sampling increment, so it is shared by all the frames and IOTA trials indexed by a process.
+_hemisphere_grids = {}
+
+
+def hemisphere_grid(incr):
+  """flex.Direction of the hemisphere grid with sampling increment incr, built once per process"""
+  from rstbx.array_family import flex
+  from rstbx.dps_core import SimpleSamplerTool
+  if incr not in _hemisphere_grids:
+    SST = SimpleSamplerTool(incr)
+    SST.construct_hemisphere_grid(SST.incr)
+    _hemisphere_grids[incr] = SST.angles
+  return _hemisphere_grids[incr]
+
+
 real_space_grid_smart_search_phil_str = """\
 coarse_sampling_grid = 0.005
   .type = float(value_min=0)
@@ -79,8 +95,11 @@ class RealSpaceGridSmartSearch(Strategy):
 
     #assert self.target_symmetry_primitive is not None
     #assert self.target_symmetry_primitive.unit_cell() is not None
+    import time
+    time1=time.time()
     SST = SimpleSamplerTool(coarse_sampling_grid)
-    SST.construct_hemisphere_grid(SST.incr)
+    SST.angles = hemisphere_grid(SST.incr)
+    print ('HEMISPHERE GRID TIME =',time.time()-time1)
     #cell_dimensions = self.target_symmetry_primitive.unit_cell().parameters()[:3]
     cell_dimensions = self._target_unit_cell.parameters()[:3]
     unique_cell_dimensions = set(cell_dimensions)
@@ -88,7 +107,6 @@ class RealSpaceGridSmartSearch(Strategy):
                  %(len(SST.angles) * len(unique_cell_dimensions)))
     vectors = flex.vec3_double()
     function_values = flex.double()
-    import time
     SST_all_angles = flex.Direction()
     # C++ function should be like this
     if self._params.use_openmp:
@@ -144,6 +162,9 @@ class RealSpaceGridSmartSearch(Strategy):
       direction=SST.angles[v//len(unique_cell_dimensions)]
       SST_filter.append(direction)
 
+    # SST.angles shares its handle with the cached coarse grid and only finegrained_angles is
+    # searched from here on, so detach it rather than let the fine grid construction touch it
+    SST.angles = flex.Direction()
     SST.construct_hemisphere_grid_finegrained(fine_sampling_grid, coarse_sampling_grid, SST_filter)
     return SST
 
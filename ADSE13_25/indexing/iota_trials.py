@@ -0,0 +1,277 @@
+from __future__ import absolute_import, division, print_function
+from six.moves import range
+import atexit
+import multiprocessing
+import os
+import pickle
+import random
+import sys
+from libtbx.phil import parse
+
+'''
+Runs the IOTA random sub-sampling indexing trials of one frame concurrently.
+All subsample selections are drawn up front in trial order, each with its own
+seed (trial+1001, as the serial loop did), and every trial starts from the
+random generator state the serial loop had after drawing its subsample, so a
+trial indexes the same spots the same way whichever worker picks it up.
+The pool of workers is created once per rank, on the first frame, and reused
+for all the frames of the rank. In process mode the frame (experiments and
+strong spots) is pickled once and sent with the tasks, and the experiments
+come back without their imagesets, which the rank puts back. Frames that
+cannot be pickled, such as psana in-memory imagesets, are run on threads.
+Results are always returned in trial order. Optionally the trials stop early
+once the consensus crystal models no longer change between checks.
+'''
+
+trials_iota_phil_str = '''
+trials {
+  nproc = 1
+    .type = int
+    .help = Number of workers indexing the random sub-sampling trials of a frame on each rank. \
+            1 runs the trials one after the other in the rank. None uses the cores left \
+            over for each rank on its node
+  method = *process thread
+    .type = choice
+    .help = process forks a pool of workers once per rank, for frames with file-backed \
+            imagesets. Forking after MPI_Init is not supported by some interconnects. \
+            thread only helps if the indexing releases the GIL, and its threads share the \
+            random generators, so the trials are not reproducible
+  stop_when_stable = False
+    .type = bool
+    .help = Stop submitting trials once the consensus crystal models are the same for \
+            stable_checks consecutive checks
+  check_every = 10
+    .type = int(value_min=1)
+    .help = Number of trials run between two consensus checks. Also the number of trials \
+            submitted at a time when stop_when_stable is True
+  min_trials = 10
+    .type = int(value_min=1)
+    .help = Number of successful trials needed before the consensus is checked
+  stable_checks = 2
+    .type = int(value_min=1)
+    .help = Number of consecutive checks giving the same consensus models needed to stop
+  relative_length_tolerance = 0.01
+    .type = float
+    .help = Unit cell lengths of consensus models within this fraction are the same
+  absolute_angle_tolerance = 1.0
+    .type = float
+    .help = Unit cell angles of consensus models within this many degrees are the same
+}
+'''
+trials_iota_scope = parse(trials_iota_phil_str)
+
+FIRST_SEED = 1001
+LOCAL_SIZE_VARIABLES = ('MPI_LOCALNRANKS', 'OMPI_COMM_WORLD_LOCAL_SIZE', 'SLURM_NTASKS_PER_NODE')
+
+def trial_seed(trial):
+  return trial + FIRST_SEED
+
+def draw_subsamples(n_observed, n_sub_sample, ntrials):
+  ''' size_t selections of n_sub_sample out of n_observed spots, one per trial '''
+  from scitbx.array_family import flex
+  selections = []
+  for trial in range(ntrials):
+    flex.set_random_seed(trial_seed(trial))
+    selections.append(flex.random_selection(n_observed, n_sub_sample))
+  return selections
+
+def cores_per_rank():
+  ''' Cores this rank may use: its CPU affinity, divided between the ranks of
+      the node when they are not bound to separate cores '''
+  n_cores = multiprocessing.cpu_count()
+  try:
+    n_usable = len(os.sched_getaffinity(0))
+  except AttributeError:
+    n_usable = n_cores
+  if n_usable == n_cores:
+    for variable in LOCAL_SIZE_VARIABLES:
+      value = os.environ.get(variable, '').split('(')[0].split(',')[0]
+      if value.isdigit() and int(value) > 0:
+        n_usable = n_cores // int(value)
+        break
+  return max(1, n_usable)
+
+def mpi_initialized():
+  MPI = sys.modules.get('mpi4py.MPI')
+  return MPI is not None and MPI.Is_initialized()
+
+def same_models(models, other_models, relative_length_tolerance, absolute_angle_tolerance):
+  ''' True if both lists hold crystal models with the same unit cells, in any order '''
+  if other_models is None or len(models) != len(other_models):
+    return False
+  cells = sorted([m.get_unit_cell() for m in models], key=lambda uc: uc.parameters())
+  other_cells = sorted([m.get_unit_cell() for m in other_models], key=lambda uc: uc.parameters())
+  for uc, other_uc in zip(cells, other_cells):
+    if not uc.is_similar_to(other_uc, relative_length_tolerance=relative_length_tolerance,
+                            absolute_angle_tolerance=absolute_angle_tolerance):
+      return False
+  return True
+
+def frame_imagesets(frame):
+  ''' Imagesets of an ExperimentList or of a DataBlock '''
+  if hasattr(frame, 'imagesets'):
+    return frame.imagesets()
+  return frame.extract_imagesets()
+
+def run_trial(index_trial, experiments, observed, trial, selection):
+  ''' (trial, selection, experiments, indexed), experiments being None and
+      indexed the error message if indexing failed '''
+  from scitbx.array_family import flex
+  # Same random generator state as the serial loop had after drawing this
+  # subsample, whichever worker runs the trial and whatever it ran before
+  flex.set_random_seed(trial_seed(trial))
+  flex.random_selection(len(observed), len(selection))
+  random.seed(trial_seed(trial))
+  observed_sample = observed.select(selection)
+  try:
+    print ('IOTA: SUM_INTENSITY_VALUE',sum(observed_sample['intensity.sum.value']), ' ',trial, len(observed_sample))
+    experiments_tmp, indexed_tmp = index_trial(experiments, observed_sample)
+  except Exception as e:
+    return trial, selection, None, str(e)
+  return trial, selection, experiments_tmp, indexed_tmp
+
+# Pool of this rank, created for the first frame and reused for the next ones
+_pool = None
+_pool_key = None
+# Trial indexer inherited by the forked workers, and the frame they last unpickled
+_index_trial = None
+_frame = None
+_frame_id = 0
+_warned_fork = False
+
+def _run_trial(task):
+  ''' Worker side of process mode. The experiments are returned without their
+      imagesets, with the index of each imageset in the frame instead '''
+  global _frame
+  frame_id, frame_pickle, trial, selection = task
+  if _frame is None or _frame[0] != frame_id:
+    _frame = (frame_id,) + tuple(pickle.loads(frame_pickle))
+  experiments, observed = _frame[1:]
+  trial, selection, experiments_tmp, indexed_tmp = run_trial(_index_trial, experiments, observed, trial, selection)
+  imageset_indices = None
+  if experiments_tmp is not None:
+    imagesets = frame_imagesets(experiments)
+    imageset_indices = []
+    for expt in experiments_tmp:
+      matches = [i for i, imageset in enumerate(imagesets) if imageset == expt.imageset]
+      imageset_indices.append(matches[0] if matches else 0)
+      expt.imageset = None
+  return trial, selection, experiments_tmp, indexed_tmp, imageset_indices
+
+def close_pool():
+  global _pool, _pool_key
+  if _pool is not None:
+    _pool.close()
+    _pool.join()
+  _pool = _pool_key = None
+
+atexit.register(close_pool)
+
+def get_pool(method, nproc, index_trial):
+  ''' The pool of this rank, created on first use. Process workers are forked
+      with index_trial, so the pool is only reused for the same trial indexer '''
+  global _pool, _pool_key, _index_trial, _warned_fork
+  key = (method, nproc, index_trial if method == 'process' else None)
+  if _pool is not None and _pool_key == key:
+    return _pool
+  close_pool()
+  if method == 'thread':
+    from multiprocessing.pool import ThreadPool
+    _pool = ThreadPool(nproc)
+  else:
+    if mpi_initialized() and not _warned_fork:
+      print ('IOTA: warning, forking %d trial workers after MPI_Init. Some interconnects do not support fork, '
+             'use iota.trials.method=thread if the workers hang or crash'%nproc)
+      _warned_fork = True
+    _index_trial = index_trial
+    if hasattr(multiprocessing, 'get_context'):
+      _pool = multiprocessing.get_context('fork').Pool(nproc)
+    else:
+      _pool = multiprocessing.Pool(nproc)
+  _pool_key = key
+  return _pool
+
+
+class TrialExecutor(object):
+  ''' Indexes the random subsamples of one frame.
+      index_trial(experiments, observed_sample) indexes one subsample and returns
+      (experiments, indexed). In process mode it must only depend on state that is
+      the same for the trials of every frame, as the workers keep the state of the
+      first frame. consensus(results), if given, returns the consensus crystal
+      models of the results so far and enables stop_when_stable '''
+
+  def __init__(self, index_trial, experiments, observed, params, consensus=None):
+    self.index_trial = index_trial
+    self.experiments = experiments
+    self.observed = observed
+    self.params = params
+    self.consensus = consensus
+    self.nproc = params.nproc if params.nproc is not None else cores_per_rank()
+    self.n_checks = 0
+
+  def run_trial(self, trial, selection):
+    return run_trial(self.index_trial, self.experiments, self.observed, trial, selection)
+
+  def frame_pickle(self):
+    ''' The pickled frame, None if it cannot be pickled '''
+    try:
+      return pickle.dumps((self.experiments, self.observed), pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+      print ('IOTA: frame cannot be sent to trial worker processes (%s), indexing trials on threads'%str(e))
+      return None
+
+  def make_map(self):
+    ''' Function mapping a list of (trial, selection) to their results '''
+    global _frame_id
+    if self.params.method == 'process':
+      frame_pickle = self.frame_pickle()
+      if frame_pickle is not None:
+        pool = get_pool('process', self.nproc, self.index_trial)
+        _frame_id += 1
+        frame_id = _frame_id
+        imagesets = frame_imagesets(self.experiments)
+        def process_map(tasks):
+          results = []
+          for trial, selection, experiments_tmp, indexed_tmp, imageset_indices in pool.map(
+              _run_trial, [(frame_id, frame_pickle, trial, selection) for trial, selection in tasks]):
+            if experiments_tmp is not None:
+              for expt, i in zip(experiments_tmp, imageset_indices):
+                expt.imageset = imagesets[i]
+            results.append((trial, selection, experiments_tmp, indexed_tmp))
+          return results
+        return process_map
+    pool = get_pool('thread', self.nproc, self.index_trial)
+    return lambda tasks: pool.map(lambda task: self.run_trial(*task), tasks)
+
+  def is_stable(self, results, previous_models):
+    succeeded = [r for r in results if r[2] is not None]
+    if len(succeeded) < self.params.min_trials:
+      return False, previous_models
+    models = self.consensus(succeeded)
+    if same_models(models, previous_models, self.params.relative_length_tolerance,
+                   self.params.absolute_angle_tolerance):
+      self.n_checks += 1
+    else:
+      self.n_checks = 0
+    return self.n_checks >= self.params.stable_checks, models
+
+  def run(self, selections):
+    ''' Results of the trials in trial order, failed trials included '''
+    tasks = list(enumerate(selections))
+    early_stop = self.params.stop_when_stable and self.consensus is not None
+    batch = self.params.check_every if early_stop else len(tasks)
+    if self.nproc > 1 and len(tasks) > 1:
+      map_trials = self.make_map()
+    else:
+      map_trials = lambda tasks: [self.run_trial(trial, selection) for trial, selection in tasks]
+    results = []
+    models = None
+    self.n_checks = 0
+    for first in range(0, len(tasks), batch):
+      results.extend(map_trials(tasks[first:first+batch]))
+      if early_stop and first+batch < len(tasks):
+        stable, models = self.is_stable(results, models)
+        if stable:
+          print ('IOTA: consensus stable after %d of %d trials'%(len(results), len(tasks)))
+          break
+    return results
@@ -310,6 +310,24 @@ class SpotFinding_Script(Script):
         else:
             do_work(0, iterable)
 
+def close_spots_to_delete(xyz, box_size, max_dist_px):
+    """Boolean mask of the spots to drop because a centroid lies closer than
+    max_dist_px: of each close pair the spot with the smaller bbox goes, and
+    both go if their bboxes are equally large. Pairs are found with a KD-tree
+    in one pass instead of comparing every spot with every other spot."""
+    from scipy.spatial import cKDTree
+    import numpy as np
+    delete = np.zeros(len(xyz), dtype=bool)
+    if len(xyz) < 2:
+        return delete
+    pairs = cKDTree(xyz).query_pairs(r=max_dist_px, output_type='ndarray')
+    i, j = pairs[:, 0], pairs[:, 1]
+    close = np.sqrt(((xyz[i] - xyz[j])**2).sum(axis=1)) < max_dist_px  # query_pairs also returns == r
+    i, j = i[close], j[close]
+    delete[j[box_size[i] >= box_size[j]]] = True
+    delete[i[box_size[j] >= box_size[i]]] = True
+    return delete
+
 class SpotFinding_Processor(Processor):
     def process_experiments(self, tag, experiments, img_id):
         import os
@@ -413,12 +431,10 @@ class SpotFinding_Processor(Processor):
         observed = flex.reflection_table.from_observations(experiments, self.params)
 
         # Reset z coordinates for dials.image_viewer; see Issues #226 for details
-        xyzobs = observed['xyzobs.px.value']
-        for i in xrange(len(xyzobs)):
-            xyzobs[i] = (xyzobs[i][0], xyzobs[i][1], 0)
-        bbox = observed['bbox']
-        for i in xrange(len(bbox)):
-            bbox[i] = (bbox[i][0], bbox[i][1], bbox[i][2], bbox[i][3], 0, 1)
+        x, y, _ = observed['xyzobs.px.value'].parts()
+        observed['xyzobs.px.value'] = flex.vec3_double(x, y, flex.double(len(observed), 0))
+        x0, x1, y0, y1, _, _ = observed['bbox'].parts()
+        observed['bbox'] = flex.int6(x0, x1, y0, y1, flex.int(len(observed), 0), flex.int(len(observed), 1))
 
         if self.params.output.composite_output:
             pass # no composite strong pickles yet
@@ -428,23 +444,11 @@ class SpotFinding_Processor(Processor):
             # Asmit LS49 specific stuff here
             # Make sure 2 spots centroids are not within some cutoff. If so, please throw out the smaller spot
             if len(observed) > 0 and self.params.LS49.filter_close_spots:
-                from scitbx.matrix import col
-                spots_to_delete = []
-                for ii, obs1 in enumerate(observed.rows()):
-                    for jj,obs2 in enumerate(observed.rows()):
-                        if ii == jj: continue
-                        dpx_centroid = (col(obs1['xyzobs.px.value']) - col(obs2['xyzobs.px.value'])).length()
-                        if dpx_centroid < self.params.LS49.filter_centroids_dist_px:
-                            box1_size = (obs1['bbox'][0]-obs1['bbox'][1])*(obs1['bbox'][2]-obs1['bbox'][3])
-                            box2_size = (obs2['bbox'][0]-obs2['bbox'][1])*(obs2['bbox'][2]-obs2['bbox'][3])
-                            if box1_size > box2_size:
-                                spots_to_delete.append(jj)
-                            else:
-                                spots_to_delete.append(ii)
-                spots_to_delete = list(set(spots_to_delete))
-                spots_to_delete_bool = flex.bool(len(observed), False)
-                for spot in spots_to_delete:
-                    spots_to_delete_bool[spot] = True
+                xyz = observed['xyzobs.px.value'].as_numpy_array()
+                x0, x1, y0, y1, _, _ = [p.as_numpy_array() for p in observed['bbox'].parts()]
+                box_size = (x0 - x1) * (y0 - y1)
+                spots_to_delete_bool = flex.bool(close_spots_to_delete(
+                    xyz, box_size, self.params.LS49.filter_centroids_dist_px))
                 observed.del_selected(spots_to_delete_bool)
 
             logger.info('\n' + '-' * 80)
@@ -0,0 +1,42 @@
+from __future__ import division, print_function
+import sys
+import h5py
+import numpy as np
+
+message = ''' Check that two simulated image_rank_*.h5 files hold bit-identical frames and model variables,
+              e.g. LY99_batch output with persistent_simulator=False and persistent_simulator=True.
+              Example usage:
+              libtbx.python compare_h5_pixels.py reference/image_rank_00000.h5 test/image_rank_00000.h5
+'''
+
+def datasets(handle):
+  found = {}
+  def visit(name, obj):
+    if isinstance(obj, h5py.Dataset) and obj.dtype.kind in "iuf":
+      found[name] = obj
+  handle.visititems(visit)
+  return found
+
+def all_frames_equal(a, b):
+  if a.ndim == 0:
+    return np.array_equal(a[()], b[()])
+  return all(np.array_equal(a[i], b[i]) for i in range(a.shape[0])) # one frame in memory at a time
+
+def run(reference, test):
+  n_diff = 0
+  with h5py.File(reference, "r") as A, h5py.File(test, "r") as B:
+    dA, dB = datasets(A), datasets(B)
+    for name in sorted(set(dA) | set(dB)):
+      if name not in dA or name not in dB:
+        print("MISSING", name); n_diff += 1; continue
+      a, b = dA[name], dB[name]
+      if a.shape != b.shape or not all_frames_equal(a, b):
+        print("DIFFERS", name, a.shape, b.shape); n_diff += 1
+  print("%d datasets differ"%n_diff)
+  return n_diff
+
+if __name__ == '__main__':
+  if len(sys.argv) != 3 or '--help' in sys.argv[1:] or '-h' in sys.argv[1:]:
+    print (message)
+    exit()
+  exit(1 if run(*sys.argv[1:]) else 0)
@@ -5,6 +5,8 @@ from libtbx.phil import parse
 from libtbx.utils import Sorry
 from scitbx.array_family import flex
 from scitbx.math import five_number_summary
+from exafel_project.kpp_utils.log_index import load_events
+from exafel_project.kpp_utils.weather_monitor import WeatherMonitor
 
 message = ''' script to get a sense of the computational performance of every rank while processing data.
               End product is a plot of wall time vs MPI rank number with every data point being that of a frame
@@ -45,6 +47,36 @@ phil_scope = parse('''
   pickle_filename = fig_object.pickle
     .type = str
     .help = Default name of pickled matplotlib plot saved to disk
+  live {
+    enable = False
+      .type = bool
+      .help = If True, follow the per-rank logs while the job runs instead of plotting, \
+              and keep a rolling summary of throughput, idle time and stragglers \
+              as done by kpp_utils/weather_monitor.py
+    interval = 30
+      .type = float
+      .help = Seconds between updates of the summary
+    window = 60
+      .type = float
+      .help = Seconds over which the current throughput is measured
+    straggler_factor = 3
+      .type = float
+      .help = A rank silent for this many median times per image is reported as a straggler
+    summary = weather_summary.json
+      .type = str
+      .help = Rolling summary file. The read offsets are checkpointed next to it, so that \
+              a restarted monitor resumes where it stopped
+    stop_after = None
+      .type = float
+      .help = Stop when no log grew for this many seconds, e.g. after the job ended
+  }
+  event_table = None
+    .type = str
+    .help = HDF5 event table of the logs (see kpp_utils/log_index.py). Written after indexing \
+            the logs if it does not exist, and read instead of the logs if it does.
+  nproc = 1
+    .type = int
+    .help = Number of processes indexing the logs
 ''')
 
 def params_from_phil(args):
@@ -60,22 +92,25 @@ def params_from_phil(args):
   params = phil_scope.fetch(sources=user_phil).extract()
   return params
 
-def get_MPI_time():
-  with open(os.path.join(params.rank_log_dir,params.jobid,"rank_0.log"),"r") as F:
-    lines = F.read().strip().split("\n")
-    assert "elapsed after Python imports" in lines[-1]
-    MPIlog_tokens = lines[-1].split()
-    elapsed = float(MPIlog_tokens[11])
-    ctime = " ".join(MPIlog_tokens[4:6])
-    return time.mktime(time.strptime(ctime,"%Y-%m-%d %H:%M:%S.%f")), elapsed
-def get_py_time():
-  with open(os.path.join(params.rank_log_dir,params.jobid,"rank_0.log"),"r") as F:
-    lines = F.read().strip().split("\n")
-    assert "elapsed after srun startup" in lines[-2]
-    MPIlog_tokens = lines[-2].split()
-    elapsed = float(MPIlog_tokens[11])
-    ctime = " ".join(MPIlog_tokens[4:6])
-    return time.mktime(time.strptime(ctime,"%Y-%m-%d %H:%M:%S.%f")), elapsed
+def get_events(params):
+  """Event table of the per-rank logs and the main slurm log, indexed in one pass"""
+  root=os.path.join(params.rank_log_dir,params.jobid)
+  logs = [os.path.join(root,filename) for filename in sorted(os.listdir(root))
+          if os.path.splitext(filename)[1] == '.log' and 'rank' in filename]
+  main_log = os.path.join(params.main_log_dir,"%s.out"%(params.jobid))
+  if os.path.isfile(main_log): logs.append(main_log)
+  print ("Indexing %d log files"%len(logs))
+  return load_events(logs, table=params.event_table, nproc=params.nproc)
+def select(events, name):
+  return events[events["event"] == name]
+def get_MPI_time(events):
+  rank0 = select(events, "python_elapsed")
+  last = rank0[rank0["rank"] == 0].iloc[-1]
+  return last["timestamp"], last["value"]
+def get_py_time(events):
+  rank0 = select(events, "srun_elapsed")
+  last = rank0[rank0["rank"] == 0].iloc[-1]
+  return last["timestamp"], last["value"]
 def get_log(params):
   log_file = os.path.join(params.main_log_dir,"%s.out"%(params.jobid))
   start_time, end_time = None, None
@@ -89,76 +124,38 @@ def get_log(params):
     print("OK")
   if start_time is None:  return None,None
   return float(start_time), float(end_time)
-def get_channcalc(params):
-  log_file = os.path.join(params.main_log_dir,"%s.out"%(params.jobid))
-  channcalc=flex.double()
-  channrank=flex.int()
-  sbcalc = flex.double()
-  sbrank = flex.int()
-  with open(log_file,"r") as F:
-    lines = F.read().strip().split("\n")
-    for line in lines:
-      if "finished with the calculation" in line:
-        tokens = line.split()
-        channcalc.append(float(tokens[1]))
-        channrank.append(int(tokens[0]))
-      if "finished with single" in line:
-        tokens = line.split()
-        sbcalc.append(float(tokens[1]))
-        sbrank.append(int(tokens[0]))
-  return channcalc, channrank, sbcalc, sbrank
+def get_channcalc(events):
+  channels = select(events, "channels_calculated")
+  single = select(events, "single_broadcast_finished")
+  return flex.double(channels["timestamp"].to_numpy()), flex.int(channels["rank"].to_numpy()), \
+         flex.double(single["timestamp"].to_numpy()), flex.int(single["rank"].to_numpy())
+
 
+def run_live(params):
+  monitor = WeatherMonitor([os.path.join(params.rank_log_dir,params.jobid,"rank_*.log")], params.live.summary,
+                           window=params.live.window, straggler_factor=params.live.straggler_factor)
+  monitor.run(interval=params.live.interval, stop_after=params.live.stop_after)
 
 def run(params):
   script_start, script_finis = get_log(params)
 
-  counter = 0
-  datum = None
-  root=os.path.join(params.rank_log_dir,params.jobid)
+  events = get_events(params)
   fig_object = plt.figure()
   good_total = fail_total = 0
-  good_timepoints = flex.double()
-  good_elapsed = flex.double()
-  good_channels = flex.double()
-  good_logger = flex.double()
-  all_rank = flex.int()
-  channels_rank = flex.int()
-  logger_rank = flex.int()
-
-  for filename in os.listdir(root):
-    if os.path.splitext(filename)[1] != '.log': continue
-    if 'rank' not in filename: continue
-
-    rank = int(filename.split('_')[1].split('.')[0])
-    counter += 1
-    if counter%100==1: print (filename, counter)
-    for line in open(os.path.join(root,filename)):
-      if line.startswith('datetime for channels'):
-        goodtime = float(line.split()[6])
-        good_channels.append(goodtime)
-        channels_rank.append(rank)
-      if "finished with the rank logger" in line:
-        goodtime = float(line.split()[1])
-        good_logger.append(goodtime)
-        logger_rank.append(rank)
-      if not line.startswith('idx------finis-------->'): continue
-      try:
-        _, _, _, _, ts, _, elapsed = line.strip().split()
-        epoch_finis = float(ts)
-      except ValueError:
-        continue
-      elapsed = float(elapsed)
-      epoch_start = epoch_finis - elapsed
-      if datum is None:
-        datum = epoch_start
-      datum = min(datum, epoch_start)
-
-      good_timepoints.append(epoch_finis)
-      good_elapsed.append(elapsed)
-      all_rank.append(rank)
+  channels = select(events, "channels_datetime")
+  good_channels = flex.double(channels["timestamp"].to_numpy())
+  channels_rank = flex.int(channels["rank"].to_numpy())
+  logger = select(events, "rank_logger_finished")
+  good_logger = flex.double(logger["timestamp"].to_numpy())
+  logger_rank = flex.int(logger["rank"].to_numpy())
+  finis = select(events, "image_finished")
+  good_timepoints = flex.double(finis["timestamp"].to_numpy())
+  good_elapsed = flex.double(finis["value"].to_numpy())
+  all_rank = flex.int(finis["rank"].to_numpy())
+  datum = flex.min(good_timepoints - good_elapsed)
 
   try:
-    chanx,chany,sbx,sby = get_channcalc(params)
+    chanx,chany,sbx,sby = get_channcalc(events)
     plt.plot(chanx-datum, chany, 'c.', markersize="0.8")
     plt.plot(sbx-datum, sby, 'b.', markersize="0.8")
   except Exception: pass
@@ -177,14 +174,14 @@ def run(params):
   plt.xlabel('Wall time (sec)')
   plt.ylabel('MPI Rank Number')
 
-  mpi_finish, mpi_elapse = get_MPI_time()
+  mpi_finish, mpi_elapse = get_MPI_time(events)
   mpi_start = mpi_finish - mpi_elapse
   plt.plot([mpi_finish-mpi_elapse-datum, mpi_finish-datum],[-(2./30.)*max_rank,-(2./30.)*max_rank], color = "orange", label="MPI comm")
   print ("The total MPI communicator time is %.1f seconds, with %.1f sec before 'foreach' and %.1f sec trailing"%(
            mpi_elapse, datum - mpi_start, mpi_finish - max(good_timepoints) ))
 
 
-  py_finish, py_elapse = get_py_time()
+  py_finish, py_elapse = get_py_time(events)
   py_start = py_finish - py_elapse
   plt.plot([py_finish-py_elapse-datum, py_finish-datum],[-(3./30.)*max_rank,-(3./30.)*max_rank], color = "blue", label="Python time")
   print ("The total Python time is %.1f seconds, with %.1f sec for imports and %.1f sec trailing"%(
@@ -223,4 +220,7 @@ if __name__ == '__main__':
   if not params.show_plot:
     import matplotlib
     matplotlib.use("pdf")
-run(params)
+if params.live.enable:
+  run_live(params)
+else:
+  run(params)
@@ -0,0 +1,77 @@
+"""
+Compare the per-reflection `offsets_from_refl_scalar` with the panel-grouped,
+vectorized `offsets_from_refl` of `evaluate_prediction_offset` on a synthetic
+reflection table spread over a multi-panel detector. Both paths must return
+identical data frames; the script raises if they do not.
+
+Example usage:
+  libtbx.python benchmark_prediction_offset.py --n_refl 100000 --n_panels 256
+"""
+from argparse import ArgumentParser
+from time import time
+
+import numpy as np
+
+from dials.array_family import flex
+from dxtbx.model import Detector
+
+from exafel_project.kpp_eval.evaluate_prediction_offset import \
+  offsets_from_refl, offsets_from_refl_scalar
+
+
+def synthetic_detector(n_panels: int, image_size: int = 256,
+                       pixel_size: float = 0.075) -> Detector:
+  """Ring of tilted panels around the beam at 150 mm distance"""
+  detector = Detector()
+  width = image_size * pixel_size
+  for i in range(n_panels):
+    angle = 2 * np.pi * i / n_panels
+    radius = 40. + width * (i % 4)
+    fast = (np.cos(angle), np.sin(angle), 0.01)
+    slow = (-np.sin(angle), np.cos(angle), 0.)
+    origin = (radius * np.cos(angle), radius * np.sin(angle), -150.)
+    panel = detector.add_panel()
+    panel.set_frame(fast, slow, origin)
+    panel.set_pixel_size((pixel_size, pixel_size))
+    panel.set_image_size((image_size, image_size))
+  return detector
+
+
+def synthetic_refl(n_refl: int, n_panels: int, image_size: int = 256,
+                   seed: int = 1337) -> flex.reflection_table:
+  rng = np.random.default_rng(seed)
+  xyz_obs = np.zeros((n_refl, 3))
+  xyz_obs[:, :2] = rng.uniform(0, image_size, size=(n_refl, 2))
+  xyz_cal = xyz_obs + rng.normal(0, 0.5, size=(n_refl, 3))
+  xyz_dials = xyz_obs + rng.normal(0, 0.8, size=(n_refl, 3))
+  refl = flex.reflection_table()
+  refl['panel'] = flex.size_t(rng.integers(0, n_panels, size=n_refl).astype(np.uint64))
+  refl['xyzobs.px.value'] = flex.vec3_double(xyz_obs)
+  refl['xyzcal.px'] = flex.vec3_double(xyz_cal)
+  refl['dials.xyzcal.px'] = flex.vec3_double(xyz_dials)
+  refl['rlp'] = flex.vec3_double(rng.uniform(0.05, 0.5, size=(n_refl, 3)))
+  return refl
+
+
+def run(args) -> None:
+  detector = synthetic_detector(args.n_panels)
+  refl = synthetic_refl(args.n_refl, args.n_panels)
+  start = time()
+  scalar = offsets_from_refl_scalar(refl, detector)
+  scalar_s = time() - start
+  start = time()
+  vectorized = offsets_from_refl(refl, detector)
+  vectorized_s = time() - start
+  for column in scalar.columns:
+    np.testing.assert_array_equal(scalar[column].values, vectorized[column].values,
+                                  err_msg=f'column {column} differs')
+  print(f'{args.n_refl} reflections on {args.n_panels} panels, identical results')
+  print(f'scalar     {scalar_s:9.3f} s')
+  print(f'vectorized {vectorized_s:9.3f} s, {scalar_s / vectorized_s:.1f}x faster')
+
+
+if __name__ == '__main__':
+  parser = ArgumentParser()
+  parser.add_argument('--n_refl', type=int, default=20000, help='number of reflections')
+  parser.add_argument('--n_panels', type=int, default=64, help='number of detector panels')
+  run(parser.parse_args())
@@ -7,8 +7,9 @@ files. It is based on many methods in `cctbx.xfel.merge` routine, see files:
 * xfel/merging/application/statistics/intensity_resolution_statistics.py
 """
 
+from itertools import combinations
 import math
-from typing import Dict, Iterable, NamedTuple, List
+from typing import Dict, Iterable, NamedTuple, List, Sequence, Tuple
 
 import numpy as np
 from cctbx import miller
@@ -26,8 +27,15 @@ mtz = None
 d_min = None
   .type = float
   .help = Lower bound of data resolution to be investigated, in Angstrom
+all_pairs = False
+  .type = bool
+  .help = If True, evaluate every pair of the mtz files given, reusing
+  .help = the resolution binner between pairs. Otherwise use the first two.
 """
 
+HKL_BITS = 21  # bits used by each of h, k, l in a packed int64 key
+HKL_OFFSET = 1 << (HKL_BITS - 1)
+
 
 class CrossCorrelationBin(NamedTuple):
   """Storage class for parameters of a cross-correlation resolution bin"""
@@ -113,50 +121,123 @@ class CrossCorrelationTable(object):
     self.cumulative_cross_correlation = cum_cc_sums.parameter
 
 
-def generate_hkl_to_bin_map(binner, miller_set) -> Dict:
-  """Generate dict: hkl to bin number for input binner"""
-  hkl_to_bin_map = {}  # hkl vs resolution bin number
-  for i_bin in binner.range_used():
-    bin_hkl_selection = binner.selection(i_bin)
-    bin_hkls = miller_set.select(bin_hkl_selection)
-    for hkl in bin_hkls.indices():
-      hkl_to_bin_map[hkl] = i_bin
-  return hkl_to_bin_map
+def pack_hkl(indices) -> np.ndarray:
+  """Pack flex.miller_index (or n x 3 ints) into one sortable int64 per hkl"""
+  if not isinstance(indices, np.ndarray):
+    indices = indices.as_vec3_double().as_numpy_array()
+  hkl = indices.astype(np.int64) + HKL_OFFSET
+  return (hkl[:, 0] << (2 * HKL_BITS)) | (hkl[:, 1] << HKL_BITS) | hkl[:, 2]
 
 
-def calculate_cross_correlation(mtz1_path: str, mtz2_path: str,
-                                d_min: float = None) -> CrossCorrelationTable:
-  """Calculate cc1/2 between two mtz files."""
-  ma1 = refl_file_reader.any_reflection_file(mtz1_path).as_miller_arrays()[0]
-  ma2 = refl_file_reader.any_reflection_file(mtz2_path).as_miller_arrays()[0]
-  d_min = d_min if d_min else max([ma1.d_min(), ma2.d_min()])
-  space_group_info = ma1.space_group().info()
-  unit_cell = ma1.unit_cell()
+class HklBinLookup(object):
+  """Resolution bin lookup of the hkls of `miller_set` in `binner`: sorted
+  packed hkl keys and the bin of each of them, queried with `bins_of`"""
+  def __init__(self, binner, miller_set) -> None:
+    self.binner = binner
+    keys, bins = [], []
+    for i_bin in binner.range_used():
+      bin_hkls = miller_set.select(binner.selection(i_bin))
+      keys.append(pack_hkl(bin_hkls.indices()))
+      bins.append(np.full(bin_hkls.size(), i_bin, dtype=np.int64))
+    keys = np.concatenate(keys)
+    bins = np.concatenate(bins)
+    order = np.argsort(keys, kind='stable')
+    self.keys = keys[order]
+    self.bins = bins[order]
+
+  def bins_of(self, indices) -> np.ndarray:
+    """Resolution bin of every hkl in `indices`, -1 if not in the set"""
+    keys = pack_hkl(indices)
+    if len(self.keys) == 0:
+      return np.full(len(keys), -1, dtype=np.int64)
+    position = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+    return np.where(self.keys[position] == keys, self.bins[position], -1)
+
+
+def read_miller_array(mtz_path: str) -> miller.array:
+  return refl_file_reader.any_reflection_file(mtz_path).as_miller_arrays()[0]
+
+
+def build_hkl_bin_lookup(ma: miller.array, d_min: float) -> HklBinLookup:
+  """Binner & hkl lookup as in self.params.statistics.resolution_binner"""
+  space_group_info = ma.space_group().info()
+  unit_cell = ma.unit_cell()
   symm = symmetry(unit_cell=unit_cell, space_group_info=space_group_info)
   ms = symm.build_miller_set(anomalous_flag=True, d_max=1000000, d_min=d_min)
   ms.setup_binner(d_max=100000, d_min=d_min, n_bins=10)
-  binner = ms.binner()  # as in self.params.statistics.resolution_binner
-  hkl_map = generate_hkl_to_bin_map(binner, ms)  # as in .hkl_resolution_bins
-  n_bins = binner.n_bins_all()
-  cc_sums_list = [CrossCorrelationSums() for _ in range(n_bins)]
+  return HklBinLookup(ms.binner(), ms)
+
 
+def cross_correlation_table(ma1: miller.array, ma2: miller.array,
+                            lookup: HklBinLookup) -> CrossCorrelationTable:
+  """Accumulate cc sums of matching hkls of `ma1` and `ma2` per bin"""
   matching_indices = miller.match_multi_indices(
     miller_indices_unique=ma1.indices(),
     miller_indices=ma2.indices())
-  for pair in matching_indices.pairs():
-    hkl = ma1.indices()[pair[0]]
-    assert hkl == ma2.indices()[pair[1]]
-    if hkl in hkl_map:
-      i_bin = hkl_map[hkl]
-      x = ma1.data()[pair[0]]
-      y = ma2.data()[pair[1]]
-      cc_sums_list[i_bin] += CrossCorrelationSums(1, x**2, y**2, x*y, x, y)
-  cct = CrossCorrelationTable(binner=binner)
+  pairs = matching_indices.pairs()
+  i1 = pairs.column(0).as_numpy_array().astype(np.int64)
+  i2 = pairs.column(1).as_numpy_array().astype(np.int64)
+  hkls = ma1.indices().as_vec3_double().as_numpy_array()[i1]
+  bins = lookup.bins_of(hkls)
+  in_set = bins >= 0
+  bins = bins[in_set]
+  x = ma1.data().as_numpy_array()[i1[in_set]]
+  y = ma2.data().as_numpy_array()[i2[in_set]]
+  n_bins = lookup.binner.n_bins_all()
+  # bincount adds weights in input order, same as summing pair by pair
+  sums = [np.bincount(bins, weights=w, minlength=n_bins)
+          for w in (x * x, y * y, x * y, x, y)]
+  counts = np.bincount(bins, minlength=n_bins)
+  cc_sums_list = [CrossCorrelationSums(int(counts[i_bin]),
+                                       *[float(s[i_bin]) for s in sums])
+                  for i_bin in range(n_bins)]
+  cct = CrossCorrelationTable(binner=lookup.binner)
   cct.build(cc_sums_list)
   return cct
 
 
+def calculate_cross_correlation(mtz1_path: str, mtz2_path: str,
+                                d_min: float = None) -> CrossCorrelationTable:
+  """Calculate cc1/2 between two mtz files."""
+  ma1 = read_miller_array(mtz1_path)
+  ma2 = read_miller_array(mtz2_path)
+  d_min = d_min if d_min else max([ma1.d_min(), ma2.d_min()])
+  return cross_correlation_table(ma1, ma2, build_hkl_bin_lookup(ma1, d_min))
+
+
+def calculate_cross_correlations(mtz_path_pairs: Sequence[Tuple[str, str]],
+                                 d_min: float = None
+                                 ) -> Dict[Tuple[str, str], CrossCorrelationTable]:
+  """Calculate cc1/2 for many pairs of mtz files, f.e. of merging variants.
+  Every mtz file is read once, and pairs with the same symmetry and d_min
+  share a single binner and hkl lookup."""
+  miller_arrays = {}
+  lookups = {}
+  tables = {}
+  for mtz1_path, mtz2_path in mtz_path_pairs:
+    for path in (mtz1_path, mtz2_path):
+      if path not in miller_arrays:
+        miller_arrays[path] = read_miller_array(path)
+    ma1, ma2 = miller_arrays[mtz1_path], miller_arrays[mtz2_path]
+    pair_d_min = d_min if d_min else max([ma1.d_min(), ma2.d_min()])
+    lookup_key = (ma1.unit_cell().parameters(),
+                  str(ma1.space_group().info()), pair_d_min)
+    if lookup_key not in lookups:
+      lookups[lookup_key] = build_hkl_bin_lookup(ma1, pair_d_min)
+    tables[(mtz1_path, mtz2_path)] = \
+      cross_correlation_table(ma1, ma2, lookups[lookup_key])
+  return tables
+
+
 def run(params_) -> None:
+  if params_.all_pairs:
+    assert len(params_.mtz) >= 2, 'At least two mtz file paths must be provided'
+    tables = calculate_cross_correlations(list(combinations(params_.mtz, 2)),
+                                          d_min=params_.d_min)
+    for (mtz_path1, mtz_path2), cct in tables.items():
+      print(f'{mtz_path1} vs {mtz_path2}')
+      print(str(cct))
+    return
   assert len(params_.mtz) == 2, 'Exactly two mtz file paths must be provided'
   mtz_path1, mtz_path2 = params_.mtz[0:2]
   cct = calculate_cross_correlation(mtz_path1, mtz_path2,
@@ -300,11 +300,67 @@ def xy_to_polar(refl, detector: Detector, dials: bool = False) -> Tuple[float, f
   return rad_component / pxsize, tang_component / pxsize
 
 
+def pixel_to_lab(xy_px: np.ndarray, panel) -> np.ndarray:
+  """Lab coordinates of (n, 2) pixel positions on `panel`, as (n, 3) array"""
+  strategy = type(panel.get_px_mm_strategy()).__name__
+  if strategy == 'SimplePxMmStrategy':
+    x = xy_px[:, 0] * panel.get_pixel_size()[0]
+    y = xy_px[:, 1] * panel.get_pixel_size()[1]
+  else:  # e.g. parallax correction, leave the conversion to dxtbx
+    xy_mm = np.array([panel.pixel_to_millimeter(tuple(xy)) for xy in xy_px])
+    x, y = xy_mm[:, 0], xy_mm[:, 1]
+  d = np.array(panel.get_d_matrix()).reshape(3, 3)  # columns fast, slow, origin
+  return np.stack([d[i, 0] * x + d[i, 1] * y + d[i, 2] for i in range(3)], axis=1)
+
+
+def rowwise_dot(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+  """`np.dot` of every row pair of two (n, k) arrays; stacked matmul reduces
+  like the scalar `np.dot`, so results match `xy_to_polar` bit for bit"""
+  return (a[:, None, :] @ b[:, :, None])[:, 0, 0]
+
+
+def xy_to_polar_array(xy_obs: np.ndarray, xy_cal: np.ndarray, panels: np.ndarray,
+                      detector: Detector) -> Tuple[np.ndarray, np.ndarray]:
+  """Vectorized `xy_to_polar` for (n, 2) pixel positions, grouped by panel"""
+  rad_components = np.empty(len(panels))
+  tang_components = np.empty(len(panels))
+  for pid in np.unique(panels):
+    sel = panels == pid
+    panel = detector[int(pid)]
+    xyz_lab = pixel_to_lab(xy_obs[sel], panel)
+    xyz_cal_lab = pixel_to_lab(xy_cal[sel], panel)
+    diff = xyz_lab[:, :2] - xyz_cal_lab[:, :2]
+    xy_lab = np.ascontiguousarray(xyz_lab[:, :2])
+    rad = xy_lab / np.sqrt(rowwise_dot(xy_lab, xy_lab))[:, None]
+    tang = np.stack([-rad[:, 1], rad[:, 0]], axis=1)
+    pxsize = panel.get_pixel_size()[0]
+    rad_components[sel] = np.abs(rowwise_dot(diff, rad)) / pxsize
+    tang_components[sel] = np.abs(rowwise_dot(diff, tang)) / pxsize
+  return rad_components, tang_components
+
+
 def offsets_from_path(refl_path: str, detector: Detector) -> pd.DataFrame:
   refl = flex.reflection_table.from_file(refl_path)
   return offsets_from_refl(refl, detector)
 
 def offsets_from_refl(refl: flex.reflection_table, detector) -> pd.DataFrame:
+  if len(refl) == 0:
+    return None
+  r = {}
+  xy_obs = refl['xyzobs.px.value'].as_numpy_array()[:, :2]
+  xy_cal1 = refl['xyzcal.px'].as_numpy_array()[:, :2]
+  xy_cal2 = refl['dials.xyzcal.px'].as_numpy_array()[:, :2]
+  r['dB_offset'] = np.sqrt(np.sum((xy_obs - xy_cal1) ** 2, axis=1))
+  r['DIALS_offset'] = np.sqrt(np.sum((xy_obs - xy_cal2) ** 2, axis=1))
+  r['resolution'] = list(1. / np.linalg.norm(refl['rlp'], axis=1))
+  panels = refl['panel'].as_numpy_array()
+  r['dB_rad'], r['dB_tang'] = xy_to_polar_array(xy_obs, xy_cal1, panels, detector)
+  r['DIALS_rad'], r['DIALS_tang'] = xy_to_polar_array(xy_obs, xy_cal2, panels, detector)
+  return pd.DataFrame.from_records(r)
+
+
+def offsets_from_refl_scalar(refl: flex.reflection_table, detector) -> pd.DataFrame:
+  """Reference implementation of `offsets_from_refl`, one reflection at a time"""
   if len(refl) == 0:
     return None
   r = {}
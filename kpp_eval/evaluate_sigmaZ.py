@@ -5,7 +5,6 @@ and plot it/them as a function of iteration step number.
 
 from collections import defaultdict
 import pathlib
-import re
 import string
 
 import matplotlib.pyplot as plt
@@ -13,6 +12,7 @@ import numpy as np
 import pandas as pd
 
 from exafel_project.kpp_eval.phil import parse_phil
+from exafel_project.kpp_utils.log_index import index_logs
 
 
 phil_scope_str = """
@@ -33,19 +33,17 @@ kpp_report = False
   .type = bool
   .help = If true, split entries based on label into several subplots,
   .help = increase font size.
+nproc = 1
+  .type = int
+  .help = Number of processes used to scan the err files
 """
 
-SIGMA_Z_REGEX = re.compile(r'^.+sigmaZ: mean=(.+), median=(.+)$', flags=re.M)
-
-
 def run(parameters) -> None:
   sigma_z_means = defaultdict(list)
   for err_path in parameters.err:
     job_id = pathlib.Path(err_path).stem
-    with open(err_path, 'r') as err_file:
-      for line in err_file:
-        if m := SIGMA_Z_REGEX.match(line):
-          sigma_z_means[job_id].append(m.group(1))
+    events = index_logs([err_path], nproc=parameters.nproc)
+    sigma_z_means[job_id] = list(events['value'][events['event'] == 'sigmaz_mean'])
   keys = l.split(',') if (l := parameters.labels) else sigma_z_means.keys()
   sigma_z_means_df = pd.DataFrame(sigma_z_means.values(), dtype=float, index=keys).T
   print(sigma_z_means_df)
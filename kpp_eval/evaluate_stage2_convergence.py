@@ -4,7 +4,9 @@ the evolution of Pearson's R or CC of F or anom as a function of stage2 step.
 """
 from enum import Enum
 import glob
+from multiprocessing import Pool
 import os
+import pickle
 import re
 from typing import Callable, List, Sequence, Tuple
 
@@ -18,7 +20,6 @@ from cctbx import miller, crystal
 import iotbx.mtz
 import iotbx.pdb
 from libtbx import Auto
-from libtbx.utils import Sorry
 from simtbx.diffBragg.utils import get_complex_fcalc_from_pdb
 from iotbx.reflection_file_reader import any_reflection_file
 
@@ -81,6 +82,15 @@ save_mtz = none *missing all
 legend = *corner none top
   .type = choice
   .help = Where, and if, the legend should be placed on the final plot.
+nproc = 1
+  .type = int
+  .help = Number of processes evaluating stage 2 iterations in parallel.
+  .help = Ignored if `is_ens_hopper = True`.
+cache = None
+  .type = str
+  .help = If given, read and update per-iteration results in this pickle,
+  .help = so that re-running (f.e. with a different stride) only evaluates
+  .help = new iterations. Ignored if `is_ens_hopper = True`.
 """
 
 
@@ -120,15 +130,24 @@ def expand_integer_ranges(ranges_str: str) -> List[int]:
   return indices
 
 
+def miller_set_from(f_asu_map: dict,
+                    symmetry: 'crystal.symmetry',
+                    size: int) -> miller.set:
+  """Miller set of the first `size` diffBragg fcell indices in `f_asu_map`"""
+  miller_idx = flex.miller_index([f_asu_map[i] for i in range(size)])
+  return miller.set(symmetry, miller_idx, True)
+
+
 def read_npz(npz_path: str,
              f_asu_map: dict,
              symmetry: 'crystal.symmetry',
              save_mtz: str,  # see help string for phil parameter `save_mtz`
+             miller_set: miller.set = None,  # if known, skip f_asu_map lookup
              ) -> miller.array:
   """Read Miller array from .npz and f_asu_map, optionally save it as mtz"""
   f_values = np.load(npz_path)['fvals']
-  miller_idx = flex.miller_index([f_asu_map[i] for i in range(len(f_values))])
-  miller_set = miller.set(symmetry, miller_idx, True)
+  if miller_set is None or miller_set.size() != len(f_values):
+    miller_set = miller_set_from(f_asu_map, symmetry, len(f_values))
   miller_data = flex.double(f_values)
   ma = miller.array(miller_set, miller_data)
   ma = ma.set_observation_type_xray_amplitude()
@@ -235,6 +254,107 @@ def evaluate_iteration(
   return pd.Series(data=stats_binned, index=bin_ranges)
 
 
+class IterationEvaluator:
+  """
+  Evaluate `stat` of diffBragg stage 2 npz files like `evaluate_iteration`,
+  with the selection and binning precomputed once. A template Miller array
+  holding fcell positions as data is passed through the same common-set and
+  binning steps, so its binned data give, for every bin, the positions of
+  the compared npz values (or of their Bijvoet mates for anomalous stats).
+  Evaluating an iteration is then a gather from the `fvals` array.
+  """
+  def __init__(self, miller_set: miller.set, ma_gt: miller.array,
+               ma_cm: miller.array, stat: Stat) -> None:
+    self.size = miller_set.size()
+    self.stat = stat
+    positions = miller.array(miller_set, flex.double(range(self.size)))
+    positions = positions.set_observation_type_xray_amplitude()
+    self.plus = self.minus = None
+    if stat.input is StatInput.ANOM:  # see miller.array.anomalous_differences
+      asu, matches = positions.match_bijvoet_mates()
+      asu_positions = asu.data().as_numpy_array().astype(np.int64)
+      self.plus = asu_positions[matches.pairs_hemisphere_selection('+').as_numpy_array()]
+      self.minus = asu_positions[matches.pairs_hemisphere_selection('-').as_numpy_array()]
+      positions = miller.array(
+        miller.set(asu, matches.miller_indices_in_hemisphere('+'), anomalous_flag=False),
+        flex.double(range(len(self.plus))))
+      positions = positions.set_observation_type_xray_amplitude()
+    binner = ma_gt.binner()
+    positions = positions.common_set(ma_cm)
+    positions, ma_gt = positions.common_sets(ma_gt)
+    positions.use_binning(binner)
+    ma_gt.use_binner_of(positions)
+    binner = ma_gt.binner()
+    self.bins = []  # bin d range, value positions, Miller arrays of the bin
+    for i_bin in binner.range_used():
+      bin_selection = binner.selection(i_bin)
+      db_selection = positions.select(bin_selection)
+      gt_selection = ma_gt.select(bin_selection)
+      db_positions = db_selection.data().as_numpy_array().astype(np.int64)
+      self.bins.append((binner.bin_d_range(i_bin), db_positions, db_selection, gt_selection))
+
+  def values_from(self, f_values: np.ndarray) -> np.ndarray:
+    if len(f_values) != self.size:
+      raise ValueError(f'Expected {self.size} fcell values, got {len(f_values)}')
+    return f_values if self.plus is None else f_values[self.plus] - f_values[self.minus]
+
+  def evaluate(self, f_values: np.ndarray, scatter_label: str = None) -> pd.Series:
+    values = self.values_from(f_values)
+    stats_binned = []
+    bin_ranges = []
+    db_data_binned = []
+    gt_data_binned = []
+    for bin_range, db_positions, db_selection, gt_selection in self.bins:
+      ma_db_selection = db_selection.customized_copy(data=flex.double(values[db_positions]))
+      try:
+        stats_binned.append(self.stat.kind.function(ma_db_selection, gt_selection))
+      except ValueError:
+        stats_binned.append(np.nan)
+      bin_ranges.append(bin_range)
+      if scatter_label is not None:
+        db_data_binned.append(ma_db_selection.data())
+        gt_data_binned.append(gt_selection.data())
+    if scatter_label is not None:
+      plot_scatters(db_data_binned, gt_data_binned, scatter_label)
+    return pd.Series(data=stats_binned, index=bin_ranges)
+
+  def evaluate_npz(self, npz_path: str) -> pd.Series:
+    return self.evaluate(np.load(npz_path)['fvals'])
+
+
+_worker_evaluator: IterationEvaluator = None  # set in pool workers
+
+
+def _init_worker(evaluator: IterationEvaluator) -> None:
+  global _worker_evaluator
+  _worker_evaluator = evaluator
+
+
+def _evaluate_npz_in_worker(npz_path: str) -> pd.Series:
+  return _worker_evaluator.evaluate_npz(npz_path)
+
+
+class IterationCache(dict):
+  """Per-iteration results, keyed by npz file, its mtime, and evaluation setup"""
+  def __init__(self, path: str, parameters) -> None:
+    super().__init__()
+    self.path = path
+    self.setup = (parameters.stat, parameters.d_min, parameters.d_max,
+                  parameters.n_bins, parameters.wavelength,
+                  get_mtz_path(parameters), get_pdb_path(parameters))
+    if path and os.path.isfile(path):
+      with open(path, 'rb') as cache_file:
+        self.update(pickle.load(cache_file))
+
+  def key(self, npz_path: str) -> tuple:
+    return (os.path.abspath(npz_path), os.path.getmtime(npz_path)) + self.setup
+
+  def save(self) -> None:
+    if self.path:
+      with open(self.path, 'wb') as cache_file:
+        pickle.dump(dict(self), cache_file)
+
+
 def plot_scatters(db_data_binned: List[Sequence[float]],  # plot along x axis
                   gt_data_binned: List[Sequence[float]],  # plot along y axis
                   label: str) -> None:        # label used in saved file name
@@ -251,6 +371,53 @@ def plot_scatters(db_data_binned: List[Sequence[float]],  # plot along x axis
   fig.savefig(f'scatter_{label}.png')
 
 
+def evaluate_npz_files(npz_files: List[str],
+                       iterations: List[int],
+                       f_asu_map: dict,
+                       symmetry: 'crystal.symmetry',
+                       ma_gt: miller.array,
+                       ma_cm: miller.array,
+                       stat: Stat,
+                       scatter_idx: List[int],
+                       parameters) -> List[pd.Series]:
+  """Evaluate `npz_files` not found in cache using a pool of processes"""
+  if not npz_files:
+    return []
+  size = len(np.load(npz_files[0])['fvals'])
+  miller_set = miller_set_from(f_asu_map, symmetry, size)
+  evaluator = IterationEvaluator(miller_set, ma_gt, ma_cm, stat)
+  cache = IterationCache(parameters.cache, parameters)
+  results = {}
+  to_evaluate = []
+  for num_iter, npz_file in zip(iterations, npz_files):
+    mtz_path = os.path.splitext(npz_file)[0] + '.mtz'
+    if parameters.save_mtz == 'all' or \
+        (parameters.save_mtz == 'missing' and not os.path.isfile(mtz_path)):
+      read_npz(npz_file, f_asu_map, symmetry, parameters.save_mtz, miller_set)
+    if num_iter in scatter_idx:
+      print(npz_file)
+      scatter_id = f'diffBragg{num_iter}'
+      results[num_iter] = evaluator.evaluate(np.load(npz_file)['fvals'], scatter_id)
+    elif (key := cache.key(npz_file)) in cache:
+      results[num_iter] = cache[key]
+    else:
+      to_evaluate.append((num_iter, npz_file))
+  print(f'Evaluating {len(to_evaluate)} iterations, {len(cache)} cached')
+  paths = [npz_file for _, npz_file in to_evaluate]
+  if parameters.nproc > 1 and len(paths) > 1:
+    with Pool(parameters.nproc, initializer=_init_worker, initargs=(evaluator,)) as pool:
+      evaluated = pool.map(_evaluate_npz_in_worker, paths)
+  else:
+    evaluated = [evaluator.evaluate_npz(path) for path in paths]
+  for (num_iter, npz_file), stat_binned in zip(to_evaluate, evaluated):
+    results[num_iter] = cache[cache.key(npz_file)] = stat_binned
+  if to_evaluate:
+    cache.save()
+  for num_iter in iterations:
+    print(f'{stat.value} step {num_iter}: {list(results[num_iter])}')
+  return [results[num_iter] for num_iter in iterations]
+
+
 def run(parameters) -> None:
   # set up paths, convenience classes, global variables
   bin_colors_pos = [(i + .5) / parameters.n_bins for i in range(parameters.n_bins)]
@@ -304,27 +471,21 @@ def run(parameters) -> None:
         iteration_files[iter] = {'name':filename, 'eval_count':eval_count}
       all_npz_files = [iteration_files[x]['name'] for x in range(len(iteration_files))]
     all_iters = len(all_npz_files)
-  for num_iter in range(0, all_iters, parameters.stride):
-    if parameters.is_ens_hopper:
+  if parameters.is_ens_hopper:
+    for num_iter in range(0, all_iters, parameters.stride):
       mtz_file = all_mtz_files[num_iter]
       print(mtz_file)
       ma = any_reflection_file(mtz_file).as_miller_arrays()[0]
-    else:
-      npz_file = all_npz_files[num_iter]
-      mtz_path = os.path.splitext(npz_file)[0] + '.mtz'
-      try:
-        ma = any_reflection_file(mtz_path).as_miller_arrays()[0]
-        print(mtz_path)
-      except Sorry:
-        print(npz_file)
-        ma = read_npz(npz_file, f_asu_map, symmetry, save_mtz=parameters.save_mtz)
-
-    if stat.input is StatInput.ANOM:
-      ma = ma.anomalous_differences()
-
-    scatter_id = f'diffBragg{num_iter}' if num_iter in scatter_idx else None
-    stat_binned = evaluate_iteration(ma, ma_gt, ma_ref, stat, scatter_id)
-    stats_binned_steps.append(stat_binned)
+      if stat.input is StatInput.ANOM:
+        ma = ma.anomalous_differences()
+      scatter_id = f'diffBragg{num_iter}' if num_iter in scatter_idx else None
+      stat_binned = evaluate_iteration(ma, ma_gt, ma_ref, stat, scatter_id)
+      stats_binned_steps.append(stat_binned)
+  else:
+    stats_binned_steps.extend(evaluate_npz_files(
+      [all_npz_files[i] for i in range(0, all_iters, parameters.stride)],
+      list(range(0, all_iters, parameters.stride)),
+      f_asu_map, symmetry, ma_gt, ma_ref, stat, scatter_idx, parameters))
   stats_dataframe = pd.concat(stats_binned_steps, axis=1)
 
   # Plot stat as a function of iteration
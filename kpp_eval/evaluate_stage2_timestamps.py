@@ -2,6 +2,8 @@ import pickle
 from matplotlib import pyplot as plt
 from datetime import datetime
 
+from exafel_project.kpp_utils.log_index import EVENT_OF_SUBSTRING, index_logs, parse_logger_prefix
+
 def get_timestamps(filename):
     with open(filename+".out", 'r') as F:
         lines = F.readlines()
@@ -23,31 +25,15 @@ def get_timestamps(filename):
         jobend = None
 
     with open(filename+".err", 'r') as F:
-        lines = F.readlines()
-    print(lines[0])
+        first_line = F.readline()
+    print(first_line)
 
     if jobstart:
         t_zero = jobstart
     else:
-        t_zero = lines[0].split(" | ")[1]
-        t_zero = datetime.strptime(t_zero, "%Y-%m-%d %H:%M:%S,%f")
-        t_zero = t_zero.timestamp()
-
-    logger = {}
-    for l in lines:
-        try:
-            rank, time, line = l.split(" | ")
-        except:
-            print(f"Couldn't read '{l}'")
-            continue
-        line = line.rstrip()
-        time = datetime.strptime(time, "%Y-%m-%d %H:%M:%S,%f")
-        time = time.timestamp() - t_zero
-        if line not in logger:
-            logger[line] = []
-        logger[line].append(time)
+        t_zero = parse_logger_prefix(first_line)[2]
 
-    items = {x:len(logger[x]) for x in logger.keys()}
+    events = index_logs([filename+".err"])
 
     interesting = [ 'EVENT: read input pickle',
                     'EVENT: BEGIN prep dataframe',
@@ -62,14 +48,12 @@ def get_timestamps(filename):
                     'EVENT: launch refiner',
                     'DONE WITH FUNC GRAD',
                     '_launcher done running optimization']
-    interesting = [s for s in interesting if s in logger]
 
     times = {}
     for l in interesting:
-        timelist = []
-        for t in logger[l]:
-            timelist.append(t)
-        times[l] = timelist
+        timelist = events['timestamp'][events['event'] == EVENT_OF_SUBSTRING[l]]
+        if len(timelist):
+            times[l] = list(timelist - t_zero)
 
     return times
 
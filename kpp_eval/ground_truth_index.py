@@ -0,0 +1,127 @@
+"""
+Build and query a compact ground-truth index of simulated images: a lookup
+from (image file path, frame index) to the `model/Umatrix_rot` and
+`model/Ncells_abc` rows written by the simulation to `image_rank_*.h5`.
+
+Building the index reads every simulated h5 file once (in parallel with MPI)
+and writes all model rows into a single small HDF5 file. Evaluation scripts
+such as `post-validate/check_stage1/compare_to_gt.py` then open one index
+instead of the source image file of every refined shot. Without an index,
+`GroundTruthIndex` still reads each source file at most once per process.
+
+Example usage:
+  srun -n 32 libtbx.python ground_truth_index.py \
+    images=$SCRATCH/cytochrome/$JOB_ID_SIM index=$SCRATCH/cytochrome/gt_index.h5
+"""
+import glob
+import os
+from typing import Dict, List, Tuple
+
+import h5py
+import numpy as np
+
+from libtbx.mpi4py import MPI
+
+from exafel_project.kpp_eval.phil import parse_phil
+
+
+phil_scope_str = """
+images = None
+  .type = str
+  .help = Directory searched recursively for simulated `image_rank_*.h5` files
+index = gt_index.h5
+  .type = str
+  .help = Path of the ground-truth index file to be written
+"""
+
+COMM = MPI.COMM_WORLD
+IMAGE_GLOB = '**/image_rank_*.h5'
+MODEL_KEYS = ('Umatrix_rot', 'Ncells_abc')
+
+
+def print0(*args: str, **kwargs):
+  if COMM.rank == 0:
+    print(*args, **kwargs)
+
+
+def normalize_path(path: str) -> str:
+  return os.path.abspath(path)
+
+
+def read_model_rows(image_path: str) -> Dict[str, np.ndarray]:
+  """All rows of the ground-truth model datasets in one image file"""
+  with h5py.File(image_path, 'r') as h5:
+    return {key: h5['model'][key][()] for key in MODEL_KEYS}
+
+
+class GroundTruthIndex:
+  """Map (image path, frame) to ground-truth (Umatrix_rot, Ncells_abc).
+  Files missing from a loaded index are read on first use, each one once."""
+  def __init__(self) -> None:
+    self.rows: Dict[str, Dict[str, np.ndarray]] = {}
+    self.files_read = 0
+
+  @classmethod
+  def from_file(cls, index_path: str) -> 'GroundTruthIndex':
+    index = cls()
+    with h5py.File(index_path, 'r') as h5:
+      paths = h5['paths'].asstr()[:]
+      offsets = h5['offsets'][:]
+      models = {key: h5[key][()] for key in MODEL_KEYS}
+    for path, start, stop in zip(paths, offsets[:-1], offsets[1:]):
+      index.rows[path] = {key: models[key][start:stop] for key in MODEL_KEYS}
+    return index
+
+  def add(self, image_path: str, rows: Dict[str, np.ndarray] = None) -> None:
+    path = normalize_path(image_path)
+    if rows is None:
+      rows = read_model_rows(path)
+      self.files_read += 1
+    self.rows[path] = rows
+
+  def lookup(self, image_path: str, frame: int) -> Tuple[np.ndarray, np.ndarray]:
+    path = normalize_path(image_path)
+    if path not in self.rows:
+      self.add(path)
+    rows = self.rows[path]
+    return rows['Umatrix_rot'][frame], rows['Ncells_abc'][frame]
+
+  def write(self, index_path: str) -> None:
+    paths = sorted(self.rows)
+    lengths = [len(self.rows[p]['Umatrix_rot']) for p in paths]
+    with h5py.File(index_path, 'w') as h5:
+      h5.create_dataset('paths', data=np.array(paths, dtype=object), dtype=h5py.string_dtype())
+      h5.create_dataset('offsets', data=np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+      for key in MODEL_KEYS:
+        h5.create_dataset(key, data=np.concatenate([self.rows[p][key] for p in paths]))
+
+
+def build_index(images_path: str, index_path: str) -> None:
+  image_paths: List[str] = sorted(glob.glob(os.path.join(images_path, IMAGE_GLOB), recursive=True)) \
+    if COMM.rank == 0 else None
+  image_paths = COMM.bcast(image_paths, root=0)
+  print0(f'Indexing ground truth of {len(image_paths)} image files')
+  index = GroundTruthIndex()
+  for image_path in image_paths[COMM.rank::COMM.size]:
+    index.add(image_path)
+  all_rows = COMM.gather(index.rows, root=0)
+  if COMM.rank == 0:
+    for rows in all_rows:
+      index.rows.update(rows)
+    index.write(index_path)
+    print0(f'Wrote {sum(len(r["Umatrix_rot"]) for r in index.rows.values())} '
+           f'frames of {len(index.rows)} files to {index_path}')
+
+
+def run(parameters) -> None:
+  images_path = p if (p := parameters.images) else '.'
+  build_index(images_path, parameters.index)
+
+
+params = []
+if __name__ == '__main__':
+  params, options = parse_phil(phil_scope_str)
+  if '-h' in options or '--help' in options:
+    print(__doc__)
+    exit()
+  run(params)
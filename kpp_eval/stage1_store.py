@@ -0,0 +1,338 @@
+"""
+Ingest the per-rank pandas pickles `hopper_results_rank*.pkl` of a stage 1
+(diffBragg hopper) output directory into one column-oriented HDF5 store,
+so that evaluation scripts do not need to unpickle every rank file again.
+
+Every column of the stage 1 tables is kept in its own resizable dataset
+under `/columns`. Tuple columns such as `ncells`, `eta_abc` or `Amats` are
+split into fixed-width numeric columns `ncells0`, `ncells1`,... named the
+same way as in `plot_stage1_hist2d.split_tuple_columns`; readers can ask
+for the whole tuple column by its base name and get the tuples back.
+Table `/sources` records the row range, size and modification time of every
+ingested pickle, which makes ingestion incremental: running it again only
+appends pickles that appeared since. If an ingested pickle has changed or
+disappeared, the store is rebuilt from scratch. Readers call
+`refresh_stage1_store` first, which does this only if the rank pickles on
+disk differ from the ones ingested.
+
+Example usage:
+  libtbx.python stage1_store.py stage1=$SCRATCH/cytochrome/$JOB_ID_HOPPER/stage1 nproc=32
+Reading only the columns needed, e.g. in another script:
+  df = read_stage1_store(store_path, columns=['exp_name', 'exp_idx', 'ncells'])
+"""
+import glob
+import json
+from multiprocessing import Pool
+import os
+from typing import Dict, List, Sequence, Tuple
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from exafel_project.kpp_eval.phil import parse_phil
+
+
+phil_scope_str = """
+stage1 = None
+  .type = str
+  .help = Directory with stage 1 results, searched recursively for
+  .help = `hopper_results_rank*.pkl`. If None, use the work dir.
+store = None
+  .type = str
+  .help = Path of the HDF5 store. If None, `stage1/stage1_store.h5` is used.
+nproc = 1
+  .type = int
+  .help = Number of processes used to unpickle the rank files
+overwrite = False
+  .type = bool
+  .help = If True, rebuild the store instead of appending new rank files only
+flush_rows = 100000
+  .type = int
+  .help = Number of buffered rows written to the store at once
+"""
+
+STORE_NAME = 'stage1_store.h5'
+STORE_VERSION = 1
+PICKLE_GLOB = '**/hopper_results_rank*.pkl'
+
+Columns = Dict[str, np.ndarray]
+
+
+class Partition:
+  """Columns of a single rank pickle, ready to be appended to the store"""
+  def __init__(self, path: str, mtime: float, size: int, columns: Columns,
+               tuple_widths: Dict[str, int], skipped: List[str]) -> None:
+    self.path = path
+    self.mtime = mtime
+    self.size = size
+    self.columns = columns
+    self.tuple_widths = tuple_widths
+    self.skipped = skipped
+
+  def __len__(self) -> int:
+    return len(next(iter(self.columns.values()))) if self.columns else 0
+
+
+def default_store_path(stage1_path: str) -> str:
+  return os.path.join(stage1_path, STORE_NAME)
+
+
+def find_rank_pickles(stage1_path: str) -> List[str]:
+  return sorted(glob.glob(os.path.join(stage1_path, PICKLE_GLOB), recursive=True))
+
+
+def current_sources(stage1_path: str) -> Dict[str, Tuple[float, int]]:
+  """Map of the rank pickles now under `stage1_path` to their (mtime, size)"""
+  current = {}
+  for pickle_path in find_rank_pickles(stage1_path):
+    stat = os.stat(pickle_path)
+    current[os.path.relpath(pickle_path, stage1_path)] = (stat.st_mtime, stat.st_size)
+  return current
+
+
+def columnize(df: pd.DataFrame) -> Tuple[Columns, Dict[str, int], List[str]]:
+  """Convert `df` into numeric or string arrays, splitting tuple columns;
+  return the arrays, widths of split tuple columns, and unsupported columns"""
+  columns: Columns = {}
+  tuple_widths: Dict[str, int] = {}
+  skipped: List[str] = []
+  for key in df.columns:
+    values = df[key]
+    first = values.iloc[0]
+    if isinstance(first, (tuple, list, np.ndarray)):
+      split = np.array(values.tolist(), dtype=float)
+      if split.ndim != 2:
+        raise ValueError(f'Column {key} holds tuples of varying length')
+      tuple_widths[key] = split.shape[1]
+      for i in range(split.shape[1]):
+        columns[key + str(i)] = split[:, i]
+    elif isinstance(first, str):
+      columns[key] = values.to_numpy(dtype=object)
+    elif pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+      columns[key] = values.to_numpy()
+    else:
+      try:
+        columns[key] = values.to_numpy(dtype=float)
+      except (TypeError, ValueError):
+        skipped.append(key)
+  return columns, tuple_widths, skipped
+
+
+def load_partition(args: Tuple[str, str]) -> Partition:
+  pickle_path, stage1_path = args
+  stat = os.stat(pickle_path)
+  df = pd.read_pickle(pickle_path)
+  rel_path = os.path.relpath(pickle_path, stage1_path)
+  if len(df) == 0:
+    return Partition(rel_path, stat.st_mtime, stat.st_size, {}, {}, [])
+  columns, tuple_widths, skipped = columnize(df.reset_index(drop=True))
+  return Partition(rel_path, stat.st_mtime, stat.st_size, columns, tuple_widths, skipped)
+
+
+def _append(dataset: h5py.Dataset, values: np.ndarray) -> None:
+  start = dataset.shape[0]
+  dataset.resize((start + len(values),))
+  dataset[start:] = values
+
+
+def _create(group: h5py.Group, name: str, values: np.ndarray) -> h5py.Dataset:
+  dtype = h5py.string_dtype() if values.dtype == object else values.dtype
+  return group.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=True)
+
+
+class Stage1Store:
+  """Append-only writer of the stage 1 HDF5 store"""
+  SOURCE_FIELDS = {'path': h5py.string_dtype(), 'mtime': float, 'size': np.int64,
+                   'start': np.int64, 'stop': np.int64}
+
+  def __init__(self, store_path: str, overwrite: bool = False) -> None:
+    self.handle = h5py.File(store_path, 'a')
+    if overwrite or self.handle.attrs.get('version') != STORE_VERSION:
+      self.clear()
+
+  def clear(self) -> None:
+    for name in list(self.handle):
+      del self.handle[name]
+    self.handle.attrs['version'] = STORE_VERSION
+    self.handle.attrs['tuple_columns'] = json.dumps({})
+    self.handle.attrs['skipped_columns'] = json.dumps([])
+    self.handle.create_group('columns')
+    sources = self.handle.create_group('sources')
+    for name, dtype in self.SOURCE_FIELDS.items():
+      sources.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=True)
+
+  @property
+  def sources(self) -> Dict[str, Tuple[float, int]]:
+    """Map of ingested pickle paths to their (mtime, size)"""
+    s = self.handle['sources']
+    return {p: (m, n) for p, m, n in zip(s['path'].asstr()[:], s['mtime'][:], s['size'][:])}
+
+  def __len__(self) -> int:
+    stops = self.handle['sources']['stop']
+    return int(stops[-1]) if stops.shape[0] else 0
+
+  def write(self, partitions: Sequence[Partition]) -> None:
+    """Append the rows of `partitions` with one resize per dataset"""
+    columns = self.handle['columns']
+    filled = [p for p in partitions if len(p)]
+    if filled:
+      names = set(filled[0].columns)
+      if (len(columns) and set(columns) != names) or \
+          any(set(p.columns) != names for p in filled):
+        raise ValueError('Stage 1 column set changed, rebuild with overwrite=True')
+      for name in names:
+        values = np.concatenate([p.columns[name] for p in filled])
+        dataset = columns[name] if name in columns else _create(columns, name, values)
+        _append(dataset, values)
+      tuple_widths = json.loads(self.handle.attrs['tuple_columns'])
+      skipped = set(json.loads(self.handle.attrs['skipped_columns']))
+      for p in filled:
+        tuple_widths.update(p.tuple_widths)
+        skipped.update(p.skipped)
+      self.handle.attrs['tuple_columns'] = json.dumps(tuple_widths)
+      self.handle.attrs['skipped_columns'] = json.dumps(sorted(skipped))
+    stops = np.cumsum([len(p) for p in partitions]) + len(self)
+    starts = stops - np.array([len(p) for p in partitions], dtype=np.int64)
+    sources = self.handle['sources']
+    _append(sources['path'], np.array([p.path for p in partitions], dtype=object))
+    _append(sources['mtime'], np.array([p.mtime for p in partitions]))
+    _append(sources['size'], np.array([p.size for p in partitions], dtype=np.int64))
+    _append(sources['start'], starts)
+    _append(sources['stop'], stops)
+    self.handle.flush()
+
+  def close(self) -> None:
+    self.handle.close()
+
+
+def ingest(stage1_path: str, store_path: str = None, nproc: int = 1,
+           overwrite: bool = False, flush_rows: int = 100000) -> int:
+  """Add the rank pickles of `stage1_path` missing from the store to it;
+  return the number of newly ingested pickles"""
+  store_path = store_path if store_path else default_store_path(stage1_path)
+  pickle_paths = find_rank_pickles(stage1_path)
+  current = current_sources(stage1_path)
+  store = Stage1Store(store_path, overwrite=overwrite)
+  known = store.sources
+  if any(current.get(path) != stamp for path, stamp in known.items()):
+    print('Ingested pickles changed or disappeared, rebuilding the store')
+    store.clear()
+    known = {}
+  new_paths = [p for p in pickle_paths if os.path.relpath(p, stage1_path) not in known]
+  print(f'{len(known)} pickles in store, ingesting {len(new_paths)} new ones')
+  tasks = [(p, stage1_path) for p in new_paths]
+  pool = Pool(nproc) if nproc > 1 else None
+  partitions = pool.imap(load_partition, tasks, chunksize=16) if pool \
+    else map(load_partition, tasks)
+  buffer, buffered_rows = [], 0
+  try:
+    for i, partition in enumerate(partitions):
+      buffer.append(partition)
+      buffered_rows += len(partition)
+      if buffered_rows >= flush_rows:
+        store.write(buffer)
+        buffer, buffered_rows = [], 0
+        print(f'Ingested {i + 1} / {len(new_paths)} pickles', end='\r', flush=True)
+    if buffer:
+      store.write(buffer)
+  finally:
+    if pool:
+      pool.close()
+    print(f'Store {store_path} holds {len(store)} rows')
+    store.close()
+  return len(new_paths)
+
+
+def stale_rank_pickles(stage1_path: str, store_path: str = None) -> List[str]:
+  """Rank pickles under `stage1_path` added, changed or removed since they
+  were ingested into the store; all of them if the store has another version"""
+  store_path = store_path if store_path else default_store_path(stage1_path)
+  current = current_sources(stage1_path)
+  with h5py.File(store_path, 'r') as f:
+    if f.attrs.get('version') != STORE_VERSION:
+      return sorted(current)
+    s = f['sources']
+    known = {p: (m, n) for p, m, n in zip(s['path'].asstr()[:], s['mtime'][:], s['size'][:])}
+  return sorted(p for p in set(current) | set(known) if current.get(p) != known.get(p))
+
+
+def refresh_stage1_store(stage1_path: str, store_path: str = None,
+                         nproc: int = 1, update: bool = False) -> bool:
+  """Check the store is up to date with the rank pickles under `stage1_path`
+  before it is read, re-ingesting them first if `update`; return False if it
+  is stale and should not be used"""
+  store_path = store_path if store_path else default_store_path(stage1_path)
+  if not (stale := stale_rank_pickles(stage1_path, store_path)):
+    return True
+  if not find_rank_pickles(stage1_path):
+    print(f'WARNING: no rank pickles under {stage1_path}, '
+          f'reading {store_path} as it was last ingested')
+    return True
+  if not update:
+    print(f'WARNING: {len(stale)} rank pickles were added, changed or removed '
+          f'since {store_path} was written, e.g. {stale[0]}; reading the rank '
+          f'pickles instead, update the store to use it again')
+    return False
+  print(f'WARNING: {len(stale)} rank pickles were added, changed or removed '
+        f'since {store_path} was written, e.g. {stale[0]}; updating the store')
+  try:
+    ingest(stage1_path, store_path=store_path, nproc=nproc)
+  except (OSError, ValueError) as e:
+    print(f'WARNING: could not update {store_path} ({e}); '
+          f'it is stale and will not be used')
+    return False
+  return True
+
+
+def stage1_store_length(store_path: str) -> int:
+  with h5py.File(store_path, 'r') as f:
+    stops = f['sources']['stop']
+    return int(stops[-1]) if stops.shape[0] else 0
+
+
+def stage1_store_columns(store_path: str) -> List[str]:
+  """Names of readable columns, tuple columns listed under their base name"""
+  with h5py.File(store_path, 'r') as f:
+    tuple_widths = json.loads(f.attrs['tuple_columns'])
+    split = {k + str(i) for k, w in tuple_widths.items() for i in range(w)}
+    return list(tuple_widths) + [k for k in f['columns'] if k not in split]
+
+
+def read_stage1_store(store_path: str, columns: Sequence[str] = None,
+                      rows: slice = slice(None), join_tuples: bool = True
+                      ) -> pd.DataFrame:
+  """Read `columns` (default all) for `rows` of the store into a DataFrame.
+  Tuple columns can be requested by base name (`ncells`) or by element
+  (`ncells0`); if `join_tuples`, base names are returned as tuples."""
+  columns = columns if columns is not None else stage1_store_columns(store_path)
+  data = {}
+  with h5py.File(store_path, 'r') as f:
+    tuple_widths = json.loads(f.attrs['tuple_columns'])
+    for name in columns:
+      if name in tuple_widths:
+        split = [f['columns'][name + str(i)][rows] for i in range(tuple_widths[name])]
+        if join_tuples:
+          data[name] = list(zip(*[s.tolist() for s in split]))
+        else:
+          data.update({name + str(i): s for i, s in enumerate(split)})
+      else:
+        dataset = f['columns'][name]
+        is_str = h5py.check_string_dtype(dataset.dtype) is not None
+        data[name] = dataset.asstr()[rows] if is_str else dataset[rows]
+  return pd.DataFrame(data)
+
+
+def run(parameters) -> None:
+  stage1_path = p if (p := parameters.stage1) else '.'
+  ingest(stage1_path, store_path=parameters.store, nproc=parameters.nproc,
+         overwrite=parameters.overwrite, flush_rows=parameters.flush_rows)
+
+
+params = []
+if __name__ == '__main__':
+  params, options = parse_phil(phil_scope_str)
+  if '-h' in options or '--help' in options:
+    print(__doc__)
+    exit()
+  run(params)
@@ -0,0 +1,150 @@
+"""
+Mergeable summary statistics for MPI evaluation scripts. Instead of gathering
+every rank's raw values on rank 0, each rank summarizes its own values and
+the summaries are combined pairwise along a binomial tree, so that the memory
+needed on rank 0 does not grow with the number of shots:
+
+- `Moments` keeps the count, mean and sum of squared deviations (Welford,
+  merged with the parallel formula of Chan et al.), minimum and maximum;
+- `Histogram` keeps fixed-bin counts over a range agreed on by all ranks,
+  typically the global minimum and maximum of a first `Moments` reduction,
+  and approximates quantiles to within one bin width. A single outlier can
+  stretch that range, so a quantile can be refined with a second pass that
+  bins the values again within the bin holding it (`refined_edges`), which
+  narrows the error by another factor of the number of bins.
+
+Both accept 1D arrays of values or 2D arrays with one column per quantity.
+"""
+from typing import Any, Callable, Dict, Sequence
+
+import numpy as np
+
+TREE_REDUCE_TAG = 7702
+
+
+def _as_2d(values: Sequence) -> np.ndarray:
+  a = np.asarray(values, dtype=float)
+  return a.reshape(-1, 1) if a.ndim == 1 else a
+
+
+class Moments:
+  """Count, mean, variance, minimum and maximum of one or more columns"""
+  def __init__(self, n: int, mean: np.ndarray, m2: np.ndarray,
+               minimum: np.ndarray, maximum: np.ndarray) -> None:
+    self.n = n
+    self.mean = mean
+    self.m2 = m2
+    self.min = minimum
+    self.max = maximum
+
+  @classmethod
+  def from_values(cls, values: Sequence, width: int = 1) -> 'Moments':
+    a = _as_2d(values) if len(values) else np.empty((0, width))
+    if len(a) == 0:
+      return cls(0, np.zeros(a.shape[1]), np.zeros(a.shape[1]),
+                 np.full(a.shape[1], np.inf), np.full(a.shape[1], -np.inf))
+    mean = a.mean(axis=0)
+    return cls(len(a), mean, ((a - mean) ** 2).sum(axis=0), a.min(axis=0), a.max(axis=0))
+
+  def merge(self, other: 'Moments') -> 'Moments':
+    n = self.n + other.n
+    if self.n == 0 or other.n == 0:
+      return self if other.n == 0 else other
+    delta = other.mean - self.mean
+    mean = self.mean + delta * other.n / n
+    m2 = self.m2 + other.m2 + delta ** 2 * self.n * other.n / n
+    return Moments(n, mean, m2, np.minimum(self.min, other.min), np.maximum(self.max, other.max))
+
+  @property
+  def std(self) -> np.ndarray:
+    """Population standard deviation, as `np.std`"""
+    return np.sqrt(self.m2 / self.n)
+
+  @property
+  def mean_square(self) -> np.ndarray:
+    return self.m2 / self.n + self.mean ** 2
+
+
+class Histogram:
+  """Fixed-bin counts of one or more columns, each over its own range,
+  and the counts of values below and above that range"""
+  def __init__(self, edges: np.ndarray, counts: np.ndarray,
+               below: np.ndarray = None, above: np.ndarray = None) -> None:
+    self.edges = edges    # shape (n_columns, n_bins + 1)
+    self.counts = counts  # shape (n_columns, n_bins)
+    self.below = below if below is not None else np.zeros(len(counts), dtype=int)
+    self.above = above if above is not None else np.zeros(len(counts), dtype=int)
+
+  @classmethod
+  def from_values(cls, values: Sequence, edges: np.ndarray) -> 'Histogram':
+    edges = np.atleast_2d(edges)
+    a = _as_2d(values) if len(values) else np.empty((0, len(edges)))
+    counts = np.array([np.histogram(a[:, i], bins=edges[i])[0] for i in range(len(edges))])
+    below = np.array([np.count_nonzero(a[:, i] < edges[i][0]) for i in range(len(edges))])
+    above = np.array([np.count_nonzero(a[:, i] > edges[i][-1]) for i in range(len(edges))])
+    return cls(edges, counts, below, above)
+
+  @classmethod
+  def from_moments(cls, values: Sequence, moments: Moments, n_bins: int) -> 'Histogram':
+    """Histogram with `n_bins` bins between global `moments.min` and `.max`"""
+    lo = moments.min
+    hi = np.where(moments.max > lo, moments.max, lo + 1e-10)
+    edges = np.linspace(lo, hi, num=n_bins + 1, axis=1)
+    return cls.from_values(values, edges)
+
+  def merge(self, other: 'Histogram') -> 'Histogram':
+    return Histogram(self.edges, self.counts + other.counts,
+                     self.below + other.below, self.above + other.above)
+
+  def _quantile_bin(self, i: int, q: float):
+    """Bin of column `i` holding the `q`-quantile and its position in it"""
+    counts = self.counts[i]
+    cumulative = np.cumsum(counts)
+    total = self.below[i] + cumulative[-1] + self.above[i]
+    target = min(max(q * total - self.below[i], 0.), cumulative[-1])
+    b = min(int(np.searchsorted(cumulative, target)), len(counts) - 1)
+    below = cumulative[b] - counts[b]
+    fraction = (target - below) / counts[b] if counts[b] else 0.
+    return b, fraction
+
+  def quantile(self, q: float) -> np.ndarray:
+    """Per-column `q`-quantile, interpolated linearly within its bin"""
+    result = np.empty(len(self.counts))
+    for i, edges in enumerate(self.edges):
+      b, fraction = self._quantile_bin(i, q)
+      result[i] = edges[b] + fraction * (edges[b + 1] - edges[b])
+    return result
+
+  def refined_edges(self, q: float) -> np.ndarray:
+    """Edges of as many bins again within the bin of each column holding the
+    `q`-quantile. The `Histogram.from_values` of these edges, merged over
+    ranks, gives the `q`-quantile to within a bin width divided by n_bins."""
+    refined = []
+    for i, edges in enumerate(self.edges):
+      b, _ = self._quantile_bin(i, q)
+      refined.append(np.linspace(edges[b], edges[b + 1], num=len(edges)))
+    return np.array(refined)
+
+  def median(self) -> np.ndarray:
+    return self.quantile(0.5)
+
+
+def merge_dicts(a: Dict[str, Any], b: Dict[str, Any]) -> Dict[str, Any]:
+  """Merge two dicts of summaries with matching keys"""
+  return {key: a[key].merge(b[key]) for key in a}
+
+
+def tree_reduce(comm, summary: Any, merge: Callable[[Any, Any], Any] = merge_dicts,
+                root: int = 0) -> Any:
+  """Combine the `summary` of every rank with `merge` along a binomial tree
+  of point-to-point messages; return the result on `root`, None elsewhere"""
+  rank = (comm.rank - root) % comm.size
+  step = 1
+  while step < comm.size:
+    if rank % (2 * step):
+      comm.send(summary, dest=(rank - step + root) % comm.size, tag=TREE_REDUCE_TAG)
+      return None
+    if rank + step < comm.size:
+      summary = merge(summary, comm.recv(source=(rank + step + root) % comm.size, tag=TREE_REDUCE_TAG))
+    step *= 2
+  return summary
@@ -1,6 +1,6 @@
 from __future__ import division, print_function
 from datetime import datetime
-from time import time
+from time import time, sleep
 import os
 import sys
 import math
@@ -8,20 +8,23 @@ start_elapse = time()
 
 from scitbx.matrix import sqr
 import libtbx.load_env # possibly implicit
-from omptbx import omp_get_num_procs
 
-from scipy import constants
-ENERGY_CONV = 1e10*constants.c*constants.h / constants.electron_volt
+# same value as 1e10*scipy.constants.c*constants.h/constants.electron_volt, exact SI constants, no scipy import
+ENERGY_CONV = 1e10*299792458.0*6.62607015e-34 / 1.602176634e-19
 
-# %%% boilerplate specialize to packaged big data %%%
+# Heavy modules are imported where they are needed, so that each rank only pays for its own code path:
+# LS49 spectra and crystal generation on rank 0, amplitude modules by crystal.structure,
+# nexus_factory and multipanel only for h5 output.  The python -X importtime harness in
+# profile_imports.py guards against eager imports creeping back in.
 
-from LS49.sim import step4_pad
-from LS49.spectra import generate_spectra
-from LS49 import ls49_big_data, legacy_random_orientations
-step4_pad.big_data = ls49_big_data
-generate_spectra.big_data = ls49_big_data
-from simtbx import get_exascale
-# %%%%%%
+def specialize_big_data():
+  # %%% boilerplate specialize to packaged big data %%%
+  from LS49.sim import step4_pad
+  from LS49.spectra import generate_spectra
+  from LS49 import ls49_big_data
+  step4_pad.big_data = ls49_big_data
+  generate_spectra.big_data = ls49_big_data
+  # %%%%%%
 
 # Develop procedure for MPI control
 
@@ -31,14 +34,54 @@ from simtbx import get_exascale
 # evaluate air + water as a singleton
 
 from exafel_project.kpp_utils.phil import parse_input
-from exafel_project.kpp_utils.ferredoxin import basic_detector_rayonix
-from exafel_project.kpp_utils.amplitudes_spread_ferredoxin import amplitudes_spread_ferredoxin
-from exafel_project.kpp_utils.amplitudes_spread_psii import amplitudes_spread_psii, amplitudes_pdb
-from exafel_project.kpp_utils.mp_utils import bcast_large_dict
 
 
-def tst_one(image,spectra,crystal,random_orientation,sfall_channels,gpu_channels_singleton,rank,params,**kwargs):
-  iterator = spectra.generate_recast_renormalized_image_parameterized(image=image%100000,params=params)
+def sfall_channels_function(structure):
+  if structure == 'ferredoxin':
+    from exafel_project.kpp_utils.amplitudes_spread_ferredoxin import amplitudes_spread_ferredoxin
+    return amplitudes_spread_ferredoxin
+  from exafel_project.kpp_utils import amplitudes_spread_psii
+  return dict(PSII=amplitudes_spread_psii.amplitudes_spread_psii, pdb=amplitudes_spread_psii.amplitudes_pdb)[structure]
+
+
+def import_rank_modules(params, rank):
+  """Import the heavy modules used by this rank's code path up front, so that the
+  "seconds elapsed after Python imports" clock started after this call excludes
+  import time, as it did when they were imported at module level"""
+  from LS49.sim import step4_pad
+  from LS49.spectra import generate_spectra
+  if rank == 0:
+    from LS49 import legacy_random_orientations
+  sfall_channels_function(params.crystal.structure)
+  if params.output.format == "h5":
+    from simtbx.nanoBragg import nexus_factory
+    if params.output.h5.async_writer.enable:
+      from exafel_project.kpp_utils import h5_writer
+  if params.detector.tiles == "single":
+    from exafel_project.kpp_utils import ferredoxin
+  else:
+    from exafel_project.kpp_utils import multipanel
+  from simtbx import get_exascale
+  from exafel_project.kpp_utils import spectra_parcel
+
+
+def multipanel_kwargs(params, specific=None):
+  # in this instance determine resolution limits from detector and beam
+  from exafel_project.kpp_utils.multipanel import specific_expt
+  if specific is None:
+    specific = specific_expt(params)
+  consistent_beam_dict = specific.beam.to_dict()
+  consistent_beam_dict["wavelength"] = ENERGY_CONV/params.beam.mean_energy
+  consistent_beam = type(specific.beam).from_dict(consistent_beam_dict)
+  nominal_resolution = specific.detector.get_max_resolution(s0=consistent_beam.get_s0())
+  direct_algo_res_limit = math.pow(math.pow(nominal_resolution,-3)*1.005,-(1./3.)) # allow 1% bandpass
+  return dict(direct_algo_res_limit=direct_algo_res_limit)
+
+
+def tst_one(image,spectra,crystal,random_orientation,sfall_channels,gpu_channels_singleton,rank,params,
+            iterator=None,**kwargs):
+  if iterator is None:
+    iterator = spectra.generate_recast_renormalized_image_parameterized(image=image%100000,params=params)
   quick = False
   prefix_root = "LY99_batch_%06d" if quick else "LY99_MPIbatch_%06d"
   file_prefix = prefix_root%image
@@ -67,21 +110,27 @@ def run_LY99_batch(test_without_mpi=False):
     MPI = mpiEmulator()
   else:
     from libtbx.mpi4py import MPI
+  from exafel_project.kpp_utils.mp_utils import bcast_large_dict, bcast_large_dict_node_shared, image_parcels
+  from exafel_project.kpp_utils.channel_cache import cached_sfall_channels
 
   comm = MPI.COMM_WORLD
   rank = comm.Get_rank()
   size = comm.Get_size()
   import omptbx
+  from omptbx import omp_get_num_procs
   workaround_nt = int(os.environ.get("OMP_NUM_THREADS",1))
   omptbx.omp_set_num_threads(workaround_nt)
   N_total = int(os.environ["N_SIM"]) # number of items to simulate
-  N_stride = size # total number of worker tasks
+  image_jitter_s = float(os.environ.get("IMAGE_JITTER_S",0)) # artificial per-image delay, for scheduler benchmarks
   print("hello from rank %d of %d"%(rank,size),"with omp_threads=",omp_get_num_procs())
+  import_rank_modules(params, rank)
   start_comp = time()
 
   # now inside the Python imports, begin large data broadcast
   if rank == 0:
     print("Rank 0 time", datetime.now())
+    specialize_big_data()
+    from LS49 import legacy_random_orientations
     from LS49.spectra.generate_spectra import spectra_simulation
     from LS49.sim.step4_pad import microcrystal
     print("hello2 from rank %d of %d"%(rank,size))
@@ -94,6 +143,8 @@ def run_LY99_batch(test_without_mpi=False):
   else:
     transmitted_info = None
   transmitted_info = comm.bcast(transmitted_info, root = 0)
+  # unpickling the spectra and crystal imports their LS49 modules; point those at the big data
+  if rank != 0: specialize_big_data()
   comm.barrier()
 
   kwargs = {}
@@ -101,30 +152,33 @@ def run_LY99_batch(test_without_mpi=False):
     from simtbx.nanoBragg import nexus_factory
     fileout_name="image_rank_%05d.h5"%rank
     kwargs["writer"] = nexus_factory(fileout_name) # break encapsulation, use kwargs to push writer to inner loop
+    if params.output.h5.async_writer.enable:
+      from exafel_project.kpp_utils.h5_writer import async_frame_writer
+      kwargs["writer"] = async_frame_writer(kwargs["writer"],
+        queue_depth=params.output.h5.async_writer.queue_depth,
+        model_block=params.output.h5.async_writer.model_block)
     if params.detector.tiles == "single":
+      from exafel_project.kpp_utils.ferredoxin import basic_detector_rayonix
       DETECTOR = basic_detector_rayonix()
     else:
       from exafel_project.kpp_utils.multipanel import specific_expt, run_sim2h5
       specific = specific_expt(params)
       DETECTOR = specific.detector
-      # in this instance determine resolution limits from detector and beam
-      consistent_beam_dict = specific.beam.to_dict()
-      consistent_beam_dict["wavelength"] = ENERGY_CONV/params.beam.mean_energy
-      consistent_beam = type(specific.beam).from_dict(consistent_beam_dict)
-      nominal_resolution = DETECTOR.get_max_resolution(s0=consistent_beam.get_s0())
-      direct_algo_res_limit = math.pow(math.pow(nominal_resolution,-3)*1.005,-(1./3.)) # allow 1% bandpass
-      kwargs["direct_algo_res_limit"] = direct_algo_res_limit
+      kwargs.update(multipanel_kwargs(params, specific))
     kwargs["writer"].construct_detector(DETECTOR)
 
   # now begin energy channel calculation
-  sfall_channels_d = {'ferredoxin': amplitudes_spread_ferredoxin, 'PSII': amplitudes_spread_psii, 'pdb': amplitudes_pdb}
-  sfall_channels = sfall_channels_d[params.crystal.structure](comm, params, **kwargs)
+  sfall_channels = cached_sfall_channels(
+    comm, params, sfall_channels_function(params.crystal.structure), **kwargs)
   print(rank, time(), "finished with the calculation of channels, now construct single broadcast")
-  sfall_channels = bcast_large_dict(comm, sfall_channels, root=0)
+  if params.mpi.node_shared_sfall:
+    sfall_channels = bcast_large_dict_node_shared(comm, sfall_channels, root=0)
+  else:
+    sfall_channels = bcast_large_dict(comm, sfall_channels, root=0)
   transmitted_info['sfall_info'] = sfall_channels
 
   comm.barrier()
-  parcels = list(range(rank,N_total,N_stride))
+  parcels = image_parcels(comm, N_total, mode=params.scheduler.mode, batch_size=params.scheduler.batch_size)
 
   print(rank, time(), "finished with single broadcast, now set up the rank logger")
 
@@ -137,6 +191,7 @@ def run_LY99_batch(test_without_mpi=False):
     sys.stderr = io.TextIOWrapper(open(error_path,'ab', 0), write_through=True)
 
   print(rank, time(), "finished with the rank logger, now construct the GPU cache container")
+  from simtbx import get_exascale
   gpu_instance = get_exascale("gpu_instance", params.context)
   gpu_energy_channels = get_exascale("gpu_energy_channels", params.context)
 
@@ -145,22 +200,31 @@ def run_LY99_batch(test_without_mpi=False):
     deviceId = gpu_run.get_deviceID())
     # singleton will instantiate, regardless of gpu, device count, or exascale API
 
+  from exafel_project.kpp_utils.spectra_parcel import preprocessed_spectra
+  simulator = None
+  if params.detector.tiles != "single" and params.persistent_simulator:
+    from exafel_project.kpp_utils.multipanel import multipanel_simulator
+    simulator = multipanel_simulator(transmitted_info["crystal"], specific, rank, params, transmitted_info["sfall_info"])
+
   comm.barrier()
 
-  for idx in parcels:
+  # spectra of a chunk of images are generated and thresholded together; with a dynamic scheduler
+  # read no further ahead than one claimed batch
+  spectra_chunk = params.scheduler.batch_size if params.scheduler.mode != "static" else params.spectrum.parcel_size
+  for idx, iterator, skipped in preprocessed_spectra(transmitted_info["spectra"], parcels, params, spectra_chunk):
     cache_time = time()
     print("idx------start-------->",idx,"rank",rank,time())
+    if params.spectrum.min_flux_fraction > 0:
+      print("channels skipped for image",idx,":",skipped,"of",params.spectrum.nchannels)
     # if rank==0: os.system("nvidia-smi")
     if params.detector.tiles == "single":
       tst_one(image=idx,spectra=transmitted_info["spectra"],
         crystal=transmitted_info["crystal"],
         random_orientation=transmitted_info["random_orientations"][idx],
         sfall_channels=transmitted_info["sfall_info"], gpu_channels_singleton=gpu_channels_singleton,
-        rank=rank,params=params,**kwargs
+        rank=rank,params=params,iterator=iterator,**kwargs
       )
     else:
-      iterator = transmitted_info["spectra"].generate_recast_renormalized_image_parameterized(
-        image=idx%100000, params=params)
       run_sim2h5(spectra = iterator,
         reference = specific,
         crystal = transmitted_info["crystal"],
@@ -168,12 +232,23 @@ def run_LY99_batch(test_without_mpi=False):
         rank = rank,
         gpu_channels_singleton=gpu_channels_singleton,
         sfall_channels=transmitted_info["sfall_info"],
-        params=params,**kwargs
+        params=params,simulator=simulator,**kwargs
       )
+    if image_jitter_s:
+      import random
+      sleep(random.Random(idx).expovariate(1./image_jitter_s)) # depends only on the image index
     print("idx------finis-------->",idx,"rank",rank,time(),"elapsed",time()-cache_time)
+  if params.output.format == "h5" and params.output.h5.async_writer.enable:
+    kwargs["writer"].close() # wait for the queued frames
   comm.barrier()
+  if params.scheduler.mode != "static":
+    parcels.free()
+  if simulator is not None:
+    simulator.free_all()
   del gpu_channels_singleton
   # avoid Kokkos allocation "device_Fhkl" being deallocated after Kokkos::finalize was called
+  if params.mpi.node_shared_sfall:
+    transmitted_info["sfall_info"].free()
   print("Overall rank",rank,"at",datetime.now(),"seconds elapsed after srun startup %.3f"%(time()-start_elapse))
   print("Overall rank",rank,"at",datetime.now(),"seconds elapsed after Python imports %.3f"%(time()-start_comp))
   if rank_profile:
@@ -0,0 +1,107 @@
+from __future__ import division, print_function
+from collections import OrderedDict
+from scitbx.array_family import flex
+
+"""
+The amorphous water + air background of a simulated image depends only on the
+detector, the beam flux and, weakly, on the shot-to-shot wavelength. Instead of
+two full-detector add_background passes per image, background_cache computes
+the background image once per (detector, wavelength bucket, flux) on each rank,
+holds it in memory, and the caller adds it to the raw pixels in one vectorized
+accumulate. The bucket width sets the accuracy: the cached image is computed at
+the bucket center, at most half a bucket away from the true shot wavelength.
+Each image is a full detector of doubles, so at most max_entries are kept and
+the least recently used one is dropped first.
+"""
+
+# rough approximation to water: interpolation points for sin(theta/lambda) vs structure factor
+water_bg = flex.vec2_double([(0,2.57),(0.0365,2.58),(0.07,2.8),(0.12,5),(0.162,8),(0.18,7.32),(0.2,6.75),(0.216,6.75),(0.236,6.5),(0.28,4.5),(0.3,4.3),(0.345,4.36),(0.436,3.77),(0.5,3.17)])
+assert [a[0] for a in water_bg] == sorted([a[0] for a in water_bg])
+# rough approximation to air
+air_bg = flex.vec2_double([(0,14.1),(0.045,13.5),(0.174,8.35),(0.35,4.78),(0.5,4.22)])
+assert [a[0] for a in air_bg] == sorted([a[0] for a in air_bg])
+
+
+def add_water_and_air_background(SIM, gpu_simulation, gpu_detector, total_flux):
+  """Accumulate the water and then the air background on the GPU detector"""
+  SIM.Fbg_vs_stol = water_bg
+  SIM.amorphous_sample_thick_mm = 0.1
+  SIM.amorphous_density_gcm3 = 1
+  SIM.amorphous_molecular_weight_Da = 18
+  SIM.flux=total_flux
+  SIM.beamsize_mm=0.003 # square (not user specified)
+  SIM.exposure_s=1.0 # multiplies flux x exposure
+  gpu_simulation.add_background(gpu_detector)
+  SIM.Fbg_vs_stol = air_bg
+  SIM.amorphous_sample_thick_mm = 10 # between beamstop and collimator
+  SIM.amorphous_density_gcm3 = 1.2e-3
+  SIM.amorphous_sample_molecular_weight_Da = 28 # nitrogen = N2
+  gpu_simulation.add_background(gpu_detector)
+
+
+def detector_fingerprint(detector):
+  """Hashable description of the panel geometry of a dxtbx detector"""
+  return tuple((p.get_origin(), p.get_fast_axis(), p.get_slow_axis(),
+                p.get_image_size(), p.get_pixel_size()) for p in detector)
+
+
+class background_cache(object):
+  def __init__(self, wavelength_bucket_A, max_entries=4):
+    assert wavelength_bucket_A > 0
+    assert max_entries > 0
+    self.wavelength_bucket_A = wavelength_bucket_A
+    self.max_entries = max_entries
+    self.images = OrderedDict()
+    self.hits = self.misses = self.evictions = 0
+
+  def hit_rate(self):
+    lookups = self.hits + self.misses
+    return self.hits / lookups if lookups else 0.
+
+  def bucket_center(self, wavelength_A):
+    return round(wavelength_A / self.wavelength_bucket_A) * self.wavelength_bucket_A
+
+  def get(self, detector_key, wavelength_A, flux, compute):
+    """Cached background image, or `compute(bucket_wavelength_A)` on a miss"""
+    center = self.bucket_center(wavelength_A)
+    key = (detector_key, round(wavelength_A / self.wavelength_bucket_A), flux)
+    if key in self.images:
+      self.hits += 1
+      self.images.move_to_end(key)
+    else:
+      self.misses += 1
+      self.images[key] = compute(center)
+      if len(self.images) > self.max_entries:
+        self.images.popitem(last=False)
+        self.evictions += 1
+    lookups = self.hits + self.misses
+    if lookups & (lookups - 1) == 0: # log at 1, 2, 4, 8, ... lookups
+      print("background cache hit rate %.3f after %d images, %d cached, %d evicted"%(
+        self.hit_rate(), lookups, len(self.images), self.evictions))
+    return self.images[key]
+
+  def compute_on_gpu(self, SIM, gpu_simulation, gpu_detector, total_flux, wavelength_A, read_pixels):
+    """Background alone, accumulated on a freshly allocated GPU detector image
+    and read back with `read_pixels()`. Leaves the detector image deallocated."""
+    gpu_detector.each_image_allocate()
+    cache_wavelength_A = SIM.wavelength_A
+    SIM.wavelength_A = wavelength_A
+    add_water_and_air_background(SIM, gpu_simulation, gpu_detector, total_flux)
+    SIM.wavelength_A = cache_wavelength_A
+    pixels = read_pixels()
+    gpu_detector.each_image_free()
+    print("background cache miss %d (hits %d) at wavelength %.6f"%(self.misses, self.hits, wavelength_A))
+    return pixels
+
+
+def get_background_cache(params):
+  """Per-rank singleton, None unless background_cache.enable is set"""
+  global _background_cache_singleton
+  if not params.background_cache.enable:
+    return None
+  if _background_cache_singleton is None:
+    _background_cache_singleton = background_cache(params.background_cache.wavelength_bucket_A,
+                                                   params.background_cache.max_entries)
+  return _background_cache_singleton
+
+_background_cache_singleton = None
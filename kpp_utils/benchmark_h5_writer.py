@@ -0,0 +1,93 @@
+"""
+Throughput of the nexus_factory frame writer as used by run_sim2h5, with one
+save_variable resize per model variable and frame, against async_frame_writer.
+A fixed compute time per frame stands in for the simulation, so that the
+overlap of compute and write shows up in the total time. By default the
+stand-in is a pure Python loop that holds the GIL, as the Python side of the
+simulation does, so the writer thread competes with it. --compute sleep
+releases the GIL for the whole compute time, like a GPU kernel launch that
+is waited on outside Python; the overlap it reports is an upper bound.
+Example usage, on local disk:
+  libtbx.python benchmark_h5_writer.py --nframes 64 --compute_s 0.2 --outdir /tmp
+  libtbx.python benchmark_h5_writer.py --compute sleep
+  libtbx.python benchmark_h5_writer.py --reference t000_rg002_chunk000_reintegrated_000000.expt
+"""
+from __future__ import division, print_function
+from argparse import ArgumentParser
+import os
+from time import time, sleep
+
+import numpy as np
+from scitbx.array_family import flex
+from dxtbx.model import BeamFactory, Spectrum
+from simtbx.nanoBragg import nexus_factory
+
+from exafel_project.kpp_utils.h5_writer import async_frame_writer
+from exafel_project.kpp_utils.multipanel import save_variable
+
+
+def get_detector(reference):
+  if reference is None:
+    from exafel_project.kpp_utils.ferredoxin import basic_detector_rayonix
+    return basic_detector_rayonix()
+  from dxtbx.model.experiment_list import ExperimentList
+  return ExperimentList.from_file(reference, check_format=False)[0].detector
+
+
+def python_compute(seconds):
+  """Busy Python loop holding the GIL between interpreter switch intervals"""
+  end = time() + seconds
+  n = 0
+  while time() < end:
+    n += 1
+  return n
+
+
+def write_frames(writer, detector, args):
+  beam = BeamFactory.simple(1.3)
+  energies = flex.double(np.linspace(9450., 9550., 100))
+  rng = np.random.default_rng(0)
+  frame = tuple(flex.double(rng.poisson(5., size=p.get_image_size()[::-1]).astype(float))
+                for p in detector)
+  writer.construct_detector(detector)
+  compute = sleep if args.compute == "sleep" else python_compute
+  start = time()
+  for i in range(args.nframes):
+    compute(args.compute_s)
+    beam.set_wavelength(1.3 + 1e-4 * i)
+    writer.add_beam_in_sequence(beam, Spectrum(energies, flex.double(100, 1.)))
+    writer.append_frame(data=frame)
+    save_variable(writer, np.eye(3), 'Umatrix_rot')
+    save_variable(writer, np.eye(3), 'Amatrix_rot')
+    save_variable(writer, np.array([32, 32, 32]), 'Ncells_abc')
+  if hasattr(writer, "close"):
+    writer.close()
+  return time() - start
+
+
+def run(args):
+  detector = get_detector(args.reference)
+  compute = args.nframes * args.compute_s
+  for label in ("nexus_factory", "async_frame_writer"):
+    path = os.path.join(args.outdir, "benchmark_%s.h5" % label)
+    writer = nexus_factory(path)
+    if label == "async_frame_writer":
+      writer = async_frame_writer(writer, queue_depth=args.queue_depth, model_block=args.model_block)
+    elapsed = write_frames(writer, detector, args)
+    print("%-20s %d frames in %7.2f s, %6.2f frames/s, %7.2f s beyond %s compute" % (
+          label, args.nframes, elapsed, args.nframes / elapsed, elapsed - compute, args.compute))
+    del writer
+    os.remove(path)
+
+
+if __name__ == "__main__":
+  parser = ArgumentParser()
+  parser.add_argument("--nframes", type=int, default=32, help="number of frames to write")
+  parser.add_argument("--compute_s", type=float, default=0.1, help="simulated compute time per frame")
+  parser.add_argument("--compute", choices=["python", "sleep"], default="python",
+                      help="python holds the GIL while computing, sleep releases it and gives an upper bound of the overlap")
+  parser.add_argument("--reference", default=None, help="expt file with the detector, default single Rayonix panel")
+  parser.add_argument("--outdir", default=".", help="directory for the temporary output files")
+  parser.add_argument("--queue_depth", type=int, default=2, help="frames queued by the async writer")
+  parser.add_argument("--model_block", type=int, default=64, help="model dataset growth in rows")
+  run(parser.parse_args())
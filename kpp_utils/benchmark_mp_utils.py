@@ -0,0 +1,139 @@
+"""
+Compare the MPI dictionary helpers of kpp_utils.mp_utils on a synthetic
+structure factor dictionary resembling the PSII `sfall_channels`. The
+dictionaries passed by the chunked helpers are checked against those of the
+one-message-per-key reference helpers, so that a small run with a small
+--chunk_bytes doubles as a regression check of the chunking.
+Example usage:
+  mpirun -n 2 libtbx.python benchmark_mp_utils.py --nchannels 10 --chunk_bytes 4096 --repeats 1
+  mpirun -n 2 libtbx.python benchmark_mp_utils.py --mode collect --nchannels 10 --chunk_bytes 4096 --repeats 1
+  mpirun -n 8 libtbx.python benchmark_mp_utils.py --nchannels 100 --d_min 1.9
+  mpirun -n 8 libtbx.python benchmark_mp_utils.py --mode collect
+  mpirun -n 8 libtbx.python benchmark_mp_utils.py --mode scaling
+"""
+from __future__ import division, print_function
+from argparse import ArgumentParser
+from functools import partial
+from time import time
+
+from cctbx import crystal
+from scitbx.array_family import flex
+from libtbx.mpi4py import MPI
+
+from exafel_project.kpp_utils.mp_utils import MPI_CHUNK_BYTES, bcast_large_dict, bcast_large_dict_by_key
+from exafel_project.kpp_utils.mp_utils import collect_large_dict, collect_large_dict_by_item
+
+
+def synthetic_miller_set(d_min):
+  """P1 anomalous miller set in the PSII unit cell"""
+  symmetry = crystal.symmetry(unit_cell=(117., 223., 310., 90., 90., 90.),
+                              space_group_symbol="P1")
+  return symmetry.build_miller_set(anomalous_flag=True, d_min=d_min)
+
+
+def synthetic_sfall_channels(nchannels, d_min, channels=None, seed=0):
+  """One complex miller array per energy channel, optionally only `channels`.
+  The data of a channel do not depend on which other channels are built."""
+  mset = synthetic_miller_set(d_min)
+  sfall_channels = {}
+  for x in range(nchannels) if channels is None else channels:
+    flex.set_random_seed(seed + x)
+    data = flex.complex_double(flex.random_double(mset.size()), flex.random_double(mset.size()))
+    sfall_channels[x] = mset.array(data=data)
+  return sfall_channels
+
+
+def assert_same_dict(received, expected):
+  """Same keys, and values with the same indices and data"""
+  assert sorted(received.keys()) == sorted(expected.keys())
+  for key, value in expected.items():
+    other = received[key]
+    if hasattr(value, "indices"):
+      assert (other.indices() == value.indices()).all_eq(True)
+      value, other = value.data(), other.data()
+    assert (other.as_numpy_array() == value.as_numpy_array()).all()
+
+
+def time_helper(comm, helper, make_data, repeats):
+  elapsed = []
+  for _ in range(repeats):
+    data = make_data() # collect helpers update the root dictionary in place
+    comm.barrier()
+    start = time()
+    received = helper(comm, data, root=0)
+    comm.barrier()
+    elapsed.append(time() - start)
+  return min(elapsed), received
+
+
+def run_bcast(comm, args):
+  make_data = lambda: synthetic_sfall_channels(args.nchannels, args.d_min) if comm.rank == 0 else None
+  chunked = partial(bcast_large_dict, chunk_bytes=args.chunk_bytes)
+  results = []
+  for name, helper in (("bcast_large_dict_by_key", bcast_large_dict_by_key), ("bcast_large_dict", chunked)):
+    best, received = time_helper(comm, helper, make_data, args.repeats)
+    assert sorted(received.keys()) == list(range(args.nchannels))
+    results.append(received)
+    if comm.rank == 0:
+      print("%-28s best of %d: %8.3f s" % (name, args.repeats, best))
+  assert_same_dict(results[1], results[0])
+  assert_same_dict(results[1], synthetic_sfall_channels(args.nchannels, args.d_min))
+  if comm.rank == 0:
+    print("bcast_large_dict with %d byte chunks matches bcast_large_dict_by_key on every rank" % args.chunk_bytes)
+
+
+def run_collect(comm, args):
+  # the last rank owns zero channels, as happens when nchannels < size; with two
+  # ranks both own channels, so that the check covers data actually gathered
+  owners = comm.size - 1 if comm.size > 2 else comm.size
+  channels = [x for x in range(args.nchannels) if x % owners == comm.rank]
+  make_data = lambda: synthetic_sfall_channels(args.nchannels, args.d_min, channels=channels)
+  chunked = partial(collect_large_dict, chunk_bytes=args.chunk_bytes)
+  results = []
+  for name, helper in (("collect_large_dict_by_item", collect_large_dict_by_item), ("collect_large_dict", chunked)):
+    best, received = time_helper(comm, helper, make_data, args.repeats)
+    results.append(received)
+    if comm.rank == 0:
+      assert sorted(received.keys()) == list(range(args.nchannels))
+      print("%-28s best of %d: %8.3f s" % (name, args.repeats, best))
+  if comm.rank == 0:
+    assert_same_dict(results[1], results[0])
+    assert_same_dict(results[1], synthetic_sfall_channels(args.nchannels, args.d_min))
+    print("collect_large_dict with %d byte chunks matches collect_large_dict_by_item" % args.chunk_bytes)
+
+
+def run_scaling(comm, args):
+  """Time collect_large_dict for a fixed payload split into a growing number
+  of keys, and for a fixed number of keys with a growing payload. The time
+  should be flat in the first series and linear in the second one."""
+  if comm.rank == 0:
+    print("%8s %12s %10s %10s" % ("keys", "MB/rank", "seconds", "MB/s"))
+  total_doubles = args.scaling_mb * 2**20 // 8
+  series = [(nkeys, total_doubles) for nkeys in (1, 10, 100, 1000)]
+  series += [(10, total_doubles * factor) for factor in (2, 4, 8)]
+  for nkeys, ndoubles in series:
+    make_data = lambda: {(comm.rank, key): flex.random_double(ndoubles // nkeys) for key in range(nkeys)}
+    best, received = time_helper(comm, partial(collect_large_dict, chunk_bytes=args.chunk_bytes),
+                                 make_data, args.repeats)
+    if comm.rank == 0:
+      assert len(received) == nkeys * comm.size
+      megabytes = ndoubles * 8 / 2**20
+      print("%8d %12.1f %10.3f %10.1f" % (nkeys, megabytes, best,
+            megabytes * (comm.size - 1) / best))
+
+
+if __name__ == "__main__":
+  parser = ArgumentParser()
+  parser.add_argument("--mode", choices=["bcast", "collect", "scaling"], default="bcast",
+                      help="which helpers to compare")
+  parser.add_argument("--nchannels", type=int, default=100, help="number of energy channels")
+  parser.add_argument("--d_min", type=float, default=2.5, help="resolution limit of the miller arrays")
+  parser.add_argument("--scaling_mb", type=int, default=16, help="smallest payload per rank for the scaling mode")
+  parser.add_argument("--repeats", type=int, default=3, help="repetitions, the best time is reported")
+  parser.add_argument("--chunk_bytes", type=int, default=MPI_CHUNK_BYTES,
+                      help="chunk size of the chunked helpers, make it small to test the chunking")
+  args = parser.parse_args()
+  comm = MPI.COMM_WORLD
+  if comm.rank == 0:
+    print("Benchmark mode %s over %d ranks" % (args.mode, comm.size))
+  dict(bcast=run_bcast, collect=run_collect, scaling=run_scaling)[args.mode](comm, args)
@@ -0,0 +1,70 @@
+"""
+Quantify the tail latency of the static and dynamic image schedulers of
+LY99_batch with a synthetic workload: every image sleeps for a base time plus
+an exponential jitter seeded by the image index, and a fraction of the ranks
+is slowed down by a constant factor, mimicking a contended GPU or CPU.
+Example usage:
+  mpirun -n 8 libtbx.python benchmark_scheduler.py --n_images 400 --batch_size 2
+  MPIR_CVAR_ASYNC_PROGRESS=1 mpirun -n 8 ...   # atomic_counter mode with MPICH
+  libtbx.python benchmark_scheduler.py --emulator   # single rank, LS49 mpiEmulator
+
+For the full simulation, compare the scheduler modes of LY99_batch with the CPU backend
+and the same artificial per-image jitter, then look at kpp-sim/weather.py plots:
+  N_SIM=400 IMAGE_JITTER_S=0.5 DEVICES_PER_NODE=1 mpirun -n 8 libtbx.python LY99_batch.py \\
+    context=kokkos_cpu scheduler.mode=coordinator scheduler.batch_size=2 ...
+"""
+from __future__ import division, print_function
+from argparse import ArgumentParser
+import random
+from time import time, sleep
+
+from exafel_project.kpp_utils.mp_utils import image_parcels
+
+
+def simulate(comm, args, mode):
+  slow = comm.size - comm.rank <= int(round(args.slow_fraction * comm.size)) # rank 0 may be the coordinator
+  factor = args.slow_factor if slow else 1.
+  comm.barrier()
+  start = time()
+  parcels = image_parcels(comm, args.n_images, mode=mode, batch_size=args.batch_size)
+  done = []
+  for idx in parcels:
+    sleep(factor * (args.base_s + random.Random(idx).expovariate(1. / args.jitter_s)))
+    done.append(idx)
+  finish = time() - start
+  comm.barrier()
+  if mode != "static":
+    parcels.free()
+  return finish, done
+
+
+def run(comm, args):
+  for mode in ("static", "atomic_counter", "coordinator"):
+    finish, done = simulate(comm, args, mode)
+    finishes = comm.gather(finish, root=0)
+    all_done = comm.gather(done, root=0)
+    if comm.rank == 0:
+      assert sorted(sum(all_done, [])) == list(range(args.n_images))
+      finishes = sorted(finishes)
+      median = finishes[len(finishes) // 2]
+      print("%-14s makespan %7.2f s, median rank finish %7.2f s, tail %7.2f s, images per worker rank %d-%d" % (
+            mode, finishes[-1], median, finishes[-1] - median,
+            min(len(d) for d in all_done if d), max(len(d) for d in all_done)))
+
+
+if __name__ == "__main__":
+  parser = ArgumentParser()
+  parser.add_argument("--n_images", type=int, default=200, help="number of images to schedule")
+  parser.add_argument("--batch_size", type=int, default=1, help="image indices claimed at once in dynamic mode")
+  parser.add_argument("--base_s", type=float, default=0.05, help="base time per image in seconds")
+  parser.add_argument("--jitter_s", type=float, default=0.05, help="mean exponential jitter per image in seconds")
+  parser.add_argument("--slow_fraction", type=float, default=0.125, help="fraction of slowed-down ranks")
+  parser.add_argument("--slow_factor", type=float, default=2., help="slowdown of the slow ranks")
+  parser.add_argument("--emulator", action="store_true", help="use the LS49 mpiEmulator instead of mpi4py")
+  args = parser.parse_args()
+  if args.emulator:
+    from LS49.adse13_196.mock_mpi import mpiEmulator
+    MPI = mpiEmulator()
+  else:
+    from libtbx.mpi4py import MPI
+  run(MPI.COMM_WORLD, args)
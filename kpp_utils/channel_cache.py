@@ -0,0 +1,150 @@
+from __future__ import division, print_function
+import hashlib
+import json
+import os
+
+import numpy as np
+
+"""
+Content-addressed on-disk cache of the energy channel structure factors
+computed by amplitudes_spread_ferredoxin, amplitudes_spread_psii and
+amplitudes_pdb. One NPZ file is stored per hash of every input the channels
+depend on: the model file contents, the resolution limit, the spectrum
+channel grid, the mean energy and the structure-specific choices. Changing
+any of these inputs produces a new hash, so stale entries are never read.
+Example usage, populating the cache ahead of a sweep of simulation jobs:
+  mpirun -n 32 libtbx.python channel_cache.py crystal.structure=PSII \\
+    beam.mean_energy=6550 channel_cache.directory=$SCRATCH/sfall_cache
+"""
+
+CACHE_VERSION = 1  # bump when the amplitude calculation itself changes
+
+
+def _model_files(params):
+  """Paths of the files read by the amplitude calculation for this structure"""
+  if params.crystal.structure == "ferredoxin":
+    from exafel_project.kpp_utils.ferredoxin import full_path
+    return [full_path(f) for f in ("1m2a.pdb", "data_sherrell/pf-rd-ox_fftkk.out",
+                                   "data_sherrell/pf-rd-red_fftkk.out", "data_sherrell/Fe_fake.dat")]
+  if params.crystal.structure == "PSII":
+    from exafel_project.kpp_utils.amplitudes_spread_psii import full_path
+    return [full_path(f) for f in ("7RF1_refine_030_Aa_refine_032_refine_034.pdb",
+                                   "data_sherrell/MnO2_spliced.dat", "data_sherrell/Mn2O3_spliced.dat",
+                                   "data_sherrell/Mn.dat")]
+  if params.crystal.pdb.source == "file":
+    return [params.crystal.pdb.file]
+  return []  # PDB entries fetched by code are identified by the code alone
+
+
+def channel_cache_key(params, direct_algo_res_limit):
+  """Hex digest identifying the structure factor channels for these inputs"""
+  inputs = dict(
+    version=CACHE_VERSION,
+    structure=params.crystal.structure,
+    absorption=params.absorption,
+    mean_energy=params.beam.mean_energy,
+    nchannels=params.spectrum.nchannels,
+    channel_width=params.spectrum.channel_width,
+    direct_algo_res_limit=direct_algo_res_limit,
+  )
+  if params.crystal.structure == "PSII":
+    inputs["PSII_control"] = params.crystal.PSII.control
+  if params.crystal.structure == "pdb":
+    pdb = params.crystal.pdb
+    inputs["pdb"] = dict(source=pdb.source, code=pdb.code, coefficients=pdb.coefficients, label=pdb.label)
+  digest = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode())
+  for path in _model_files(params):
+    with open(path, "rb") as fopen:
+      digest.update(hashlib.sha256(fopen.read()).digest())
+  return digest.hexdigest()
+
+
+class channel_cache(object):
+  """One NPZ file of miller indices and data per channel, named by the
+  hash of the simulation parameters"""
+
+  def __init__(self, params, direct_algo_res_limit):
+    directory = os.path.expandvars(params.channel_cache.directory)
+    self.path = os.path.join(directory, "sfall_%s.npz" % channel_cache_key(params, direct_algo_res_limit))
+
+  def exists(self):
+    return os.path.isfile(self.path)
+
+  def load(self):
+    from cctbx import crystal, miller
+    from cctbx.array_family import flex
+    channels = {}
+    with np.load(self.path) as npz:
+      symmetry = crystal.symmetry(unit_cell=tuple(npz["unit_cell"]),
+                                  space_group_symbol="Hall: %s" % npz["hall_symbol"])
+      anomalous_flag = bool(npz["anomalous_flag"])
+      flex_type = getattr(flex, str(npz["flex_type"]))
+      for key in npz["keys"]:
+        h, k, l = (flex.int(row) for row in npz["indices_%d" % key])
+        mset = miller.set(symmetry, flex.miller_index(h, k, l), anomalous_flag=anomalous_flag)
+        channels[int(key)] = mset.array(data=flex_type(npz["data_%d" % key]))
+    return channels
+
+  def save(self, channels):
+    """Write atomically, so concurrent jobs never read a partial file"""
+    first = channels[min(channels)]
+    arrays = dict(
+      keys=np.array(sorted(channels), dtype=np.int64),
+      unit_cell=np.array(first.unit_cell().parameters()),
+      hall_symbol=np.array(first.space_group_info().type().hall_symbol()),
+      anomalous_flag=np.array(bool(first.anomalous_flag())),
+      flex_type=np.array(type(first.data()).__name__),
+    )
+    for key, array in channels.items():
+      hkl = array.indices().as_vec3_double().as_numpy_array().T
+      arrays["indices_%d" % key] = np.ascontiguousarray(hkl, dtype=np.int32)
+      arrays["data_%d" % key] = array.data().as_numpy_array()
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    partial = "%s.%d.tmp" % (self.path, os.getpid())
+    with open(partial, "wb") as fopen:
+      np.savez(fopen, **arrays)
+    os.replace(partial, self.path)
+
+
+def cached_sfall_channels(comm, params, compute, **kwargs):
+  """Return the channels from the cache on rank 0 if present, otherwise call
+  `compute(comm, params, **kwargs)` and store its result. As with the
+  amplitude functions, only rank 0 is guaranteed to hold all channels."""
+  if params.channel_cache.directory is None:
+    return compute(comm, params, **kwargs)
+  cache = None
+  if comm.rank == 0:
+    cache = channel_cache(params, kwargs.get("direct_algo_res_limit", _default_res_limit(params)))
+  # a ground truth request must reach amplitudes_pdb, which writes it as a side effect
+  hit = comm.bcast(cache is not None and cache.exists() and params.output.ground_truth is None, root=0)
+  if hit:
+    if comm.rank != 0:
+      return {}
+    print("Loading cached energy channels from", cache.path)
+    return cache.load()
+  sfall_channels = compute(comm, params, **kwargs)
+  if comm.rank == 0:
+    cache.save(sfall_channels)
+    print("Saved energy channels to", cache.path)
+  return sfall_channels
+
+
+def _default_res_limit(params):
+  """Fallback resolution limits of the amplitude functions, for single panel runs"""
+  return 1.7 if params.crystal.structure == "ferredoxin" else 1.85
+
+
+def precompute():
+  from libtbx.mpi4py import MPI
+  from exafel_project.kpp_utils.phil import parse_input
+  from exafel_project.kpp_utils.LY99_batch import sfall_channels_function, multipanel_kwargs
+  params, options = parse_input()
+  assert params.channel_cache.directory is not None, "channel_cache.directory must be set"
+  comm = MPI.COMM_WORLD
+  kwargs = multipanel_kwargs(params) if params.detector.tiles == "multipanel" else {}
+  compute = sfall_channels_function(params.crystal.structure)
+  cached_sfall_channels(comm, params, compute, **kwargs)
+
+
+if __name__ == "__main__":
+  precompute()
@@ -60,6 +60,10 @@ def basic_detector_rayonix(): # from development, not actually used here but use
                  'type': ''}]}
   return DetectorFactory.from_dict(det_descr)
 
+from exafel_project.kpp_utils.background_cache import add_water_and_air_background, \
+  detector_fingerprint, get_background_cache
+from exafel_project.kpp_utils.spectra_parcel import significant_channels
+
 from LS49.sim.debug_utils import channel_extractor
 CHDBG_singleton = channel_extractor()
 
@@ -143,13 +147,6 @@ def run_sim2smv(prefix,crystal,spectra,rotation,rank,gpu_channels_singleton,para
   temp=SIM.Ncells_abc
   SIM.Ncells_abc=temp
 
-  # rough approximation to water: interpolation points for sin(theta/lambda) vs structure factor
-  water_bg = flex.vec2_double([(0,2.57),(0.0365,2.58),(0.07,2.8),(0.12,5),(0.162,8),(0.18,7.32),(0.2,6.75),(0.216,6.75),(0.236,6.5),(0.28,4.5),(0.3,4.3),(0.345,4.36),(0.436,3.77),(0.5,3.17)])
-  assert [a[0] for a in water_bg] == sorted([a[0] for a in water_bg])
-  # rough approximation to air
-  air_bg = flex.vec2_double([(0,14.1),(0.045,13.5),(0.174,8.35),(0.35,4.78),(0.5,4.22)])
-  assert [a[0] for a in air_bg] == sorted([a[0] for a in air_bg])
-
   # simulated crystal is only 125 unit cells (25 nm wide)
   # amplify spot signal to simulate physical crystal of 4000x larger: 100 um (64e9 x the volume)
   SIM.raw_pixels *= crystal.domains_per_crystal; # must calculate the correct scale!
@@ -177,10 +174,18 @@ def run_sim2smv(prefix,crystal,spectra,rotation,rank,gpu_channels_singleton,para
     gpu_simulation.allocate()
 
     gpu_detector = gpud(deviceId=SIM.device_Id, nanoBragg=SIM)
+    BG = get_background_cache(params)
+    if BG is not None:
+      def read_pixels():
+        gpu_detector.write_raw_pixels(SIM)
+        return SIM.raw_pixels.deep_copy()
+      background = BG.get(detector_fingerprint(DETECTOR), shot_to_shot_wavelength_A, params.beam.total_flux,
+        compute = lambda wavelength_A: BG.compute_on_gpu(SIM, gpu_simulation, gpu_detector,
+                                                         params.beam.total_flux, wavelength_A, read_pixels))
     gpu_detector.each_image_allocate()
 
     # loop over energies
-    for x in range(len(flux)):
+    for x in significant_channels(flux, params):
       P = Profiler("USE_EXASCALE_API nanoBragg Python and C++ rank %d"%(rank))
 
       print("USE_EXASCALE_API+++++++++++++++++++++++ Wavelength",x)
@@ -195,25 +200,16 @@ def run_sim2smv(prefix,crystal,spectra,rotation,rank,gpu_channels_singleton,para
     SIM.wavelength_A = shot_to_shot_wavelength_A # return to canonical energy for subsequent background
 
     assert add_background_algorithm == "cuda"
-    if add_background_algorithm == "cuda":
+    if add_background_algorithm == "cuda" and BG is None:
       QQ = Profiler("nanoBragg background rank %d"%(rank))
-      SIM.Fbg_vs_stol = water_bg
-      SIM.amorphous_sample_thick_mm = 0.1
-      SIM.amorphous_density_gcm3 = 1
-      SIM.amorphous_molecular_weight_Da = 18
-      SIM.flux=params.beam.total_flux
-      SIM.beamsize_mm=0.003 # square (not user specified)
-      SIM.exposure_s=1.0 # multiplies flux x exposure
-      gpu_simulation.add_background(gpu_detector)
-      SIM.Fbg_vs_stol = air_bg
-      SIM.amorphous_sample_thick_mm = 10 # between beamstop and collimator
-      SIM.amorphous_density_gcm3 = 1.2e-3
-      SIM.amorphous_sample_molecular_weight_Da = 28 # nitrogen = N2
-      gpu_simulation.add_background(gpu_detector)
+      add_water_and_air_background(SIM, gpu_simulation, gpu_detector, params.beam.total_flux)
 
     # deallocate GPU arrays
     gpu_detector.write_raw_pixels(SIM)  # updates SIM.raw_pixels from GPU
     gpu_detector.each_image_free()
+    if BG is not None:
+      QQ = Profiler("nanoBragg cached background rank %d"%(rank))
+      SIM.raw_pixels += background
     SIM.Amatrix_RUB = Amatrix_rot # return to canonical orientation
     del QQ
 
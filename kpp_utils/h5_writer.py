@@ -0,0 +1,108 @@
+from __future__ import division, print_function
+import atexit
+import os
+import queue
+import threading
+
+import numpy as np
+
+"""
+Asynchronous, double-buffered wrapper around the simtbx.nanoBragg nexus_factory
+writer. Completed frames are handed to a background thread through a bounded
+queue, so that the simulation of image N+1 overlaps the write of image N; the
+queue depth bounds the number of frames held in memory. Per-frame model
+variables (Umatrix_rot, Amatrix_rot, Ncells_abc) go into chunked datasets that
+grow in blocks of `model_block` rows and are trimmed to the number of frames
+when the writer is closed. Closing is registered with atexit, so queued frames
+are flushed even if the caller never closes the writer explicitly.
+"""
+
+
+class model_variable_writer(object):
+  """Append rows to extendable datasets, resizing once per `block` rows"""
+
+  def __init__(self, handle, block=64):
+    self.handle = handle
+    self.block = block
+    self.counts = {}
+
+  def append(self, variable, variable_name, root='/model'):
+    assert isinstance(variable, np.ndarray)
+    path = os.path.join(root, variable_name)
+    if path not in self.counts:
+      self.counts[path] = 0
+      self.handle.create_dataset(path, shape=(self.block,)+variable.shape, dtype=variable.dtype,
+                                 maxshape=(None,)+variable.shape, chunks=(self.block,)+variable.shape)
+    dset = self.handle[path]
+    nimg = self.counts[path]
+    if nimg == dset.shape[0]:
+      dset.resize((nimg + self.block,) + dset.shape[1:])
+    dset[nimg] = variable
+    self.counts[path] = nimg + 1
+
+  def trim(self):
+    for path, nimg in self.counts.items():
+      dset = self.handle[path]
+      dset.resize((nimg,) + dset.shape[1:])
+
+
+class async_frame_writer(object):
+  """Drop-in replacement for the nexus_factory writer in run_sim2h5"""
+
+  def __init__(self, writer, queue_depth=2, model_block=64):
+    self.writer = writer
+    self.handle = writer.handle
+    self.model = model_variable_writer(writer.handle, block=model_block)
+    # each frame queues add_beam_in_sequence, append_frame and the model variables
+    self.tasks = queue.Queue(maxsize=5*queue_depth)
+    self.error = None
+    self.closed = False
+    self.thread = threading.Thread(target=self._work, name="async_frame_writer")
+    self.thread.daemon = True
+    self.thread.start()
+    atexit.register(self.close)
+
+  def _work(self):
+    while True:
+      task = self.tasks.get()
+      try:
+        if task is None:
+          return
+        if self.error is None:
+          function, args, kwargs = task
+          function(*args, **kwargs)
+      except Exception as e:
+        self.error = e
+      finally:
+        self.tasks.task_done()
+
+  def _submit(self, function, *args, **kwargs):
+    if self.error is not None:
+      raise self.error
+    assert not self.closed, "writer already closed"
+    self.tasks.put((function, args, kwargs))
+
+  def construct_detector(self, detector):
+    self.writer.construct_detector(detector)
+
+  def add_beam_in_sequence(self, beam, spectrum):
+    # the caller mutates its beam for the next shot, so queue a copy
+    self._submit(self.writer.add_beam_in_sequence, type(beam).from_dict(beam.to_dict()), spectrum)
+
+  def append_frame(self, data):
+    self._submit(self.writer.append_frame, data=data)
+
+  def save_variable(self, variable, variable_name, root='/model'):
+    self._submit(self.model.append, np.array(variable), variable_name, root)
+
+  def close(self):
+    """Flush all queued frames, trim the model datasets and flush the file"""
+    if self.closed:
+      return
+    self.closed = True
+    self.tasks.put(None)
+    self.thread.join()
+    if self.error is not None:
+      raise self.error
+    self.model.trim()
+    self.handle.flush()
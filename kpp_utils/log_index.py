@@ -0,0 +1,297 @@
+from __future__ import division, print_function
+from argparse import ArgumentParser
+from datetime import datetime
+from multiprocessing import Pool
+import json
+import os
+import re
+
+import numpy as np
+
+"""
+Single-pass indexer of the text logs written by the simulation (LY99_batch
+rank logs and main slurm log) and by diffBragg stage 2 (logger lines
+"rank:node | time | function >> message" or "rank | time | message").
+Every known event type is extracted in one pass over each log, and files
+are split into byte-range chunks that are scanned by a pool of workers, so
+that even a single main_stage2.log of a 20k-rank job is read in parallel.
+
+The result is a columnar event table with one row per event:
+  rank       int32, from the logger prefix, the line, or the rank_N.log (debug_N.txt) name
+  node       str, from the "rank:node" logger prefix, else ""
+  timestamp  float64 epoch seconds, from the line itself or its logger prefix
+  event      str, one of the names in EVENT_RULES (or "debug:<step>")
+  value      float64, event payload (elapsed time, shot id, sigmaZ...) or nan
+saved as compact HDF5 columns with events and nodes stored as integer codes.
+The paths, sizes and modification times of the indexed logs are kept in the
+"sources" attribute, and load_events re-indexes the logs when they changed.
+Timing and plotting tools (kpp-sim/weather.py, extract_timestamps.py,
+evaluate_stage2_timestamps.py, evaluate_sigmaZ.py, mpi_histogram_timings.py)
+query this table.
+Example usage:
+  libtbx.python log_index.py $SCRATCH/$JOBID/rank_*.log $JOBID.out --output events.h5 --nproc 32
+"""
+
+EVENT_TABLE_COLUMNS = ("rank", "node", "timestamp", "event", "value")
+CHUNK_BYTES = 64 * 2**20
+RANK_FILENAME = re.compile(r"(?:rank|debug)_(\d+)")
+
+
+def _token(index):
+  return lambda message, tokens: float(tokens[index])
+
+def _after(separator):
+  return lambda message, tokens: float(message.rsplit(separator, 1)[1].split()[0].rstrip(","))
+
+def _nan(message, tokens):
+  return np.nan
+
+def _datetime_tokens(start):
+  return lambda message, tokens: datetime.fromisoformat(" ".join(tokens[start:start + 2])).timestamp()
+
+
+# (event name, substring identifying the line, value parser, timestamp parser, rank token)
+# Simulation logs print time.time() and the rank in the text; parsers take the message
+# and its split tokens, and None means: take timestamp and rank from the logger prefix (stage 2)
+# or the rank from the rank_N.log file name. When several substrings occur in a line,
+# the leftmost one wins.
+EVENT_RULES = [
+  # LY99_batch / multipanel / ferredoxin simulation logs
+  ("image_finished", "idx------finis-------->", _token(6), _token(4), 3),
+  ("channels_datetime", "datetime for channels", _nan, _token(6), 5),
+  ("rank_logger_finished", "finished with the rank logger", _nan, _token(1), 0),
+  ("channels_calculated", "finished with the calculation", _nan, _token(1), 0),
+  ("single_broadcast_finished", "finished with single", _nan, _token(1), 0),
+  ("srun_elapsed", "seconds elapsed after srun startup", _token(11), _datetime_tokens(4), 2),
+  ("python_elapsed", "seconds elapsed after Python imports", _token(11), _datetime_tokens(4), 2),
+  # diffBragg stage 2 logger messages
+  ("read_input_pickle", "EVENT: read input pickle", _nan, None, None),
+  ("launch_setup_done", "_launch done run setup", _nan, None, None),
+  ("launcher_setup_done", "_launcher done runno setup", _nan, None, None),
+  ("launcher_setup", "_launcher runno setup", _nan, None, None),
+  ("launcher_optimization_done", "_launcher done running optimization", _nan, None, None),
+  ("prep_dataframe_begin", "EVENT: BEGIN prep dataframe", _nan, None, None),
+  ("prep_dataframe_done", "EVENT: DONE prep dataframe", _nan, None, None),
+  ("loading_inputs_begin", "EVENT: begin loading inputs", _nan, None, None),
+  ("experiment_list_begin", "EVENT: BEGIN loading experiment list", _nan, None, None),
+  ("experiment_list_done", "EVENT: DONE loading experiment list", _nan, None, None),
+  ("roi_data_begin", "EVENT: LOADING ROI DATA", _nan, None, None),
+  ("roi_data_done", "EVENT: DONE LOADING ROI", _nan, None, None),
+  ("barrier_startup_enter", "DONE LOADING DATA; ENTER BARRIER", _nan, None, None),
+  ("barrier_startup_exit", "DONE LOADING DATA; EXIT BARRIER", _nan, None, None),
+  ("hkl_info_begin", "EVENT: Gathering global HKL information", _nan, None, None),
+  ("hkl_info_done", "EVENT: FINISHED gather global HKL information", _nan, None, None),
+  ("launch_refiner", "EVENT: launch refiner", _nan, None, None),
+  ("setup_begin", "Setup begins!", _nan, None, None),
+  ("setup_end", "Setup ends!", _nan, None, None),
+  ("func_grad_begin", "BEGIN FUNC GRAD ; iteration", _nan, None, None),
+  ("func_grad_begin", "BEGIN FUNC GRAD ; call", _nan, None, None),
+  ("func_grad_done", "DONE WITH FUNC GRAD", _nan, None, None),
+  ("update_fcell_begin", "start update Fcell", _nan, None, None),
+  ("update_fcell_done", "done update Fcell", _nan, None, None),
+  ("shot_finished", "finished diffBragg for shot", _after("shot"), None, None),
+  ("shot_begin", "run diffBragg for shot", _after("shot"), None, None),
+  ("shots_worked", "Time rank worked on shots", _after("="), None, None),
+  ("mpi_aggregation_begin", "MPI aggregation of func and grad", _nan, None, None),
+  ("mpi_aggregation_done", "Time for MPIaggregation", _nan, None, None),
+  ("sigmaz_mean", "sigmaZ: mean=", _after("mean="), None, None),
+]
+EVENT_NAMES = sorted({rule[0] for rule in EVENT_RULES})
+EVENT_OF_SUBSTRING = {rule[1]: rule[0] for rule in EVENT_RULES}
+_RULES_BY_SUBSTRING = {rule[1]: rule for rule in EVENT_RULES}
+_EVENT_REGEX = re.compile("|".join(re.escape(rule[1]) for rule in EVENT_RULES))
+_PREFIX_RANK = re.compile(r"(\d+)\s*$")
+
+
+def parse_logger_prefix(line):
+  """Split "rank[:node] | time | [function >> ]message" into its parts, rank
+  given as e.g. "12" or "RANK0012"; return (None, "", None, line) for lines
+  without a logger prefix"""
+  parts = line.split(" | ", 2)
+  if len(parts) != 3:
+    return None, "", None, line
+  ranknode, stamp, message = parts
+  rank, _, node = ranknode.partition(":")
+  m = _PREFIX_RANK.search(rank)
+  try:
+    timestamp = datetime.fromisoformat(stamp.strip().replace(",", ".")).timestamp()
+  except ValueError:
+    return None, "", None, line
+  return (int(m.group(1)) if m else None), node.strip(), timestamp, message.split(" >> ", 1)[-1]
+
+
+def parse_debug_line(line):
+  """(hostname, timestamp, status, step) of an xfel debug-directory line
+  "hostname,ts,now,status,step", as read by mpi_histogram_timings.py and
+  analyze_computational_performance.py in ADSE13_25/command_line"""
+  try:
+    hostname, ts, now, status, step = line.strip().split(",")
+    from iotbx.detectors.cspad_detector_formats import reverse_timestamp
+    now_s, now_ms = reverse_timestamp(now)
+  except (ValueError, TypeError):
+    return None
+  return hostname, now_s + 1e-3 * now_ms, status.strip(), step.strip()
+
+
+def parse_line(line, file_rank):
+  """(rank, node, timestamp, event, value) of a known event, else None"""
+  rank, node, timestamp, message = parse_logger_prefix(line)
+  match = _EVENT_REGEX.search(message)
+  if match is None:
+    return None
+  event, _, parse_value, parse_time, rank_token = _RULES_BY_SUBSTRING[match.group(0)]
+  tokens = message.split()
+  try:
+    value = parse_value(message, tokens)
+    if parse_time is not None:
+      timestamp = parse_time(message, tokens)
+    if rank_token is not None and rank is None:
+      rank = int(tokens[rank_token])
+  except (ValueError, IndexError):
+    return None
+  rank = file_rank if rank is None else rank
+  return (-1 if rank is None else rank), node, (np.nan if timestamp is None else timestamp), event, value
+
+
+def file_chunks(path, chunk_bytes=CHUNK_BYTES):
+  """Byte ranges (path, start, stop) covering the file"""
+  size = os.path.getsize(path)
+  return [(path, start, min(start + chunk_bytes, size)) for start in range(0, max(size, 1), chunk_bytes)]
+
+
+def scan_chunk(chunk):
+  """Events of lines starting within [start, stop) of the file, in file order"""
+  path, start, stop = chunk
+  m = RANK_FILENAME.search(os.path.basename(path))
+  file_rank = int(m.group(1)) if m else None
+  debug_format = path.endswith(".txt")
+  rows = []
+  with open(path, "rb") as F:
+    if start > 0:
+      F.seek(start - 1)
+      F.readline()  # a line starting before `start` belongs to the previous chunk
+    while F.tell() < stop:
+      raw = F.readline()
+      if not raw:
+        break
+      line = raw.decode("utf-8", errors="replace").rstrip("\n")
+      if debug_format:
+        parsed = parse_debug_line(line)
+        if parsed is not None:
+          hostname, timestamp, status, step = parsed
+          rows.append((-1 if file_rank is None else file_rank, hostname, timestamp, "debug:" + step, np.nan))
+        continue
+      parsed = parse_line(line, file_rank)
+      if parsed is not None:
+        rows.append(parsed)
+  return rows
+
+
+def rows_to_table(rows):
+  """Columnar event table, dict of numpy arrays plus category names"""
+  ranks, nodes, timestamps, events, values = zip(*rows) if rows else ((),) * 5
+  node_names, node_codes = np.unique(np.array(nodes, dtype=str), return_inverse=True)
+  event_names, event_codes = np.unique(np.array(events, dtype=str), return_inverse=True)
+  return dict(rank=np.array(ranks, dtype=np.int32),
+              node=node_codes.astype(np.int32), node_names=[str(n) for n in node_names],
+              timestamp=np.array(timestamps, dtype=np.float64),
+              event=event_codes.astype(np.int32), event_names=[str(n) for n in event_names],
+              value=np.array(values, dtype=np.float64))
+
+
+def index_logs(paths, nproc=1, chunk_bytes=CHUNK_BYTES):
+  """Scan `paths` in parallel chunks; return the event table as a DataFrame,
+  rows in file order for the paths in the order given"""
+  chunks = [c for path in paths for c in file_chunks(path, chunk_bytes)]
+  if nproc > 1 and len(chunks) > 1:
+    pool = Pool(nproc)
+    try:
+      scanned = pool.map(scan_chunk, chunks, chunksize=max(1, len(chunks) // (4 * nproc)))
+    finally:
+      pool.close()
+  else:
+    scanned = [scan_chunk(c) for c in chunks]
+  return table_to_dataframe(rows_to_table([row for rows in scanned for row in rows]))
+
+
+def table_to_dataframe(table):
+  import pandas as pd
+  return pd.DataFrame(dict(
+    rank=table["rank"],
+    node=pd.Categorical.from_codes(table["node"], categories=table["node_names"]),
+    timestamp=table["timestamp"],
+    event=pd.Categorical.from_codes(table["event"], categories=table["event_names"]),
+    value=table["value"]))
+
+
+def log_sources(paths):
+  """[path, size, mtime] of each log, as recorded in the event table"""
+  sources = []
+  for path in paths:
+    stat = os.stat(path)
+    sources.append([os.path.abspath(path), stat.st_size, stat.st_mtime])
+  return sources
+
+
+def write_event_table(df, path, paths=None):
+  """Write the event table, with the sources of the logs `paths` it was indexed from"""
+  import h5py
+  with h5py.File(path, "w") as F:
+    if paths is not None:
+      F.attrs["sources"] = json.dumps(log_sources(paths))
+    F.create_dataset("rank", data=df["rank"].to_numpy(), compression="gzip")
+    F.create_dataset("timestamp", data=df["timestamp"].to_numpy(), compression="gzip")
+    F.create_dataset("value", data=df["value"].to_numpy(), compression="gzip")
+    for key in ("node", "event"):
+      F.create_dataset(key, data=df[key].cat.codes.to_numpy().astype(np.int32), compression="gzip")
+      F.create_dataset(key + "_names", data=np.array(df[key].cat.categories, dtype=object),
+                       dtype=h5py.string_dtype())
+
+
+def read_event_table(path, events=None, ranks=None):
+  """Event table written by write_event_table, optionally only some events/ranks"""
+  import h5py
+  with h5py.File(path, "r") as F:
+    table = {key: F[key][()] for key in EVENT_TABLE_COLUMNS}
+    table["node_names"] = list(F["node_names"].asstr()[()])
+    table["event_names"] = list(F["event_names"].asstr()[()])
+  df = table_to_dataframe(table)
+  if events is not None:
+    df = df[df["event"].isin(list(events))]
+  if ranks is not None:
+    df = df[df["rank"].isin(list(ranks))]
+  return df.reset_index(drop=True)
+
+
+def read_table_sources(path):
+  """Sources recorded by write_event_table, None if there are none"""
+  import h5py
+  with h5py.File(path, "r") as F:
+    sources = F.attrs.get("sources")
+  return None if sources is None else json.loads(sources)
+
+
+def load_events(paths, table=None, nproc=1):
+  """Events from the saved `table` if it was indexed from `paths` as they are
+  now, else by scanning `paths` (and saving the result to `table`)"""
+  if table is not None and os.path.isfile(table):
+    if read_table_sources(table) == log_sources(paths):
+      return read_event_table(table)
+    print("Logs changed since %s was written, re-indexing" % table)
+  df = index_logs(paths, nproc=nproc)
+  if table is not None:
+    write_event_table(df, table, paths)
+  return df
+
+
+if __name__ == "__main__":
+  parser = ArgumentParser()
+  parser.add_argument("logs", nargs="+", help="log files to index")
+  parser.add_argument("--output", default="events.h5", help="HDF5 file of the event table")
+  parser.add_argument("--nproc", type=int, default=1, help="number of worker processes")
+  parser.add_argument("--chunk_mb", type=int, default=64, help="size of the file chunk read by one worker")
+  args = parser.parse_args()
+  df = index_logs(args.logs, nproc=args.nproc, chunk_bytes=args.chunk_mb * 2**20)
+  write_event_table(df, args.output, args.logs)
+  print("Indexed %d events in %d files, written to %s" % (len(df), len(args.logs), args.output))
+  print(df["event"].value_counts().to_string())
@@ -1,4 +1,7 @@
 from __future__ import division
+import pickle
+
+import numpy as np
 from libtbx.mpi4py import MPI
 
 
@@ -8,14 +11,43 @@ of sent/received/gathered/broadcasted objects must be smaller than 2**31 bytes.
 Attempting to pass a larger object causes an `OverflowError` or `SystemError`.
 The dictionaries of structure factors created by the EXAFEL scripts can easily
 exceed this internal limit, which can raise errors with ambiguous traceback.
-The `*_large_*` functions defined below circumvent this issue by passing values
-either one-by-one or in slices, which can negatively affect the execution time
-of the preparatory stage, but otherwise circumvents the mpi-related issues.
+The `*_large_*` functions defined below circumvent this issue by pickling
+the whole object once and passing the resulting bytes as raw buffers in chunks
+of at most `MPI_CHUNK_BYTES`, so that the number of collective calls scales
+with the payload size rather than with the number of dictionary keys.
 """
 
+MPI_CHUNK_BYTES = 2**30  # safely below the 2**31 mpi4py limit
+
+
+def _pickle_as_buffer(data) -> np.ndarray:
+  """Serialize `data` once and expose the bytes as a read-only uint8 array"""
+  return np.frombuffer(pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL),
+                       dtype=np.uint8)
+
+
+def _chunk_slices(nbytes: int, chunk_bytes: int = MPI_CHUNK_BYTES):
+  """Yield consecutive `slice`s of at most `chunk_bytes` covering `nbytes`"""
+  for start in range(0, nbytes, chunk_bytes):
+    yield slice(start, min(start + chunk_bytes, nbytes))
+
 
-def bcast_large_dict(comm: MPI.Comm, data: dict, root: int = 0) -> dict:
-  """Broadcast dictionary elements one-by-one to avoid MPI overflow issues"""
+def bcast_large_dict(comm: MPI.Comm, data: dict, root: int = 0,
+                     chunk_bytes: int = MPI_CHUNK_BYTES) -> dict:
+  """Broadcast dictionary pickled once on root, as chunked raw byte buffers"""
+  on_root = root == comm.rank
+  payload = _pickle_as_buffer(data) if on_root else None
+  nbytes = comm.bcast(payload.size if on_root else None, root=root)
+  if not on_root:
+    payload = np.empty(nbytes, dtype=np.uint8)
+  for chunk in _chunk_slices(nbytes, chunk_bytes):
+    comm.Bcast(payload[chunk], root=root)
+  return data if on_root else pickle.loads(memoryview(payload))
+
+
+def bcast_large_dict_by_key(comm: MPI.Comm, data: dict, root: int = 0) -> dict:
+  """Broadcast dictionary elements one-by-one to avoid MPI overflow issues.
+  Superseded by `bcast_large_dict`, kept as a reference for benchmarking."""
   on_root = root == comm.rank
   received = {}
   keys = list(data.keys()) if data is not None else None
@@ -26,9 +58,10 @@ def bcast_large_dict(comm: MPI.Comm, data: dict, root: int = 0) -> dict:
   return received
 
 
-def collect_large_dict(comm: MPI.Comm, data: dict, root: int = 0) -> dict:
+def collect_large_dict_by_item(comm: MPI.Comm, data: dict, root: int = 0) -> dict:
   """Gather dictionary elements one-by-one to avoid MPI overflow issues,
-  then recreate the dictionary from "gathered" list elements."""
+  then recreate the dictionary from "gathered" list elements.
+  Superseded by `collect_large_dict`, kept as a reference for benchmarking."""
   rank = comm.rank
   on_root = root == rank
   max_data_length = comm.allreduce(len(data), op=MPI.MAX)
@@ -45,3 +78,265 @@ def collect_large_dict(comm: MPI.Comm, data: dict, root: int = 0) -> dict:
   if on_root:
     data.update({r[0]: r[1] for r in received if r is not None})
   return data if on_root else None
+
+
+def _gatherv_rounds(sizes: np.ndarray, chunk_bytes: int = MPI_CHUNK_BYTES):
+  """Split the concatenation of all per-rank payloads of `sizes` bytes into
+  rounds of at most `chunk_bytes`. For every round yield the slice of the
+  concatenated receive buffer, the per-rank offsets into the local payloads,
+  the per-rank counts, and the per-rank displacements within the slice."""
+  ends = np.cumsum(sizes)
+  starts = ends - sizes
+  for chunk in _chunk_slices(int(ends[-1]), chunk_bytes):
+    lo = np.clip(starts, chunk.start, chunk.stop)
+    hi = np.clip(ends, chunk.start, chunk.stop)
+    yield chunk, lo - starts, hi - lo, lo - chunk.start
+
+
+def collect_large_dict(comm: MPI.Comm, data: dict, root: int = 0,
+                       chunk_bytes: int = MPI_CHUNK_BYTES) -> dict:
+  """Gather dictionaries pickled once per rank to root. Payload sizes are
+  exchanged first, then the bytes are streamed with chunked `Gatherv` calls,
+  and the root dictionary is updated with the unpickled contributions."""
+  on_root = root == comm.rank
+  payload = _pickle_as_buffer(data) if not on_root else np.empty(0, np.uint8)
+  sizes = np.zeros(comm.size, dtype=np.int64)
+  comm.Allgather(np.array([payload.size], dtype=np.int64), sizes)
+  received = np.empty(int(sizes.sum()) if on_root else 0, dtype=np.uint8)
+  for chunk, offsets, counts, displs in _gatherv_rounds(sizes, chunk_bytes):
+    send = payload[offsets[comm.rank]:offsets[comm.rank] + counts[comm.rank]]
+    recv = None
+    if on_root:
+      recv = [received[chunk], counts.tolist(), displs.tolist(), MPI.BYTE]
+    comm.Gatherv(send, recv, root=root)
+  if not on_root:
+    return None
+  ends = np.cumsum(sizes)
+  for start, end in zip(ends - sizes, ends):
+    if end > start:
+      data.update(pickle.loads(memoryview(received[start:end])))
+  return data
+
+
+class NodeSharedChannels(object):
+  """Read-only, dict-like view of miller arrays stored once per node in an MPI
+  shared memory window. `indices(key)` and `data(key)` return zero-copy NumPy
+  views into the window, while item access builds a cctbx miller array for
+  consumers such as `structure_factors_to_GPU_direct`. The miller sets are
+  built once per distinct block of indices, and the array of the first
+  channel, read for its unit cell and Fhkl on every image, is kept."""
+
+  def __init__(self, window, buffer, layout, node_comm=None):
+    self._window = window
+    self._buffer = buffer
+    self._layout = layout  # key -> (symmetry, anomalous, flex type, n, hkl offset, data offset, dtype)
+    self._node_comm = node_comm
+    self._sets = {}  # hkl offset -> miller set
+    self._pinned_key = next(iter(layout), None)
+    self._pinned = None
+    self._cached = (None, None)
+
+  def keys(self):
+    return self._layout.keys()
+
+  def __len__(self):
+    return len(self._layout)
+
+  def __iter__(self):
+    return iter(self._layout)
+
+  def __contains__(self, key):
+    return key in self._layout
+
+  def _view(self, offset, dtype, shape):
+    count = int(np.prod(shape))
+    return np.frombuffer(self._buffer, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+  def indices(self, key) -> np.ndarray:
+    """Miller indices of channel `key` as a (3, n) int32 array of h, k, l rows"""
+    _, _, _, n, hkl_offset, _, _ = self._layout[key]
+    return self._view(hkl_offset, np.int32, (3, n))
+
+  def data(self, key) -> np.ndarray:
+    """Structure factors of channel `key` as a 1-d array"""
+    _, _, _, n, _, data_offset, dtype = self._layout[key]
+    return self._view(data_offset, dtype, (n,))
+
+  def _miller_set(self, key):
+    symmetry, anomalous_flag, _, _, hkl_offset, _, _ = self._layout[key]
+    if hkl_offset not in self._sets:
+      from cctbx import miller
+      from cctbx.array_family import flex
+      h, k, l = (flex.int(row) for row in self.indices(key))
+      self._sets[hkl_offset] = miller.set(symmetry, flex.miller_index(h, k, l), anomalous_flag=anomalous_flag)
+    return self._sets[hkl_offset]
+
+  def __getitem__(self, key):
+    if key == self._pinned_key and self._pinned is not None:
+      return self._pinned
+    if self._cached[0] == key:
+      return self._cached[1]
+    from cctbx.array_family import flex
+    flex_type = self._layout[key][2]
+    array = self._miller_set(key).array(data=getattr(flex, flex_type)(self.data(key)))
+    if key == self._pinned_key:
+      self._pinned = array
+    else:
+      self._cached = (key, array)
+    return array
+
+  def free(self):
+    """Collectively release the shared window and node communicator on all
+    ranks of the node"""
+    self._cached = (None, None)
+    self._pinned = None
+    self._sets = {}
+    self._buffer = None
+    self._window.Free()
+    if self._node_comm is not None:
+      self._node_comm.Free()
+      self._node_comm = None
+
+
+def _node_shared_layout(data: dict, alignment: int = 64):
+  """Byte layout of miller indices and data of all channels in `data`.
+  Channels whose indices equal those of the previous channel share them."""
+  layout, blocks = {}, []
+  nbytes, previous = 0, None
+  align = lambda offset: -(-offset // alignment) * alignment
+  for key, array in data.items():
+    indices = array.indices().as_vec3_double().as_numpy_array().T.astype(np.int32)
+    values = array.data().as_numpy_array()
+    if previous is not None and np.array_equal(previous[0], indices):
+      hkl_offset = previous[1]
+    else:
+      hkl_offset = nbytes
+      blocks.append((hkl_offset, indices))
+      nbytes = align(hkl_offset + indices.nbytes)
+    previous = (indices, hkl_offset)
+    blocks.append((nbytes, values))
+    layout[key] = (array.crystal_symmetry(), array.anomalous_flag(),
+                   type(array.data()).__name__, values.size, hkl_offset, nbytes,
+                   values.dtype.str)
+    nbytes = align(nbytes + values.nbytes)
+  return layout, blocks, nbytes
+
+
+def bcast_large_dict_node_shared(comm: MPI.Comm, data: dict, root: int = 0) -> NodeSharedChannels:
+  """Broadcast a dictionary of miller arrays to one leader rank per node, which
+  exposes it to the other ranks of its node through a shared memory window.
+  Memory per node no longer scales with the number of ranks per node."""
+  shift = (comm.rank - root) % comm.size  # root becomes rank 0 of its node and of the leaders
+  node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED, key=shift)
+  is_leader = node_comm.rank == 0
+  leader_comm = comm.Split(0 if is_leader else MPI.UNDEFINED, key=shift)
+  layout, blocks, nbytes = None, [], 0
+  if is_leader:
+    data = bcast_large_dict(leader_comm, data, root=0)
+    layout, blocks, nbytes = _node_shared_layout(data)
+    leader_comm.Free()
+  window = MPI.Win.Allocate_shared(nbytes, 1, comm=node_comm)
+  buffer, _ = window.Shared_query(0)
+  if is_leader:
+    shared = np.frombuffer(buffer, dtype=np.uint8)
+    for offset, block in blocks:
+      shared[offset:offset + block.nbytes] = np.ascontiguousarray(block).view(np.uint8).ravel()
+    del data, blocks, shared
+  layout = node_comm.bcast(layout, root=0)
+  node_comm.Barrier()
+  return NodeSharedChannels(window, buffer, layout, node_comm)
+
+
+def static_parcels(comm: MPI.Comm, n_total: int):
+  """Image indices of this rank under the static round-robin assignment"""
+  return range(comm.rank, n_total, comm.size)
+
+
+class atomic_counter_parcels(object):
+  """Image indices claimed in batches of `batch_size` from a shared counter,
+  held by rank 0 in an MPI window and advanced with an atomic Fetch_and_op,
+  so that fast ranks take over work that a static stride would leave to
+  stragglers. Which rank simulates an image varies from run to run, but the
+  image itself depends only on its index. Iterate once on every rank, then
+  call `free()` collectively. Requires hardware RMA atomics or asynchronous
+  MPI progress (e.g. MPIR_CVAR_ASYNC_PROGRESS=1 for MPICH), otherwise claims
+  stall while rank 0 is busy computing."""
+
+  def __init__(self, comm: MPI.Comm, n_total: int, batch_size: int = 1):
+    self.comm = comm
+    self.n_total = n_total
+    self.batch_size = batch_size
+    self._next = 0  # used instead of a window when running on a single rank
+    self._window = None
+    if comm.size > 1:
+      self._counter = np.zeros(1, dtype=np.int64) if comm.rank == 0 else None
+      self._window = MPI.Win.Create(self._counter, disp_unit=8, comm=comm)
+
+  def _claim(self) -> int:
+    if self._window is None:
+      start, self._next = self._next, self._next + self.batch_size
+      return start
+    increment = np.array([self.batch_size], dtype=np.int64)
+    start = np.empty(1, dtype=np.int64)
+    self._window.Lock(0, MPI.LOCK_SHARED)
+    self._window.Fetch_and_op(increment, start, 0, 0, MPI.SUM)
+    self._window.Unlock(0)
+    return int(start[0])
+
+  def __iter__(self):
+    while True:
+      start = self._claim()
+      if start >= self.n_total:
+        return
+      for idx in range(start, min(start + self.batch_size, self.n_total)):
+        yield idx
+
+  def free(self):
+    if self._window is not None:
+      self._window.Free()
+      self._window = None
+
+
+class coordinator_parcels(atomic_counter_parcels):
+  """Image indices handed out in batches by rank 0, which acts as a dedicated
+  coordinator and simulates no images itself. Works with any MPI, at the cost
+  of one worker rank."""
+  TAG = 7701
+
+  def __init__(self, comm: MPI.Comm, n_total: int, batch_size: int = 1):
+    self.comm = comm
+    self.n_total = n_total
+    self.batch_size = batch_size
+    self._next = 0
+    self._window = None
+
+  def _claim(self) -> int:
+    if self.comm.size == 1:
+      return super(coordinator_parcels, self)._claim()
+    self.comm.send(None, dest=0, tag=self.TAG)
+    return self.comm.recv(source=0, tag=self.TAG)
+
+  def _serve(self):
+    status = MPI.Status()
+    active = self.comm.size - 1
+    while active:
+      self.comm.recv(source=MPI.ANY_SOURCE, tag=self.TAG, status=status)
+      start, self._next = self._next, self._next + self.batch_size
+      self.comm.send(start, dest=status.Get_source(), tag=self.TAG)
+      active -= start >= self.n_total  # this worker is done
+
+  def __iter__(self):
+    if self.comm.rank == 0 and self.comm.size > 1:
+      self._serve()
+      return iter(())
+    return super(coordinator_parcels, self).__iter__()
+
+
+def image_parcels(comm: MPI.Comm, n_total: int, mode: str = "static", batch_size: int = 1):
+  """Iterable of image indices to simulate on this rank. `mode` is static,
+  atomic_counter or coordinator; the last two need a collective `free()`."""
+  if mode == "atomic_counter":
+    return atomic_counter_parcels(comm, n_total, batch_size=batch_size)
+  if mode == "coordinator":
+    return coordinator_parcels(comm, n_total, batch_size=batch_size)
+  return static_parcels(comm, n_total)
@@ -13,6 +13,9 @@ import os
 from libtbx.development.timers import Profiler
 from simtbx import get_exascale
 import numpy as np
+from exafel_project.kpp_utils.background_cache import add_water_and_air_background, \
+  detector_fingerprint, get_background_cache
+from exafel_project.kpp_utils.spectra_parcel import significant_channels
 
 def specific_expt(params):
   P = Profiler("Initialize specific expt file %s"%(params.detector.reference))
@@ -39,236 +42,294 @@ def get_diffuse_from(params):
   val.rotate_principal_axes = params.diffuse.rotate_principal_axes
   return val
 
-def run_sim2h5(crystal,spectra,reference,rotation,rank,gpu_channels_singleton,params,
-                quick=False,save_bragg=False,sfall_channels=None, **kwargs):
-  DIFFUSE = get_diffuse_from(params)
-  DETECTOR = reference.detector
-  PANEL = DETECTOR[0]
-
-  wavlen, flux, shot_to_shot_wavelength_A = next(spectra) # list of lambdas, list of fluxes, average wavelength
-  assert shot_to_shot_wavelength_A > 0 # wavelength varies shot-to-shot
-  # os.system("nvidia-smi") # printout might severely impact performance
-
-  # use crystal structure to initialize Fhkl array
-  N = crystal.number_of_cells(sfall_channels[0].unit_cell())
-
-  consistent_beam = reference.beam
-  consistent_beam.set_wavelength(shot_to_shot_wavelength_A)
-  SIM = nanoBragg(detector = DETECTOR, beam = consistent_beam)
-  SIM.Ncells_abc=(N,N,N)
-  print("beam, polar", SIM.beam_vector, SIM.polar_vector)
-
-  SIM.adc_offset_adu = 0 # Do not offset by 40
-  #SIM.adc_offset_adu = 10 # Do not offset by 40
-  SIM.mosaic_spread_deg = 0.05 # interpreted by UMAT_nm as a half-width stddev
-                               # mosaic_domains setter MUST come after mosaic_spread_deg setter
-  SIM.mosaic_domains = int(os.environ.get("MOS_DOM","26")) # AnisoU class requires an even number
-  print ("MOSAIC",SIM.mosaic_domains,"after two fold duplicity is applied")
-  SIM.distance_mm = PANEL.get_distance()
-  print ("DISTANCE_mm",SIM.distance_mm)
-
-  from simtbx.nanoBragg.anisotropic_mosaicity import AnisoUmats
-  AUM = AnisoUmats(num_random_samples=SIM.mosaic_domains)
-  UMAT_nm,_,_ = AUM.generate_Umats(eta = SIM.mosaic_spread_deg, how=2, compute_derivs=False)
-  SIM.set_mosaic_blocks(UMAT_nm)
-
-  if params.attenuation:
-    SIM.detector_thick_mm = 0.032 # = 0 for Rayonix
-    SIM.detector_thicksteps = 1 # should default to 1 for Rayonix, but set to 5 for CSPAD
-    SIM.detector_attenuation_length_mm = 0.017 # default is silicon
-
-  # get same noise each time this test is run
-  SIM.seed = 1
-  SIM.oversample = params.oversample
-  SIM.wavelength_A = shot_to_shot_wavelength_A
-  SIM.polarization=1
-  # this will become F000, marking the beam center
-  SIM.default_F=0
-  SIM.Fhkl=sfall_channels[0] # instead of sfall_main
-  Amatrix_rot = (rotation *
-             sqr(sfall_channels[0].unit_cell().orthogonalization_matrix())).transpose()
-
-  SIM.Amatrix_RUB = Amatrix_rot
-  #workaround for failing init_cell, use custom written Amatrix setter
-
-  if params.crystal.symmetrize_Flatt:
-    # recip space Amat (rows are the recip lattice vecs)
-    A = sqr(SIM.Amatrix).transpose()
-    Areal = A.inverse()
-    real_a,real_b,real_c = Areal.as_list_of_lists()
-    # nanoBragg stores the primitive unit cell
-    C_p1 = Crystal(real_a,real_b,real_c, "P1")
-
-    # get the space group from the params
-    if params.crystal.structure=='pdb':
-      P = pdb_input(params.crystal.pdb.file)
-      symbol = P.crystal_symmetry().space_group().info().type().lookup_symbol()
-    elif params.crystal.structure=='ferredoxin':
-      symbol = "C 1 2 1"
-    elif params.crystal.structure=='PSII':
-      symbol = "P 21 21 21"
-    else:
-      raise NotImplementedError("crystal.structure must be PSII, pdb, or ferrodoxin")
-    SIM.set_mosaic_blocks_sym(C_p1, symbol, orig_mos_domains=len(UMAT_nm))
-
-  print("unit_cell_Adeg=",SIM.unit_cell_Adeg)
-  print("unit_cell_tuple=",SIM.unit_cell_tuple)
-  Amat = sqr(SIM.Amatrix).transpose() # recovered Amatrix from SIM
-  from cctbx import crystal_orientation
-  Ori = crystal_orientation.crystal_orientation(Amat, crystal_orientation.basis_type.reciprocal)
-
-  # fastest option, least realistic
-  SIM.xtal_shape=shapetype.Gauss_argchk # both crystal & RLP are Gaussian
-  # only really useful for long runs
-  SIM.progress_meter=False
-  # prints out value of one pixel only.  will not render full image!
-  # flux is always in photons/s
-  SIM.flux=params.beam.total_flux
-  SIM.exposure_s=1.0 # so total fluence is e12
-  # assumes round beam
-  SIM.beamsize_mm=0.003 #cannot make this 3 microns; spots are too intense
-  temp=SIM.Ncells_abc
-  SIM.Ncells_abc=temp
-
-  # rough approximation to water: interpolation points for sin(theta/lambda) vs structure factor
-  water_bg = flex.vec2_double([(0,2.57),(0.0365,2.58),(0.07,2.8),(0.12,5),(0.162,8),(0.18,7.32),(0.2,6.75),(0.216,6.75),(0.236,6.5),(0.28,4.5),(0.3,4.3),(0.345,4.36),(0.436,3.77),(0.5,3.17)])
-  assert [a[0] for a in water_bg] == sorted([a[0] for a in water_bg])
-  # rough approximation to air
-  air_bg = flex.vec2_double([(0,14.1),(0.045,13.5),(0.174,8.35),(0.35,4.78),(0.5,4.22)])
-  assert [a[0] for a in air_bg] == sorted([a[0] for a in air_bg])
-
-  # simulated crystal is only 125 unit cells (25 nm wide)
-  # amplify spot signal to simulate physical crystal of 4000x larger: 100 um (64e9 x the volume)
-  SIM.raw_pixels *= crystal.domains_per_crystal; # must calculate the correct scale!
-
-  QQ = Profiler("nanoBragg Bragg spots rank %d"%(rank))
-  if True:
-    #something new
+def mosaic_symmetry_symbol(params):
+  # get the space group from the params
+  if params.crystal.structure=='pdb':
+    P = pdb_input(params.crystal.pdb.file)
+    return P.crystal_symmetry().space_group().info().type().lookup_symbol()
+  elif params.crystal.structure=='ferredoxin':
+    return "C 1 2 1"
+  elif params.crystal.structure=='PSII':
+    return "P 21 21 21"
+  raise NotImplementedError("crystal.structure must be PSII, pdb, or ferrodoxin")
+
+# nanoBragg properties changed during an image (background passes, noise) that are
+# not all set again before they are used on the next image
+RESTORED_PROPERTIES = ("calib_seed", "flux", "exposure_s", "beamsize_mm", "Fbg_vs_stol",
+  "amorphous_sample_thick_mm", "amorphous_density_gcm3", "amorphous_molecular_weight_Da",
+  "detector_calibration_noise_pct", "readout_noise_adu")
+
+class multipanel_simulator(object):
+  """Per-rank simulation context for run_sim2h5.  The nanoBragg object with its detector
+  geometry, the AnisoUmats mosaic blocks (drawn from a fixed seed), the gpu_detector and
+  the pixel mask are set up once, on the first image.  For every image the properties in
+  RESTORED_PROPERTIES are put back to their values on the fresh object, and the Fhkl
+  table and the orientation dependent state are set in the same order as for a fresh
+  object.  Only the wavelength of the beam differs between images, and nanoBragg and the
+  gpu_detector take it from SIM.wavelength_A, set for every image.  The Fhkl table, the
+  mosaic blocks and the exascale_api allocation are still redone for every image.  The
+  per-image path remains the default (persistent_simulator=False); identical output of
+  the two paths is unverified, so check a multi-image job with kpp-sim/compare_h5_pixels.py,
+  with and without noise and psf, before use."""
+  def __init__(self, crystal, reference, rank, params, sfall_channels):
+    self.crystal = crystal
+    self.reference = reference
+    self.rank = rank
+    self.params = params
+    self.sfall_channels = sfall_channels
+    self.SIM = None
+    self.DIFFUSE = get_diffuse_from(params)
+
+  def _setup(self, consistent_beam):
+    params = self.params
+    DETECTOR = self.reference.detector
+    self.SIM = SIM = nanoBragg(detector = DETECTOR, beam = consistent_beam)
+    self.fresh_state = dict((name, getattr(SIM, name)) for name in RESTORED_PROPERTIES)
+    self.N = self.crystal.number_of_cells(self.sfall_channels[0].unit_cell())
+    self.mosaic_domains = int(os.environ.get("MOS_DOM","26")) # AnisoU class requires an even number
+    SIM.mosaic_spread_deg = 0.05
+    from simtbx.nanoBragg.anisotropic_mosaicity import AnisoUmats
+    AUM = AnisoUmats(num_random_samples=self.mosaic_domains)
+    self.UMAT_nm,_,_ = AUM.generate_Umats(eta = SIM.mosaic_spread_deg, how=2, compute_derivs=False)
+    if params.crystal.symmetrize_Flatt:
+      self.symbol = mosaic_symmetry_symbol(params)
+
     devices_per_node = int(os.environ["DEVICES_PER_NODE"])
-    SIM.device_Id = rank%devices_per_node
-
-    assert gpu_channels_singleton.get_deviceID()==SIM.device_Id
-    if gpu_channels_singleton.get_nchannels() == 0: # if uninitialized
-        P = Profiler("Initialize the channels singleton rank %d"%(rank))
-        for x in range(len(flux) if params.absorption=="spread" else 1):
-          gpu_channels_singleton.structure_factors_to_GPU_direct(
-           x, sfall_channels[x].indices(), sfall_channels[x].data())
+    SIM.device_Id = self.rank%devices_per_node
+    self.gpu_detector = get_exascale("gpu_detector", params.context)(
+      deviceId=SIM.device_Id, detector=DETECTOR, beam=consistent_beam)
+    multipanel=(len(DETECTOR),DETECTOR[0].get_image_size()[0],DETECTOR[0].get_image_size()[1])
+    image_grid = flex.grid(multipanel)
+    positive_mask = ~(flex.bool(image_grid, False))
+    self.positive_mask_iselection = positive_mask.iselection()
+
+  def free_all(self):
+    if self.SIM is not None:
+      self.SIM.free_all()
+      self.SIM = None
+      self.gpu_detector = None
+
+  def run(self, spectra, rotation, gpu_channels_singleton, **kwargs):
+    crystal = self.crystal
+    rank = self.rank
+    params = self.params
+    sfall_channels = self.sfall_channels
+    DETECTOR = self.reference.detector
+    PANEL = DETECTOR[0]
+
+    wavlen, flux, shot_to_shot_wavelength_A = next(spectra) # list of lambdas, list of fluxes, average wavelength
+    assert shot_to_shot_wavelength_A > 0 # wavelength varies shot-to-shot
+    # os.system("nvidia-smi") # printout might severely impact performance
+
+    consistent_beam = self.reference.beam
+    consistent_beam.set_wavelength(shot_to_shot_wavelength_A)
+    first_image = self.SIM is None
+    if first_image:
+      self._setup(consistent_beam)
+    SIM = self.SIM
+    if not first_image: # restore the state of a freshly constructed nanoBragg
+      for name in RESTORED_PROPERTIES: # add_noise may advance calib_seed, backgrounds set flux etc.
+        setattr(SIM, name, self.fresh_state[name])
+      raw_pixels = SIM.raw_pixels
+      raw_pixels.fill(0)
+      SIM.raw_pixels = raw_pixels
+    # use crystal structure to initialize Fhkl array
+    N = self.N
+    SIM.Ncells_abc=(N,N,N)
+    print("beam, polar", SIM.beam_vector, SIM.polar_vector)
+
+    SIM.adc_offset_adu = 0 # Do not offset by 40
+    #SIM.adc_offset_adu = 10 # Do not offset by 40
+    SIM.mosaic_spread_deg = 0.05 # interpreted by UMAT_nm as a half-width stddev
+                                 # mosaic_domains setter MUST come after mosaic_spread_deg setter
+    SIM.mosaic_domains = self.mosaic_domains
+    print ("MOSAIC",SIM.mosaic_domains,"after two fold duplicity is applied")
+    SIM.distance_mm = PANEL.get_distance()
+    print ("DISTANCE_mm",SIM.distance_mm)
+
+    UMAT_nm = self.UMAT_nm
+    SIM.set_mosaic_blocks(UMAT_nm)
+
+    if params.attenuation:
+      SIM.detector_thick_mm = 0.032 # = 0 for Rayonix
+      SIM.detector_thicksteps = 1 # should default to 1 for Rayonix, but set to 5 for CSPAD
+      SIM.detector_attenuation_length_mm = 0.017 # default is silicon
+
+    # get same noise each time this test is run
+    SIM.seed = 1
+    SIM.oversample = params.oversample
+    SIM.wavelength_A = shot_to_shot_wavelength_A
+    SIM.polarization=1
+    # this will become F000, marking the beam center
+    SIM.default_F=0
+    SIM.Fhkl=sfall_channels[0] # instead of sfall_main
+    Amatrix_rot = (rotation *
+               sqr(sfall_channels[0].unit_cell().orthogonalization_matrix())).transpose()
+
+    SIM.Amatrix_RUB = Amatrix_rot
+    #workaround for failing init_cell, use custom written Amatrix setter
+
+    if params.crystal.symmetrize_Flatt:
+      # recip space Amat (rows are the recip lattice vecs)
+      A = sqr(SIM.Amatrix).transpose()
+      Areal = A.inverse()
+      real_a,real_b,real_c = Areal.as_list_of_lists()
+      # nanoBragg stores the primitive unit cell
+      C_p1 = Crystal(real_a,real_b,real_c, "P1")
+      SIM.set_mosaic_blocks_sym(C_p1, self.symbol, orig_mos_domains=len(UMAT_nm))
+
+    print("unit_cell_Adeg=",SIM.unit_cell_Adeg)
+    print("unit_cell_tuple=",SIM.unit_cell_tuple)
+    Amat = sqr(SIM.Amatrix).transpose() # recovered Amatrix from SIM
+    from cctbx import crystal_orientation
+    Ori = crystal_orientation.crystal_orientation(Amat, crystal_orientation.basis_type.reciprocal)
+
+    # fastest option, least realistic
+    SIM.xtal_shape=shapetype.Gauss_argchk # both crystal & RLP are Gaussian
+    # only really useful for long runs
+    SIM.progress_meter=False
+    # prints out value of one pixel only.  will not render full image!
+    # flux is always in photons/s
+    SIM.flux=params.beam.total_flux
+    SIM.exposure_s=1.0 # so total fluence is e12
+    # assumes round beam
+    SIM.beamsize_mm=0.003 #cannot make this 3 microns; spots are too intense
+    temp=SIM.Ncells_abc
+    SIM.Ncells_abc=temp
+
+    # simulated crystal is only 125 unit cells (25 nm wide)
+    # amplify spot signal to simulate physical crystal of 4000x larger: 100 um (64e9 x the volume)
+    SIM.raw_pixels *= crystal.domains_per_crystal; # must calculate the correct scale!
+
+    QQ = Profiler("nanoBragg Bragg spots rank %d"%(rank))
+    if True:
+      #something new
+      assert gpu_channels_singleton.get_deviceID()==SIM.device_Id
+      if gpu_channels_singleton.get_nchannels() == 0: # if uninitialized
+          P = Profiler("Initialize the channels singleton rank %d"%(rank))
+          for x in range(len(flux) if params.absorption=="spread" else 1):
+            gpu_channels_singleton.structure_factors_to_GPU_direct(
+             x, sfall_channels[x].indices(), sfall_channels[x].data())
+          del P
+          import time
+          print("datetime for channels singleton rank %d"%(rank),time.time())
+
+      exascale_api = get_exascale("exascale_api", params.context)
+
+      gpu_simulation = exascale_api(nanoBragg = SIM)
+      gpu_simulation.allocate()
+
+      gpu_simulation.diffuse = self.DIFFUSE
+      gpu_detector = self.gpu_detector
+      # with noise or psf the background must be on the GPU before add_noise, so it is not cached
+      BG = None if (params.noise or params.psf) else get_background_cache(params)
+      if BG is not None:
+        background = BG.get(detector_fingerprint(DETECTOR), shot_to_shot_wavelength_A, params.beam.total_flux,
+          compute = lambda wavelength_A: BG.compute_on_gpu(SIM, gpu_simulation, gpu_detector,
+                                                           params.beam.total_flux, wavelength_A, gpu_detector.get_raw_pixels))
+      gpu_detector.each_image_allocate()
+
+      positive_mask_iselection = self.positive_mask_iselection
+
+      # loop over energies
+      for x in significant_channels(flux, params):
+        P = Profiler("USE_EXASCALE_API nanoBragg Python and C++ rank %d"%(rank))
+
+        print("USE_EXASCALE_API+++++++++++++++++++++++ Wavelength",x)
+
+        # from channel_pixels function
+        SIM.wavelength_A = wavlen[x]
+        SIM.flux = flux[x]
+        channel_selection = 0 if params.absorption=="high_remote" else x
+        gpu_simulation.add_energy_channel_mask_allpanel(
+              channel_selection, gpu_channels_singleton, gpu_detector, positive_mask_iselection)
         del P
-        import time
-        print("datetime for channels singleton rank %d"%(rank),time.time())
+      gpu_detector.scale_in_place(crystal.domains_per_crystal) # apply scale directly on GPU
+      SIM.wavelength_A = shot_to_shot_wavelength_A # return to canonical energy for subsequent background
 
-    exascale_api = get_exascale("exascale_api", params.context)
-    gpud = get_exascale("gpu_detector", params.context)
+      if BG is None:
+        QQ = Profiler("nanoBragg background rank %d"%(rank))
+        add_water_and_air_background(SIM, gpu_simulation, gpu_detector, params.beam.total_flux)
 
-    gpu_simulation = exascale_api(nanoBragg = SIM)
-    gpu_simulation.allocate()
+      # gpu_detector.write_raw_pixels(SIM)  # updates SIM.raw_pixels from GPU ###################################################################NKS
 
-    gpu_simulation.diffuse = DIFFUSE
-    gpu_detector = gpud(deviceId=SIM.device_Id, detector=DETECTOR, beam=consistent_beam)
-    gpu_detector.each_image_allocate()
+      SIM.Amatrix_RUB = Amatrix_rot # return to canonical orientation
+      del QQ
 
-    multipanel=(len(DETECTOR),DETECTOR[0].get_image_size()[0],DETECTOR[0].get_image_size()[1])
-    image_grid = flex.grid(multipanel)
-    positive_mask = ~(flex.bool(image_grid, False))
-    positive_mask_iselection = positive_mask.iselection()
-
-    # loop over energies
-    for x in range(len(flux)):
-      P = Profiler("USE_EXASCALE_API nanoBragg Python and C++ rank %d"%(rank))
-
-      print("USE_EXASCALE_API+++++++++++++++++++++++ Wavelength",x)
-
-      # from channel_pixels function
-      SIM.wavelength_A = wavlen[x]
-      SIM.flux = flux[x]
-      channel_selection = 0 if params.absorption=="high_remote" else x
-      gpu_simulation.add_energy_channel_mask_allpanel(
-            channel_selection, gpu_channels_singleton, gpu_detector, positive_mask_iselection)
-      del P
-    gpu_detector.scale_in_place(crystal.domains_per_crystal) # apply scale directly on GPU
-    SIM.wavelength_A = shot_to_shot_wavelength_A # return to canonical energy for subsequent background
-
-    QQ = Profiler("nanoBragg background rank %d"%(rank))
-    SIM.Fbg_vs_stol = water_bg
-    SIM.amorphous_sample_thick_mm = 0.1
-    SIM.amorphous_density_gcm3 = 1
-    SIM.amorphous_molecular_weight_Da = 18
-    SIM.flux=params.beam.total_flux
-    SIM.beamsize_mm=0.003 # square (not user specified)
-    SIM.exposure_s=1.0 # multiplies flux x exposure
-    gpu_simulation.add_background(gpu_detector)
-    SIM.Fbg_vs_stol = air_bg
-    SIM.amorphous_sample_thick_mm = 10 # between beamstop and collimator
-    SIM.amorphous_density_gcm3 = 1.2e-3
-    SIM.amorphous_sample_molecular_weight_Da = 28 # nitrogen = N2
-    gpu_simulation.add_background(gpu_detector)
-
-    # gpu_detector.write_raw_pixels(SIM)  # updates SIM.raw_pixels from GPU ###################################################################NKS
-
-    SIM.Amatrix_RUB = Amatrix_rot # return to canonical orientation
+    if params.psf:
+      SIM.detector_psf_kernel_radius_pixels=10;
+      SIM.detector_psf_type=shapetype.Fiber # for Rayonix
+      SIM.detector_psf_fwhm_mm=0.08
+      #SIM.apply_psf() # the actual application is called within the C++ SIM.add_noise()
+    else:
+      #SIM.detector_psf_kernel_radius_pixels=5;
+      SIM.detector_psf_type=shapetype.Unknown # for CSPAD
+      SIM.detector_psf_fwhm_mm=0
+
+    if params.noise:
+      SIM.adc_offset_adu = 10 # Do not offset by 40
+      SIM.detector_calibration_noise_pct = 1.0
+      SIM.readout_noise_adu = 1.
+
+    QQ = Profiler("nanoBragg noise rank %d"%(rank))
+    if params.noise or params.psf:
+      from LS49.sim.step6_pad import estimate_gain
+      print("quantum_gain=",SIM.quantum_gain) #defaults to 1. converts photons to ADU
+      print("adc_offset_adu=",SIM.adc_offset_adu)
+      print("detector_calibration_noise_pct=",SIM.detector_calibration_noise_pct)
+      print("flicker_noise_pct=",SIM.flicker_noise_pct)
+      print("readout_noise_adu=",SIM.readout_noise_adu) # gaussian random number to add to every pixel (0 for PAD)
+      # apply Poissonion correction, then scale to ADU, then adc_offset.
+      # should be 10 for most Rayonix, Pilatus should be 0, CSPAD should be 0.
+      print("detector_psf_type=",SIM.detector_psf_type)
+      print("detector_psf_fwhm_mm=",SIM.detector_psf_fwhm_mm)
+      print("detector_psf_kernel_radius_pixels=",SIM.detector_psf_kernel_radius_pixels)
+      #estimate_gain(SIM.raw_pixels,offset=0)
+      #SIM.add_noise() #converts photons to ADU.
+      nominal_data = gpu_simulation.add_noise(gpu_detector)
+      #estimate_gain(SIM.raw_pixels,offset=SIM.adc_offset_adu,algorithm="slow")
+      #estimate_gain(SIM.raw_pixels,offset=SIM.adc_offset_adu,algorithm="kabsch")
+    else:                                           # the normal way to gt the data,
+      nominal_data = gpu_detector.get_raw_pixels()  # but shortcut due to noise call.
+      if BG is not None:
+        nominal_data += background
     del QQ
+    gpu_detector.each_image_free() # deallocate GPU arrays
+
+    if params.output.format == "h5":
+      from dxtbx.model import Spectrum
+      from cctbx import factor_ev_angstrom
+      spectrum= Spectrum(factor_ev_angstrom/wavlen, flux)
+      kwargs["writer"].add_beam_in_sequence(consistent_beam,spectrum)
+
+      print ("ZINGA nominal", nominal_data, nominal_data.focus())
+      # ad hoc code to recast as tuple of panel arrays
+      npanel,nslow,nfast = nominal_data.focus()
+      nominal_data.reshape(flex.grid((npanel*nslow,nfast)))
+      reshape_data = tuple([ nominal_data[ip*nslow:(ip+1)*nslow, 0:nfast ] for ip in range(npanel)])
+      kwargs["writer"].append_frame(data=reshape_data)
+
+      # It is understood that save_variable is provisional.  In the future we have to address that
+      #   - the resulting H5 are no longer NeXus compliant
+      #   - orientation refers to the P1-setting used internally in nanoBragg, rather than the conventional reference setting
+      save_variable(kwargs["writer"], rotation.as_numpy_array(), 'Umatrix_rot')
+      save_variable(kwargs["writer"], Amatrix_rot.as_numpy_array(), 'Amatrix_rot')
+      save_variable(kwargs["writer"], np.array(SIM.Ncells_abc), 'Ncells_abc')
 
-  if params.psf:
-    SIM.detector_psf_kernel_radius_pixels=10;
-    SIM.detector_psf_type=shapetype.Fiber # for Rayonix
-    SIM.detector_psf_fwhm_mm=0.08
-    #SIM.apply_psf() # the actual application is called within the C++ SIM.add_noise()
-  else:
-    #SIM.detector_psf_kernel_radius_pixels=5;
-    SIM.detector_psf_type=shapetype.Unknown # for CSPAD
-    SIM.detector_psf_fwhm_mm=0
-
-  if params.noise:
-    SIM.adc_offset_adu = 10 # Do not offset by 40
-    SIM.detector_calibration_noise_pct = 1.0
-    SIM.readout_noise_adu = 1.
-
-  QQ = Profiler("nanoBragg noise rank %d"%(rank))
-  if params.noise or params.psf:
-    from LS49.sim.step6_pad import estimate_gain
-    print("quantum_gain=",SIM.quantum_gain) #defaults to 1. converts photons to ADU
-    print("adc_offset_adu=",SIM.adc_offset_adu)
-    print("detector_calibration_noise_pct=",SIM.detector_calibration_noise_pct)
-    print("flicker_noise_pct=",SIM.flicker_noise_pct)
-    print("readout_noise_adu=",SIM.readout_noise_adu) # gaussian random number to add to every pixel (0 for PAD)
-    # apply Poissonion correction, then scale to ADU, then adc_offset.
-    # should be 10 for most Rayonix, Pilatus should be 0, CSPAD should be 0.
-    print("detector_psf_type=",SIM.detector_psf_type)
-    print("detector_psf_fwhm_mm=",SIM.detector_psf_fwhm_mm)
-    print("detector_psf_kernel_radius_pixels=",SIM.detector_psf_kernel_radius_pixels)
-    #estimate_gain(SIM.raw_pixels,offset=0)
-    #SIM.add_noise() #converts photons to ADU.
-    nominal_data = gpu_simulation.add_noise(gpu_detector)
-    #estimate_gain(SIM.raw_pixels,offset=SIM.adc_offset_adu,algorithm="slow")
-    #estimate_gain(SIM.raw_pixels,offset=SIM.adc_offset_adu,algorithm="kabsch")
-  else:                                           # the normal way to gt the data,
-    nominal_data = gpu_detector.get_raw_pixels()  # but shortcut due to noise call.
-  del QQ
-  gpu_detector.each_image_free() # deallocate GPU arrays
-
-  if params.output.format == "h5":
-    from dxtbx.model import Spectrum
-    from cctbx import factor_ev_angstrom
-    spectrum= Spectrum(factor_ev_angstrom/wavlen, flux)
-    kwargs["writer"].add_beam_in_sequence(consistent_beam,spectrum)
-
-    print ("ZINGA nominal", nominal_data, nominal_data.focus())
-    # ad hoc code to recast as tuple of panel arrays
-    npanel,nslow,nfast = nominal_data.focus()
-    nominal_data.reshape(flex.grid((npanel*nslow,nfast)))
-    reshape_data = tuple([ nominal_data[ip*nslow:(ip+1)*nslow, 0:nfast ] for ip in range(npanel)])
-    kwargs["writer"].append_frame(data=reshape_data)
-
-    # It is understood that save_variable is provisional.  In the future we have to address that
-    #   - the resulting H5 are no longer NeXus compliant
-    #   - orientation refers to the P1-setting used internally in nanoBragg, rather than the conventional reference setting
-    save_variable(kwargs["writer"], rotation.as_numpy_array(), 'Umatrix_rot')
-    save_variable(kwargs["writer"], Amatrix_rot.as_numpy_array(), 'Amatrix_rot')
-    save_variable(kwargs["writer"], np.array(SIM.Ncells_abc), 'Ncells_abc')
-
-  SIM.free_all()
+def run_sim2h5(crystal,spectra,reference,rotation,rank,gpu_channels_singleton,params,
+                quick=False,save_bragg=False,sfall_channels=None,simulator=None, **kwargs):
+  """Simulate one image.  With a persistent multipanel_simulator, the per-rank setup
+  is reused from the previous image; otherwise it is rebuilt and freed here."""
+  transient = simulator is None
+  if transient:
+    simulator = multipanel_simulator(crystal, reference, rank, params, sfall_channels)
+  simulator.run(spectra, rotation, gpu_channels_singleton, **kwargs)
+  if transient:
+    simulator.free_all()
 
 def save_variable(writer, variable, variable_name, root='/model'):
+      if hasattr(writer, "save_variable"): # async_frame_writer, block-allocated datasets
+        return writer.save_variable(variable, variable_name, root)
       path = os.path.join(root, variable_name)
       h5 = writer.handle
       assert isinstance(variable, np.ndarray)
@@ -22,6 +22,54 @@ def parse_input():
       .type = choice
       .help = either do a spread calculation, which calculates wavelength-dependent amplitudes, or
       .help = a high_remote energy calculation, where amplitudes are only calculated at the mean energy
+    mpi {
+      node_shared_sfall = False
+        .type = bool
+        .help = broadcast the energy channel structure factors to one leader rank per node, which exposes
+        .help = them to the other ranks of the node through an MPI shared memory window instead of
+        .help = holding one copy per rank. Requires real MPI, not available with the mpiEmulator.
+    }
+    channel_cache {
+      directory = None
+        .type = path
+        .help = if set, load the energy channel structure factors from a file in this directory named by
+        .help = the hash of all inputs they depend on, or compute and store them there if missing.
+        .help = Populate ahead of time with libtbx.python kpp_utils/channel_cache.py <same arguments>
+    }
+    scheduler {
+      mode = *static atomic_counter coordinator
+        .type = choice
+        .help = static: rank r simulates images r, r+size, r+2*size, ...
+        .help = atomic_counter: ranks claim batches of image indices from an MPI RMA counter held by rank 0,
+        .help = so that slow ranks do not set the tail of the job. Needs hardware RMA atomics or
+        .help = asynchronous MPI progress (MPIR_CVAR_ASYNC_PROGRESS=1 for MPICH).
+        .help = coordinator: rank 0 hands out the batches and simulates no images itself.
+        .help = In all modes each image only depends on its index.
+      batch_size = 1
+        .type = int(value_min=1)
+        .help = number of consecutive image indices claimed at once in the dynamic modes
+    }
+    background_cache {
+      enable = False
+        .type = bool
+        .help = compute the water + air background image once per detector, wavelength bucket and flux on each
+        .help = rank, and add it to the raw pixels instead of two add_background passes per image.
+        .help = For detector.tiles=multipanel only used with noise=False and psf=False, because the GPU noise
+        .help = model needs the background in device memory.
+      wavelength_bucket_A = 0.0001
+        .type = float(value_min=0)
+        .help = width of the wavelength buckets, the cached background is computed at the bucket center
+      max_entries = 4
+        .type = int(value_min=1)
+        .help = most background images kept per rank, each the size of a full detector image.
+        .help = The least recently used one is dropped when a new bucket is computed
+    }
+    persistent_simulator = False
+      .type = bool
+      .help = detector.tiles=multipanel only: keep the nanoBragg object, mosaic blocks and GPU detector of each
+      .help = rank across images, instead of rebuilding them for every image. Output is meant to be identical,
+      .help = but this has not been verified: check with kpp-sim/compare_h5_pixels.py against a run without it
+      .help = before relying on it
     oversample = 1
       .type = int(value_min=0)
       .help = directly set nanoBragg oversample parameter, currently only implemented for multipanel
@@ -41,6 +89,13 @@ def parse_input():
       channel_width = 1.0
         .type = float
         .help = width of one energy channel in eV.
+      min_flux_fraction = 0
+        .type = float(value_min=0)
+        .help = skip the energy channels carrying less than this fraction of an image's total flux. 0 simulates every channel.
+        .help = The kept channels are scaled up so that the image's total flux is unchanged
+      parcel_size = 64
+        .type = int(value_min=1)
+        .help = number of images whose spectra are generated and thresholded together (static scheduler)
     }
     crystal {
       symmetrize_Flatt = True
@@ -133,6 +188,18 @@ def parse_input():
           .type = bool
           .help = Subtract 0.5 from the float-valued pixels, thus the Nexus writer behaves like SMV (cast to lower integer)
           .help = instead of nearest integer rounding.
+        async_writer {
+          enable = False
+            .type = bool
+            .help = write frames from a background thread, overlapping the simulation of the next image,
+            .help = and store the model variables in datasets preallocated in blocks of model_block rows
+          queue_depth = 2
+            .type = int(value_min=1)
+            .help = maximum number of completed frames waiting to be written
+          model_block = 64
+            .type = int(value_min=1)
+            .help = rows added at once to the /model datasets, trimmed to the frame count on close
+        }
       }
       ground_truth = None
         .type = str
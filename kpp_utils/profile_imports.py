@@ -0,0 +1,101 @@
+"""
+Import-time regression harness for the LY99_batch entry point. Runs
+  python -X importtime -c "import exafel_project.kpp_utils.LY99_batch"
+in a subprocess, reports the slowest imports, and checks that modules which
+only some code paths need are not imported eagerly at module import time.
+That check only looks at the list of imported modules, not at timings, so
+it gives the same answer on any machine. --check also compares with a
+baseline recorded on the same machine: modules imported since are listed
+for information, and the import time only fails the check if --tolerance
+is given.
+Example usage:
+  libtbx.python profile_imports.py --deferred                          # no timings, exit code 1 on eager import
+  libtbx.python profile_imports.py --record importtime_baseline.json   # before a change
+  libtbx.python profile_imports.py --check importtime_baseline.json    # after, exit code 1 on regression
+"""
+from __future__ import division, print_function
+from argparse import ArgumentParser
+import json
+import platform
+import subprocess
+import sys
+
+ENTRY_POINT = "exafel_project.kpp_utils.LY99_batch"
+
+# imported by LY99_batch only on the code paths that need them
+DEFERRED_MODULES = [
+  "exafel_project.kpp_utils.amplitudes_spread_psii",       # not needed by ferredoxin runs
+  "exafel_project.kpp_utils.amplitudes_spread_ferredoxin",
+  "exafel_project.kpp_utils.multipanel",
+  "simtbx.nanoBragg.nexus_factory",                        # not needed for SMV output
+  "LS49.spectra",                                          # not needed when spectra are cached
+  "LS49.spectra.generate_spectra",
+  "LS49.sim.step4_pad",
+  "scipy",
+  "omptbx",
+]
+
+
+def importtime(module=ENTRY_POINT):
+  """Map of module name to (self, cumulative) import time in microseconds"""
+  result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s" % module],
+                          stderr=subprocess.PIPE, universal_newlines=True, check=True)
+  timings = {}
+  for line in result.stderr.splitlines():
+    if not line.startswith("import time:") or "[us]" in line:
+      continue
+    self_us, cumulative_us, name = line[len("import time:"):].split("|")
+    timings[name.strip()] = (int(self_us), int(cumulative_us))
+  return timings
+
+
+def eager_imports(timings):
+  """Deferred modules imported by the entry point at module import time"""
+  eager = [name for name in DEFERRED_MODULES if name in timings]
+  for name in eager:
+    print("EAGER IMPORT of deferred module", name)
+  return eager
+
+
+def run(args):
+  timings = importtime()
+  if args.deferred:
+    eager = eager_imports(timings)
+    print("%s imports %d modules, %d of %d deferred modules eagerly" % (
+          ENTRY_POINT, len(timings), len(eager), len(DEFERRED_MODULES)))
+    return 1 if eager else 0
+  total_s = timings[ENTRY_POINT][1] * 1e-6
+  print("import %s: %.3f s cumulative, %d modules" % (ENTRY_POINT, total_s, len(timings)))
+  for name, (self_us, cumulative_us) in sorted(timings.items(), key=lambda item: -item[1][1])[:args.top]:
+    print("  %9.3f s cumulative %9.3f s self  %s" % (cumulative_us * 1e-6, self_us * 1e-6, name))
+  eager = eager_imports(timings)
+
+  if args.record is not None:
+    with open(args.record, "w") as fout:
+      json.dump(dict(total_s=total_s, modules=len(timings), eager=eager,
+                     python=platform.python_version(), machine=platform.machine(),
+                     module_names=sorted(timings)), fout, indent=2)
+    print("Recorded baseline in", args.record)
+  if args.check is not None:
+    with open(args.check) as fin:
+      baseline = json.load(fin)
+    print("baseline %.3f s, %d modules; now %.3f s, %d modules" % (
+          baseline["total_s"], baseline["modules"], total_s, len(timings)))
+    for name in sorted(set(timings) - set(baseline["module_names"])):
+      print("new import not in the baseline", name)
+    regressed = args.tolerance is not None and total_s > args.tolerance * baseline["total_s"]
+    if regressed:
+      print("REGRESSION: import time exceeds %.2f x baseline" % args.tolerance)
+    return 1 if (regressed or eager) else 0
+  return 1 if eager else 0
+
+
+if __name__ == "__main__":
+  parser = ArgumentParser()
+  parser.add_argument("--deferred", action="store_true", help="only check that no deferred module is imported, without timings")
+  parser.add_argument("--record", default=None, help="write the current numbers to this json file")
+  parser.add_argument("--check", default=None, help="compare against the numbers in this json file, recorded on the same machine")
+  parser.add_argument("--tolerance", type=float, default=None,
+                      help="if given, also fail when the import time exceeds this ratio to the baseline; timings depend on the machine")
+  parser.add_argument("--top", type=int, default=15, help="number of slowest imports to list")
+  sys.exit(run(parser.parse_args()))
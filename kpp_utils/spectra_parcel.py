@@ -0,0 +1,67 @@
+from __future__ import division, print_function
+import numpy as np
+from scitbx.array_family import flex
+
+"""
+Spectrum preprocessing for a parcel of images. The LS49 generator still
+produces one image's spectrum per call, already recast onto the
+spectrum.nchannels grid; these are stacked into (n_images, nchannels)
+arrays, and the channels carrying less than spectrum.min_flux_fraction of an
+image's total flux are zeroed in one vectorized step. The kept channels are
+scaled so that each image keeps its total flux. The inner channel loops of
+run_sim2smv and run_sim2h5 then only launch the significant channels, see
+significant_channels().
+"""
+
+
+def significant_channels(flux, params):
+  """Channel indices to simulate; every channel unless min_flux_fraction is set"""
+  if params.spectrum.min_flux_fraction <= 0:
+    return range(len(flux))
+  return [x for x in range(len(flux)) if flux[x] > 0]
+
+
+class parcel_spectra(object):
+  def __init__(self, spectra, image_indices, params):
+    self.image_indices = list(image_indices)
+    wavlen, flux, mean_wavelength = [], [], []
+    for idx in self.image_indices:
+      w, f, m = next(spectra.generate_recast_renormalized_image_parameterized(image=idx%100000, params=params))
+      wavlen.append(np.asarray(w))
+      flux.append(np.asarray(f))
+      mean_wavelength.append(m)
+    self.wavlen = np.array(wavlen)
+    self.flux = np.array(flux)
+    self.mean_wavelength = np.array(mean_wavelength)
+    fraction = params.spectrum.min_flux_fraction
+    if fraction > 0:
+      total = self.flux.sum(axis=1, keepdims=True)
+      self.keep = self.flux >= fraction * total
+      kept = np.where(self.keep, self.flux, 0.)
+      kept_total = kept.sum(axis=1, keepdims=True)
+      self.flux = kept * np.divide(total, kept_total, out=np.ones_like(total), where=kept_total > 0)
+    else:
+      self.keep = np.ones(self.flux.shape, dtype=bool)
+    self.skipped = (~self.keep).sum(axis=1)
+
+  def __iter__(self):
+    """Yield image index, spectrum iterator as expected by run_sim2smv/run_sim2h5, skipped channels"""
+    for i, idx in enumerate(self.image_indices):
+      spectrum = (flex.double(self.wavlen[i]), flex.double(self.flux[i]), float(self.mean_wavelength[i]))
+      yield idx, iter([spectrum]), int(self.skipped[i])
+
+
+def preprocessed_spectra(spectra, parcels, params, chunk_size):
+  """Preprocess the image indices of `parcels` in chunks of `chunk_size`. With a
+  dynamic scheduler, chunk_size should not exceed the claimed batch size, since
+  reading ahead claims images early."""
+  chunk = []
+  for idx in parcels:
+    chunk.append(idx)
+    if len(chunk) == chunk_size:
+      for item in parcel_spectra(spectra, chunk, params):
+        yield item
+      chunk = []
+  if chunk:
+    for item in parcel_spectra(spectra, chunk, params):
+      yield item
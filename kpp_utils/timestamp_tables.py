@@ -0,0 +1,189 @@
+from __future__ import division, print_function
+from argparse import ArgumentParser
+import re
+
+import numpy as np
+
+"""
+Flat HDF5 layout of the diffBragg stage 2 phase timings. Every phase (startup,
+setup, iterations, update_Fcell, shots...) is one table of four extendable
+columns with one row per start/end interval:
+  /<phase>/rank     int32
+  /<phase>/shot_id  int64, -1 except for phase "shots"
+  /<phase>/start    float64 epoch seconds, nan if the interval never started
+  /<phase>/end      float64 epoch seconds, nan if the interval never ended
+sorted by rank (then shot), intervals in log order, plus table /nodes
+(rank, node) with the node name of every rank. A whole phase is read back
+with one slice per column, instead of walking one group per rank and one
+dataset per shot as in the older nested layout
+  /<rank>/<phase>/start|end, /<rank>/shots/<id>/start|end, attr node,
+which convert_nested() translates into this one. Example usage:
+  libtbx.python timestamp_tables.py old_timestamps.h5 timestamps.h5
+"""
+
+LAYOUT_VERSION = 2
+COLUMNS = ("rank", "shot_id", "start", "end")
+NO_SHOT = -1
+
+# phase: (event starting it, event ending it), see EVENT_RULES in log_index.py
+PHASES = {"startup": ("read_input_pickle", "launch_setup_done"),
+          "refinement": ("launcher_setup", "launcher_setup_done"),
+          "prep_dataframe": ("prep_dataframe_begin", "prep_dataframe_done"),
+          "from_json_file": ("experiment_list_begin", "experiment_list_done"),
+          "GatherFromExperiment": ("roi_data_begin", "roi_data_done"),
+          "MPI_barrier_startup": ("barrier_startup_enter", "barrier_startup_exit"),
+          "gather_Hi_info": ("hkl_info_begin", "hkl_info_done"),
+          "setup": ("setup_begin", "setup_end"),
+          "iterations": ("func_grad_begin", "func_grad_done"),
+          "update_Fcell": ("update_fcell_begin", "update_fcell_done"),
+          "MPI_barrier_iterations": ("shots_worked", "mpi_aggregation_begin"),
+          "MPI_aggregation": ("mpi_aggregation_begin", "mpi_aggregation_done")}
+SHOT_EVENTS = ("shot_begin", "shot_finished")
+TIMED_EVENT = "shots_worked"
+
+
+def empty_table():
+  return dict(rank=np.zeros(0, dtype=np.int32), shot_id=np.zeros(0, dtype=np.int64),
+              start=np.zeros(0), end=np.zeros(0))
+
+
+def pair_intervals(start_keys, start_times, end_keys, end_times):
+  """Table pairing the k-th start with the k-th end of every (rank, shot_id)
+  key, keys given as (n, 2) int64 arrays; unmatched ends are left nan"""
+  keys = np.concatenate([start_keys, end_keys]).reshape(-1, 2)
+  if len(keys) == 0:
+    return empty_table()
+  is_end = np.r_[np.zeros(len(start_keys), dtype=bool), np.ones(len(end_keys), dtype=bool)]
+  order = np.lexsort((is_end, keys[:, 1], keys[:, 0]))  # stable, log order kept within a group
+  sorted_keys = np.column_stack([keys[order], is_end[order]])
+  new_group = np.r_[True, np.any(sorted_keys[1:] != sorted_keys[:-1], axis=1)]
+  group_start = np.flatnonzero(new_group)
+  occurrence = np.empty(len(order), dtype=np.int64)
+  occurrence[order] = np.arange(len(order)) - np.repeat(group_start, np.diff(np.r_[group_start, len(order)]))
+  rows, row_of = np.unique(np.column_stack([keys, occurrence]), axis=0, return_inverse=True)
+  row_of = row_of.reshape(-1)
+  start = np.full(len(rows), np.nan)
+  end = np.full(len(rows), np.nan)
+  start[row_of[~is_end]] = start_times
+  end[row_of[is_end]] = end_times
+  return dict(rank=rows[:, 0].astype(np.int32), shot_id=rows[:, 1], start=start, end=end)
+
+
+def _keys(events, shot_id=None):
+  shots = np.full(len(events), NO_SHOT, dtype=np.int64) if shot_id is None else shot_id
+  return np.column_stack([events["rank"].to_numpy(dtype=np.int64), shots])
+
+
+def phase_tables(events):
+  """Flat phase tables of a log_index event table"""
+  by_event = {name: group for name, group in events.groupby("event", observed=True)}
+  none = events.iloc[:0]
+  tables = {}
+  for phase, (begin, finish) in PHASES.items():
+    b, f = by_event.get(begin, none), by_event.get(finish, none)
+    tables[phase] = pair_intervals(_keys(b), b["timestamp"].to_numpy(),
+                                   _keys(f), f["timestamp"].to_numpy())
+  worked = by_event.get(TIMED_EVENT, none)
+  rank = worked["rank"].to_numpy(dtype=np.int32)
+  shot_id = np.full(len(worked), NO_SHOT, dtype=np.int64)
+  end = worked["timestamp"].to_numpy()
+  order = np.lexsort((shot_id, rank))  # stable, log order kept within a rank
+  tables["add_diffBragg_spots"] = dict(rank=rank[order], shot_id=shot_id[order],
+                                       start=(end - worked["value"].to_numpy())[order], end=end[order])
+  b, f = (by_event.get(name, none) for name in SHOT_EVENTS)
+  tables["shots"] = pair_intervals(
+    _keys(b, b["value"].to_numpy(dtype=np.int64)), b["timestamp"].to_numpy(),
+    _keys(f, f["value"].to_numpy(dtype=np.int64)), f["timestamp"].to_numpy())
+  return tables
+
+
+def rank_nodes(events):
+  """(ranks, nodes): first non-empty node name logged by every rank"""
+  named = events[events["node"] != ""].drop_duplicates("rank")
+  ranks = np.unique(events["rank"].to_numpy())
+  nodes = dict(zip(named["rank"], named["node"].astype(str)))
+  return ranks.astype(np.int32), [nodes.get(r, "") for r in ranks]
+
+
+def _append(group, name, values, dtype):
+  if name not in group:
+    group.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=True)
+  dataset = group[name]
+  start = dataset.shape[0]
+  dataset.resize((start + len(values),))
+  dataset[start:] = values
+
+
+def write_tables(path, tables, ranks, nodes):
+  """Write the phase tables and the node of every rank to `path`"""
+  import h5py
+  with h5py.File(path, "w") as F:
+    F.attrs["layout_version"] = LAYOUT_VERSION
+    for phase, table in tables.items():
+      group = F.require_group(phase)
+      for column in COLUMNS:
+        _append(group, column, table[column], table[column].dtype)
+    group = F.require_group("nodes")
+    _append(group, "rank", np.asarray(ranks, dtype=np.int32), np.int32)
+    _append(group, "node", np.array(nodes, dtype=object), h5py.string_dtype())
+
+
+def read_tables(path, phases=None):
+  """{phase: {column: array}} of a flat timestamps file, and {rank: node}"""
+  import h5py
+  with h5py.File(path, "r") as F:
+    if F.attrs.get("layout_version") != LAYOUT_VERSION:
+      raise ValueError("%s has the nested layout, convert it with timestamp_tables.py" % path)
+    phases = [p for p in F if p != "nodes"] if phases is None else phases
+    tables = {p: {column: F[p][column][()] for column in COLUMNS} for p in phases}
+    nodes = dict(zip(F["nodes/rank"][()].tolist(), F["nodes/node"].asstr()[()]))
+  return tables, nodes
+
+
+def _padded_pair(start, end):
+  n = max(len(start), len(end))
+  padded = np.full((2, n), np.nan)
+  padded[0, :len(start)] = start
+  padded[1, :len(end)] = end
+  return padded
+
+
+def convert_nested(nested_path, flat_path):
+  """Translate a nested-layout timestamps file into the flat layout"""
+  import h5py
+  rows = {}
+  ranks, nodes = [], []
+  with h5py.File(nested_path, "r") as F:
+    for name in F:
+      rank = int(re.search(r"(\d+)$", name).group(1))
+      ranks.append(rank)
+      nodes.append(str(F[name].attrs.get("node", "")))
+      for phase in F[name]:
+        if phase == "shots":
+          items = [(int(shot), F[name]["shots"][shot]) for shot in F[name]["shots"]]
+        else:
+          items = [(NO_SHOT, F[name][phase])]
+        for shot_id, group in items:
+          pair = _padded_pair(group["start"][()], group["end"][()])
+          rows.setdefault(phase, []).append((rank, shot_id, pair))
+  tables = {}
+  for phase, phase_rows in rows.items():
+    lengths = [pair.shape[1] for _, _, pair in phase_rows]
+    tables[phase] = dict(
+      rank=np.repeat([r for r, _, _ in phase_rows], lengths).astype(np.int32),
+      shot_id=np.repeat([s for _, s, _ in phase_rows], lengths).astype(np.int64),
+      start=np.concatenate([pair[0] for _, _, pair in phase_rows]),
+      end=np.concatenate([pair[1] for _, _, pair in phase_rows]))
+    order = np.lexsort((tables[phase]["shot_id"], tables[phase]["rank"]))
+    tables[phase] = {column: values[order] for column, values in tables[phase].items()}
+  order = np.argsort(ranks)
+  write_tables(flat_path, tables, np.array(ranks)[order], [nodes[i] for i in order])
+
+
+if __name__ == "__main__":
+  parser = ArgumentParser()
+  parser.add_argument("nested", help="timestamps.h5 with one group per rank")
+  parser.add_argument("flat", help="path of the converted file")
+  args = parser.parse_args()
+  convert_nested(args.nested, args.flat)
+  print("Converted %s into %s" % (args.nested, args.flat))
@@ -0,0 +1,262 @@
+from __future__ import division, print_function
+from argparse import ArgumentParser
+import glob
+import json
+import os
+import time
+
+import numpy as np
+
+from exafel_project.kpp_utils.log_index import RANK_FILENAME, parse_debug_line, parse_line
+
+"""
+Live computational weather: follow the per-rank logs of a running job and
+keep a rolling summary of its progress, instead of parsing the finished logs
+as kpp-sim/weather.py and analyze_computational_performance.py do.
+
+Every interval, only the complete lines appended to each log since the last
+update are read, starting from the byte offset saved for that file. Rank
+logs of the simulation (rank_N.log, "idx------finis-------->" lines) and xfel
+debug files (debug_N.txt, status "stop"/"done" lines) are understood. The
+summary holds the throughput (images/s) over the last window and since the
+first image, the idle time of ranks between images, and the stragglers:
+ranks that have been silent for more than straggler_factor times the median
+time per image while other ranks finished images. Ranks that are done, whose
+last debug status was stop/done or that printed their final elapsed times,
+are not stragglers. It is rewritten atomically, so a
+human or a scheduler can poll it. The byte offsets and per-rank statistics
+are checkpointed after every update, and a restarted monitor resumes from
+the checkpoint instead of re-reading the logs.
+Example usage, while the job runs:
+  libtbx.python weather_monitor.py "$SCRATCH/$JOBID/rank_*.log" --interval 30 --summary weather_summary.json
+"""
+
+CHECKPOINT_VERSION = 1
+DONE_STATUS = ("stop", "done")
+START_STEP = "start"
+# events printed by a simulation rank once it has no more images
+FINAL_EVENTS = ("srun_elapsed", "python_elapsed")
+
+
+def write_json_atomic(path, content):
+  tmp_path = path + ".tmp"
+  with open(tmp_path, "w") as F:
+    json.dump(content, F, indent=1)
+  os.replace(tmp_path, path)
+
+
+def read_new_lines(path, offset):
+  """Complete lines appended to `path` since byte `offset` and the offset
+  after them; a file shorter than `offset` was rewritten and is re-read"""
+  size = os.path.getsize(path)
+  if size < offset:
+    offset = 0
+  if size == offset:
+    return [], offset
+  with open(path, "rb") as F:
+    F.seek(offset)
+    data = F.read(size - offset)
+  end = data.rfind(b"\n") + 1  # an unterminated last line is read next time
+  return data[:end].decode("utf-8", errors="replace").splitlines(), offset + end
+
+
+class RankState(object):
+  """Running statistics of one rank"""
+  FIELDS = ("images", "first_start", "last_finish", "last_seen", "busy", "idle", "max_idle", "pending_start",
+            "done")
+
+  def __init__(self, **kwargs):
+    self.images = 0
+    self.busy = self.idle = self.max_idle = 0.
+    self.first_start = self.last_finish = self.last_seen = self.pending_start = None
+    self.done = False  # not working on an image, as far as the logs tell
+    for key, value in kwargs.items():
+      setattr(self, key, value)
+
+  def to_dict(self):
+    return {key: getattr(self, key) for key in self.FIELDS}
+
+  def seen(self, timestamp):
+    if self.last_seen is None or timestamp > self.last_seen:
+      self.last_seen = timestamp
+
+  def image(self, start, finish):
+    if self.last_finish is None:
+      self.first_start = start
+    elif start > self.last_finish:
+      gap = start - self.last_finish
+      self.idle += gap
+      self.max_idle = max(self.max_idle, gap)
+    self.images += 1
+    self.busy += finish - start
+    self.last_finish = finish if self.last_finish is None else max(self.last_finish, finish)
+    self.pending_start = None
+    self.seen(finish)
+
+
+class WeatherMonitor(object):
+  def __init__(self, patterns, summary_path, checkpoint_path=None, window=60.,
+               straggler_factor=3., max_stragglers=20):
+    self.patterns = patterns
+    self.summary_path = summary_path
+    self.checkpoint_path = checkpoint_path if checkpoint_path else summary_path + ".checkpoint"
+    self.window = window
+    self.straggler_factor = straggler_factor
+    self.max_stragglers = max_stragglers
+    self.offsets = {}
+    self.ranks = {}
+    self.recent = []  # finish times of the images in the last window
+    if os.path.isfile(self.checkpoint_path):
+      self.load_checkpoint()
+
+  def load_checkpoint(self):
+    with open(self.checkpoint_path) as F:
+      checkpoint = json.load(F)
+    if checkpoint.get("version") != CHECKPOINT_VERSION:
+      return
+    self.offsets = checkpoint["offsets"]
+    self.ranks = {int(rank): RankState(**state) for rank, state in checkpoint["ranks"].items()}
+    self.recent = checkpoint["recent"]
+    print("Resuming from %s: %d files, %d images" % (
+      self.checkpoint_path, len(self.offsets), sum(s.images for s in self.ranks.values())))
+
+  def save_checkpoint(self):
+    write_json_atomic(self.checkpoint_path, dict(
+      version=CHECKPOINT_VERSION, offsets=self.offsets, recent=self.recent,
+      ranks={str(rank): state.to_dict() for rank, state in self.ranks.items()}))
+
+  def rank_state(self, rank):
+    if rank not in self.ranks:
+      self.ranks[rank] = RankState()
+    return self.ranks[rank]
+
+  def image(self, state, start, finish):
+    state.image(start, finish)
+    self.recent.append(finish)
+
+  def consume(self, path, lines):
+    m = RANK_FILENAME.search(os.path.basename(path))
+    file_rank = int(m.group(1)) if m else -1
+    if path.endswith(".txt"):
+      state = self.rank_state(file_rank)
+      for line in lines:
+        parsed = parse_debug_line(line)
+        if parsed is None:
+          continue
+        hostname, timestamp, status, step = parsed
+        if step == START_STEP:
+          state.pending_start = timestamp
+        if status in DONE_STATUS:
+          start = state.pending_start if state.pending_start is not None else \
+            (state.last_finish if state.last_finish is not None else timestamp)
+          self.image(state, start, timestamp)
+        else:
+          state.seen(timestamp)
+        state.done = status in DONE_STATUS
+      return
+    for line in lines:
+      parsed = parse_line(line, file_rank)
+      if parsed is None:
+        continue
+      rank, node, timestamp, event, value = parsed
+      if np.isnan(timestamp):
+        continue
+      state = self.rank_state(rank)
+      if event == "image_finished":
+        self.image(state, timestamp - value, timestamp)
+      else:
+        state.seen(timestamp)
+      state.done = event in FINAL_EVENTS
+
+  def update(self):
+    """Read what was appended to the logs; return the number of new lines"""
+    paths = sorted(set(p for pattern in self.patterns for p in glob.glob(pattern)))
+    n_lines = 0
+    for path in paths:
+      lines, self.offsets[path] = read_new_lines(path, self.offsets.get(path, 0))
+      self.consume(path, lines)
+      n_lines += len(lines)
+    latest = self.latest()
+    if latest is not None:
+      self.recent = [t for t in self.recent if t > latest - self.window]
+    self.save_checkpoint()
+    return n_lines
+
+  def latest(self):
+    seen = [s.last_seen for s in self.ranks.values() if s.last_seen is not None]
+    return max(seen) if seen else None
+
+  def summary(self):
+    latest = self.latest()
+    working = [s for s in self.ranks.values() if s.images]
+    images = sum(s.images for s in working)
+    summary = dict(updated=time.time(), latest_event=latest, files=len(self.offsets),
+                   ranks=len(self.ranks), images=images, window=self.window,
+                   throughput_window=len(self.recent) / self.window,
+                   throughput_overall=None, median_image_time=None, idle_fraction=None,
+                   max_idle=None, stragglers=[])
+    if not working:
+      return summary
+    first = min(s.first_start for s in working)
+    if latest > first:
+      summary["throughput_overall"] = images / (latest - first)
+    spans = sum(s.last_finish - s.first_start for s in working)
+    summary["idle_fraction"] = sum(s.idle for s in working) / spans if spans > 0 else 0.
+    summary["max_idle"] = max(s.max_idle for s in working)
+    image_time = float(np.median([s.busy / s.images for s in working]))
+    summary["median_image_time"] = image_time
+    # a rank only straggles if other ranks finished images after it was last seen
+    finishes = sorted(((s.last_finish, rank) for rank, s in self.ranks.items()
+                       if s.last_finish is not None), reverse=True)[:2]
+    def others_progressed(rank, s):
+      others = [finish for finish, other in finishes if other != rank]
+      return bool(others) and others[0] > s.last_seen
+    silent = sorted(((latest - s.last_seen, rank, s) for rank, s in self.ranks.items()
+                     if s.last_seen is not None and not s.done), key=lambda x: -x[0])
+    summary["stragglers"] = [dict(rank=rank, silent=quiet, images=s.images)
+                             for quiet, rank, s in silent
+                             if quiet > self.straggler_factor * image_time and
+                             others_progressed(rank, s)][:self.max_stragglers]
+    return summary
+
+  def write_summary(self):
+    summary = self.summary()
+    write_json_atomic(self.summary_path, summary)
+    return summary
+
+  def run(self, interval=30., max_updates=None, stop_after=None):
+    """Update every `interval` seconds, until `max_updates` updates were made
+    or no log grew for `stop_after` seconds"""
+    updates = 0
+    last_growth = time.time()
+    while True:
+      if self.update():
+        last_growth = time.time()
+      s = self.write_summary()
+      updates += 1
+      print("%s %d images on %d ranks, %.2f images/s over %d s, %d stragglers" % (
+        time.strftime("%H:%M:%S"), s["images"], s["ranks"], s["throughput_window"],
+        self.window, len(s["stragglers"])), flush=True)
+      if max_updates is not None and updates >= max_updates:
+        break
+      if stop_after is not None and time.time() - last_growth > stop_after:
+        break
+      time.sleep(interval)
+    return s
+
+
+if __name__ == "__main__":
+  parser = ArgumentParser()
+  parser.add_argument("patterns", nargs="+", help="glob patterns of the rank logs, e.g. 'rank_*.log'")
+  parser.add_argument("--summary", default="weather_summary.json", help="rolling summary file")
+  parser.add_argument("--checkpoint", default=None, help="checkpoint file, default next to the summary")
+  parser.add_argument("--interval", type=float, default=30., help="seconds between updates")
+  parser.add_argument("--window", type=float, default=60., help="seconds of the throughput window")
+  parser.add_argument("--straggler_factor", type=float, default=3.,
+                      help="silence, in median times per image, flagging a rank as straggler")
+  parser.add_argument("--max_updates", type=int, default=None, help="stop after this many updates")
+  parser.add_argument("--stop_after", type=float, default=None, help="stop when no log grew for this many seconds")
+  args = parser.parse_args()
+  monitor = WeatherMonitor(args.patterns, args.summary, args.checkpoint, window=args.window,
+                           straggler_factor=args.straggler_factor)
+  monitor.run(interval=args.interval, max_updates=args.max_updates, stop_after=args.stop_after)
@@ -10,8 +10,10 @@ import os
 from copy import deepcopy
 from dxtbx.model import ExperimentList
 
-import h5py
 from simtbx.diffBragg import utils
+from exafel_project.kpp_eval.ground_truth_index import GroundTruthIndex
+from exafel_project.kpp_eval.streaming_stats import Histogram, Moments, tree_reduce
+from exafel_project.kpp_eval.stage1_store import default_store_path, read_stage1_store, refresh_stage1_store, stage1_store_length
 
 from argparse import ArgumentParser
 parser = ArgumentParser()
@@ -21,6 +23,11 @@ parser.add_argument("--figname", type=str, default=None, help="If provided, will
 parser.add_argument("--nbins", default=70, type=int, help="Number of histogram bins")
 parser.add_argument("--logbins", action="store_true", help="whether to use log-spaced bins for the histogram")
 parser.add_argument("--noDisplay", action="store_true", help="whether to use plt.show()")
+parser.add_argument("--gt_index", type=str, default=None, help="ground-truth index written by kpp_eval/ground_truth_index.py. If not provided, each simulated image file is read once per rank.")
+parser.add_argument("--quantile_bins", default=16384, type=int, help="Number of histogram bins used to approximate medians. The bin holding the median is then binned again --median_passes times with as many bins, so the error is at most (max-min)/quantile_bins**(1+median_passes)")
+parser.add_argument("--median_passes", default=1, type=int, help="Number of passes re-binning the histogram bin holding each median")
+parser.add_argument("--store", type=str, default=None, help="stage 1 HDF5 store written by kpp_eval/stage1_store.py. If not provided, dirname/stage1_store.h5 is used when present, otherwise the rank pickles are read. If rank pickles of dirname were added or changed since the store was written, the rank pickles are read instead, unless --update_store is given.")
+parser.add_argument("--update_store", action="store_true", help="ingest the rank pickles of dirname added or changed since the store was written into it before reading it")
 args = parser.parse_args()
 
 stage1_dir = args.dirname
@@ -32,18 +39,39 @@ def print0(*args, **kwargs):
 
 import glob
 cols = ["exp_name", "exp_idx", "ncells", "Amats", "a", "b", "c", "al", "be", "ga", "eta_abc", "eta", "sigz", "niter", "spot_scales", "spot_scales_init"]
-pkls = glob.glob(os.path.join(stage1_dir, "pandas/hopper*rank*pkl"))
-if not pkls:
-    print("No input files found, check stage1 dir")
-    exit()
-
+store = args.store if args.store is not None else default_store_path(stage1_dir)
 dfs = []
-for i_f, f in enumerate(pkls):
-    if i_f % COMM.size != COMM.rank:
-        continue
-    print0("Loaded %d / %d pickles" %(i_f+1, len(pkls)), end="\r", flush=True)
-    df = pandas.read_pickle(f)[cols]
-    dfs.append(df)
+use_store = False
+if os.path.exists(store):
+    # rank 0 checks the store (re-ingesting rank pickles that changed since it
+    # was written if --update_store) and always reaches the bcast
+    use_store = False
+    if COMM.rank == 0:
+        try:
+            use_store = refresh_stage1_store(stage1_dir, store, update=args.update_store)
+        except Exception as e:
+            print("WARNING: could not check %s (%s), reading the rank pickles" % (store, e))
+    use_store = COMM.bcast(use_store)
+if use_store:
+    # each rank reads its own block of rows, and only the columns used here
+    nrows = stage1_store_length(store)
+    rows = slice(nrows * COMM.rank // COMM.size, nrows * (COMM.rank+1) // COMM.size)
+    print0("Reading %d rows from %s" % (nrows, store))
+    df = read_stage1_store(store, cols, rows=rows)
+    if len(df):
+        dfs.append(df)
+else:
+    pkls = glob.glob(os.path.join(stage1_dir, "pandas/hopper*rank*pkl"))
+    if not pkls:
+        print("No input files found, check stage1 dir")
+        exit()
+
+    for i_f, f in enumerate(pkls):
+        if i_f % COMM.size != COMM.rank:
+            continue
+        print0("Loaded %d / %d pickles" %(i_f+1, len(pkls)), end="\r", flush=True)
+        df = pandas.read_pickle(f)[cols]
+        dfs.append(df)
 
 angles = []
 angles_dials = []
@@ -54,97 +82,145 @@ sigzs = []
 tdata = []
 
 df = None
+n_expt_lists_read = 0
+gt_files_read = 0
 if dfs:
     df = pandas.concat(dfs).reset_index(drop=True)
     gt_ncells = None
-    for i_df, (e, i_exp, A, ncells, etas, sigz) in enumerate(zip(df.exp_name, df.exp_idx, df.Amats, df.ncells, df.eta_abc, df.sigz)):
-        expt = ExperimentList.from_file(e, False)[i_exp]
-        C = expt.crystal
-        C_dials = deepcopy(C)
-        C.set_A(tuple(A))
-
-        h5 = expt.imageset.get_path(0)
-        h5_idx = expt.imageset.indices()[0]
-        gt_amat = h5py.File(h5, 'r')['model/Umatrix_rot'][h5_idx]
-        if gt_ncells is None:
-            gt_ncells = h5py.File(h5, 'r')['model/Ncells_abc'][h5_idx]
-        Cgt = deepcopy(C)
-        Cgt.set_U(tuple(gt_amat.ravel()))
-        a, b, c = Cgt.get_real_space_vectors()
-        symbol = args.symbol
-        if args.symbol is None:
-            symbol = C.get_space_group().info().type().lookup_symbol()
-        try:
-            ang = utils.compare_with_ground_truth(a, b, c, [C], symbol=symbol)[0]
-            ang_dials = utils.compare_with_ground_truth(a, b, c, [C_dials], symbol=symbol)[0]
-        except:
-            continue
-        refined_ucells.append(C.get_unit_cell().parameters() )
-        angles.append(ang)
-        angles_dials.append(ang_dials)
-        ucell_s = ",".join(["%.3f" %u for u in refined_ucells[-1]])
-        nabc_s = ",".join(["%.1f"%n for n in ncells])
-        print("missori=%.5f -> %.5f deg.; ucell=[%s]; nabc=[%s] (shot %d / %d)" % (ang_dials, ang, ucell_s, nabc_s, i_df, len(df)))
-        tdata.append(" ".join(["%.6f"%u for u in refined_ucells[-1]]) + " %s"%("".join(symbol.split())))
-        refined_ncells.append( ncells)
-        refined_etas.append(etas)
-        sigzs.append(sigz)
-
-angles = COMM.reduce(angles)
-angles_dials = COMM.reduce(angles_dials)
-refined_ncells = COMM.reduce(refined_ncells)
-refined_etas = COMM.reduce(refined_etas)
-refined_ucells = COMM.reduce(refined_ucells)
-sigzs = COMM.reduce(sigzs)
-tdata = COMM.reduce(tdata)
-all_df = COMM.gather(df)
+    gt_index = GroundTruthIndex.from_file(args.gt_index) if args.gt_index else GroundTruthIndex()
+    # group the shots by experiment list, so that each expt (and image) file is opened once
+    for e, df_e in df.groupby("exp_name", sort=False):
+        expts = ExperimentList.from_file(e, False)
+        n_expt_lists_read += 1
+        for i_df, i_exp, A, ncells, etas, sigz in zip(df_e.index, df_e.exp_idx, df_e.Amats, df_e.ncells, df_e.eta_abc, df_e.sigz):
+            expt = expts[i_exp]
+            C = deepcopy(expt.crystal)
+            C_dials = deepcopy(C)
+            C.set_A(tuple(A))
+
+            h5 = expt.imageset.get_path(0)
+            h5_idx = expt.imageset.indices()[0]
+            gt_amat, gt_ncells_shot = gt_index.lookup(h5, h5_idx)
+            if gt_ncells is None:
+                gt_ncells = gt_ncells_shot
+            Cgt = deepcopy(C)
+            Cgt.set_U(tuple(gt_amat.ravel()))
+            a, b, c = Cgt.get_real_space_vectors()
+            symbol = args.symbol
+            if args.symbol is None:
+                symbol = C.get_space_group().info().type().lookup_symbol()
+            try:
+                ang = utils.compare_with_ground_truth(a, b, c, [C], symbol=symbol)[0]
+                ang_dials = utils.compare_with_ground_truth(a, b, c, [C_dials], symbol=symbol)[0]
+            except:
+                continue
+            refined_ucells.append(C.get_unit_cell().parameters() )
+            angles.append(ang)
+            angles_dials.append(ang_dials)
+            ucell_s = ",".join(["%.3f" %u for u in refined_ucells[-1]])
+            nabc_s = ",".join(["%.1f"%n for n in ncells])
+            print("missori=%.5f -> %.5f deg.; ucell=[%s]; nabc=[%s] (shot %d / %d)" % (ang_dials, ang, ucell_s, nabc_s, i_df, len(df)))
+            tdata.append(" ".join(["%.6f"%u for u in refined_ucells[-1]]) + " %s"%("".join(symbol.split())))
+            refined_ncells.append( ncells)
+            refined_etas.append(etas)
+            sigzs.append(sigz)
+    gt_files_read = gt_index.files_read
 
+# SUMMARIZE: each rank summarizes its own shots, and the summaries are merged along a
+# binomial tree, so rank 0 never holds the raw values of all shots
+n_expt_lists_read = COMM.reduce(n_expt_lists_read)
+gt_files_read = COMM.reduce(gt_files_read)
+print0("Opened %d expt files and %d image files for ground truth" % (n_expt_lists_read, gt_files_read))
+gt_ncells = next((n for n in COMM.allgather(gt_ncells if dfs else None) if n is not None), None)
+
+spot_scales = df.spot_scales.values if df is not None else []
+spot_scales_init = df.spot_scales_init.values if df is not None else []
+values = {"angles": angles, "angles_dials": angles_dials, "ucells": refined_ucells,
+          "ncells": refined_ncells, "etas": refined_etas, "sigz": sigzs,
+          "spot_scales": spot_scales, "spot_scales_init": spot_scales_init}
+widths = {"ucells": 6, "ncells": 3, "etas": 3}
+moments = tree_reduce(COMM, {k: Moments.from_values(v, widths.get(k, 1)) for k, v in values.items()})
+moments = COMM.bcast(moments)
+if moments["angles"].n == 0:
+    print0("No shots could be compared to ground truth")
+    exit()
+quantile_keys = ["angles", "angles_dials", "ucells", "ncells", "etas", "sigz", "spot_scales"]
+histograms = tree_reduce(COMM, {k: Histogram.from_moments(values[k], moments[k], args.quantile_bins)
+                                for k in quantile_keys})
+# further passes over the bin holding each median, so that outliers stretching
+# the (min, max) range do not cost median precision
+for _ in range(args.median_passes):
+    median_edges = COMM.bcast({k: histograms[k].refined_edges(0.5) for k in quantile_keys}
+                              if COMM.rank == 0 else None)
+    histograms = tree_reduce(COMM, {k: Histogram.from_values(values[k], median_edges[k])
+                                    for k in quantile_keys})
+
+# histograms for the plots, over the global range of the data
+all_ang_min = min(moments["angles"].min[0], moments["angles_dials"].min[0])
+all_ang_max = max(moments["angles"].max[0], moments["angles_dials"].max[0])
+if args.logbins:
+    bins = np.logspace(np.log10(all_ang_min), np.log10(all_ang_max), args.nbins)
+else:
+    bins = np.linspace(0, all_ang_max, args.nbins)
+plot_histograms = tree_reduce(COMM, {
+    "angles": Histogram.from_values(angles, bins),
+    "angles_dials": Histogram.from_values(angles_dials, bins),
+    "sigz": Histogram.from_moments(sigzs, moments["sigz"], args.nbins)})
+
+#handle tdata, written on rank 0 one rank at a time
+tdata_file = os.path.join(os.getcwd(),"tdata_cells_stg1.tdata")
 if COMM.rank==0:
-    all_df = pandas.concat([df for df in all_df if df is not None])
-    #handle tdata
-    tdata_file = os.path.join(os.getcwd(),"tdata_cells_stg1.tdata")
-    mycluster = "uc_metrics.dbscan file_name=%s space_group=Pmmm eps=0.02 feature_vector=a,b,c write_covariance=False plot.outliers=False"%tdata_file
     with open(tdata_file,"w") as F:
-      F.write("\n".join(tdata))
-      print("Plot unit cell distribution with\n%s"%mycluster)
+        for rank in range(COMM.size):
+            lines = tdata if rank == 0 else COMM.recv(source=rank)
+            F.writelines(line + "\n" for line in lines)
+else:
+    COMM.send(tdata, dest=0)
 
-    # PRINT RESULTS
+if COMM.rank==0:
+    mycluster = "uc_metrics.dbscan file_name=%s space_group=Pmmm eps=0.02 feature_vector=a,b,c write_covariance=False plot.outliers=False"%tdata_file
+    print("Plot unit cell distribution with\n%s"%mycluster)
 
-    med_d = np.median(angles_dials)
-    mn_d = np.mean(angles_dials)
-    sig_d = np.std(angles_dials)
-    med = np.median(angles)
-    mn = np.mean(angles)
-    sig = np.std(angles)
+    # PRINT RESULTS
+    M = moments
+    H = histograms
+    med_d = H["angles_dials"].median()[0]
+    mn_d = M["angles_dials"].mean[0]
+    sig_d = M["angles_dials"].std[0]
+    med = H["angles"].median()[0]
+    mn = M["angles"].mean[0]
+    sig = M["angles"].std[0]
     print("\nRESULTS\n><><><><><><><><><><><>")
     print("Init misori: Median, Mean, Stdev = %.4f , %.4f %.4f (degrees)" %(med_d, mn_d, sig_d))
     print("Final misori: Median, Mean, Stdev = %.4f , %.4f %.4f (degrees)" %(med, mn, sig))
 
     from scipy.stats import rayleigh
-    assert(np.min(angles_dials) >= 0.)
-    param_angles_dials = rayleigh.fit(angles_dials, floc=0.) # distribution fitting
-    assert(np.min(angles) >= 0.)
-    param_angles_stge1 = rayleigh.fit(angles, floc=0., method="MM")
+    # Rayleigh fits with loc fixed at 0 depend on the moments only:
+    # maximum likelihood scale**2 = <x**2>/2, method of moments scale = <x>/sqrt(pi/2)
+    assert(M["angles_dials"].min[0] >= 0.)
+    param_angles_dials = (0., np.sqrt(M["angles_dials"].mean_square[0] / 2.))
+    assert(M["angles"].min[0] >= 0.)
+    param_angles_stge1 = (0., M["angles"].mean[0] / np.sqrt(np.pi / 2.))
     print("Init misori: Rayleigh scale, Max = %.4f , %.4f (degrees)" %
-                          (param_angles_dials[1],np.max(angles_dials)))
+                          (param_angles_dials[1],M["angles_dials"].max[0]))
     print("Final misori:Rayleigh scale, Max = %.4f , %.4f (degrees)" %
-                          (param_angles_stge1[1],np.max(angles)))
+                          (param_angles_stge1[1],M["angles"].max[0]))
     print("\nUnit cell stats:")
     labels = ["a", "b","c", "al", "be", "ga"]
-    uc_mins = np.min(refined_ucells, axis=0)
-    uc_maxs = np.max(refined_ucells, axis=0)
-    uc_meds = np.median(refined_ucells, axis=0)
-    uc_mns= np.median(refined_ucells, axis=0)
-    uc_sigs = np.std(refined_ucells, axis=0)
+    uc_mins = M["ucells"].min
+    uc_maxs = M["ucells"].max
+    uc_meds = H["ucells"].median()
+    uc_mns= M["ucells"].mean
+    uc_sigs = M["ucells"].std
     units = ["Ang"]*3 + ["deg."]*3
     for name, minu, maxu, med, mn, sig, unit in zip(labels, uc_mins, uc_maxs, uc_meds, uc_mns, uc_sigs, units):
         print("%2s: Min-Max, Median, Mean, Stdev = %8.4f-%8.4f, %8.4f , %8.4f %8.4f (%s)" %(name, minu, maxu, med, mn, sig, unit))
 
     print("\nNcells_abc stats:")
     labels = ["Na", "Nb", "Nc"]
-    N_meds = np.median(refined_ncells, axis=0)
-    N_mns= np.median(refined_ncells, axis=0)
-    N_sigs = np.std(refined_ncells, axis=0)
+    N_meds = H["ncells"].median()
+    N_mns= M["ncells"].mean
+    N_sigs = M["ncells"].std
     for name, med, mn, sig  in zip(labels, N_meds, N_mns, N_sigs):
         print("%s: Median, Mean, Stdev = %.4f , %.4f %.4f (unit cells)" %(name, med, mn, sig))
     print("Ground truth Ncells_abc=", gt_ncells)
@@ -152,45 +228,37 @@ if COMM.rank==0:
 
     print("\n<Eta_abc>:")
     labels = ["eta_a", "eta_b", "eta_c"]
-    eta_meds = np.median(refined_etas, axis=0)
-    eta_mns= np.median(refined_etas, axis=0)
-    eta_sigs = np.std(refined_etas, axis=0)
+    eta_meds = H["etas"].median()
+    eta_mns= M["etas"].mean
+    eta_sigs = M["etas"].std
     for name, med, mn, sig  in zip(labels, eta_meds, eta_mns, eta_sigs):
         print("%s: Median, Mean, Stdev = %.4f , %.4f %.4f (unit cells)" %(name, med, mn, sig))
     print("Ground truth Eta_abc=0.05 (is this right?)")
 
     print("\n<SigmaZ>")
-    N_meds = np.median(refined_ncells, axis=0)
-    N_mns= np.median(refined_ncells, axis=0)
-    N_sigs = np.std(refined_ncells, axis=0)
     print("Min - Max, Median Mean = %.4f - %.4f, %.4f %.4f" %(
-        np.min(sigzs), np.max(sigzs), np.median(sigzs), np.mean(sigzs)))
+        M["sigz"].min[0], M["sigz"].max[0], H["sigz"].median()[0], M["sigz"].mean[0]))
 
     print("\nSpot scales (G):")
-    S = all_df.spot_scales
-    Si = all_df.spot_scales_init
-    print("Init: %.4f"% Si.mean()) #  all the same init
+    S = M["spot_scales"]
+    print("Init: %.4f"% M["spot_scales_init"].mean[0]) #  all the same init
     print("Min - Max, Median, Mean = %.4f - %.4f, %.4f, %.4f"
-          % (S.min(), S.max(), S.median(), S.mean()))
+          % (S.min[0], S.max[0], H["spot_scales"].median()[0], S.mean[0]))
     print("Done.")
 
     # MAKEPLOT
     import pylab as plt
     fig, ax = plt.subplots(1,1)
     fig.set_size_inches((5.5,3))
-    all_ang = np.hstack((angles, angles_dials))
-    if args.logbins:
-        bins = np.logspace(np.log10(all_ang.min()), np.log10(all_ang.max()), args.nbins)
-    else:
-        bins = np.linspace(0, np.max(all_ang), args.nbins)
 
-    med = np.median(angles)
-    med_dials = np.median(angles_dials)
+    med = H["angles"].median()[0]
+    med_dials = H["angles_dials"].median()[0]
     hist_args = {"histtype":"step", "lw":1.5,"alpha":0.8}
-    heights=plt.hist(angles,bins=bins,
+    # draw the reduced bin counts as weights of one point per bin
+    heights=plt.hist(bins[:-1],bins=bins, weights=plot_histograms["angles"].counts[0],
             label="diffBragg, median=%.4f$\degree$" % med,
             **hist_args)[0]
-    heights_dials=plt.hist(angles_dials, bins=bins ,
+    heights_dials=plt.hist(bins[:-1], bins=bins, weights=plot_histograms["angles_dials"].counts[0],
             label="DIALS, median=%.4f$\degree$" % med_dials,
             color='tomato', **hist_args)[0]
 
@@ -212,12 +280,12 @@ if COMM.rank==0:
     fig, ax = plt.subplots(1,1)
     ax.set_xlabel("<$\sigma$Z>")
     ax.set_ylabel("# of images")
-    heights_sigz=plt.hist(sigzs, bins=args.nbins ,
-            label="$\sigma$Z, median=%.4f" % np.median(sigzs),
+    sigz_bins = plot_histograms["sigz"].edges[0]
+    heights_sigz=plt.hist(sigz_bins[:-1], bins=sigz_bins, weights=plot_histograms["sigz"].counts[0],
+            label="$\sigma$Z, median=%.4f" % H["sigz"].median()[0],
             color='tomato')[0]
     plt.legend()
     if args.figname is not None:
         plt.savefig(args.figname+"_sigZ.png", dpi=200)
     if not args.noDisplay:
         plt.show()
-
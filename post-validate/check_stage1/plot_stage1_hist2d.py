@@ -7,6 +7,8 @@ from collections import deque
 import glob
 from itertools import islice
 from numbers import Number
+import os
+import re
 
 from matplotlib.patches import Patch, Rectangle
 import matplotlib.pyplot as plt
@@ -15,6 +17,8 @@ import pandas as pd
 from typing import Generator, List, Sequence, Tuple, TypeVar
 
 from exafel_project.kpp_eval.phil import parse_phil
+from exafel_project.kpp_eval.stage1_store import default_store_path, \
+    read_stage1_store, refresh_stage1_store, stage1_store_columns
 
 
 phil_scope_str = """
@@ -30,6 +34,11 @@ heat = False
 n_bins = None
   .type = int
   .help = Number of bins to group data along x and y. Default log2(len(x)).
+update_store = False
+  .type = bool
+  .help = If True, ingest rank pickles added or changed since the stage 1
+  .help = store was written into it before reading it. Otherwise a stale
+  .help = store is not used and the rank pickles are read instead.
 x {
   key = sigz
     .type = str
@@ -146,14 +155,47 @@ def assert_same_length(*args: Tuple[Sequence]) -> None:
         raise ValueError(f'Iterable input lengths do not match: {lens}')
 
 
-def read_pickled_dataframes(stage1_path: str = '.') -> Stage1Results:
-    pickle_glob = stage1_path + '/**/hopper_results_rank*.pkl'
-    pickle_paths = glob.glob(pickle_glob, recursive=True)
-    stage1_dfs: List[pd.DataFrame] = []
-    for pickle_path in pickle_paths:
-        with open(pickle_path, 'rb') as pickle_file:
-            stage1_dfs.append(pd.read_pickle(pickle_file))
-    df = pd.concat(stage1_dfs, ignore_index=True)
+def required_columns(keys: Sequence[str], available: Sequence[str]) -> List[str]:
+    """Stage 1 columns needed to evaluate `keys`: the (tuple) columns they
+    name, both columns behind every `_dist`, and `exp_name`, `exp_idx`"""
+    required = {'exp_name', 'exp_idx'}
+    for key in keys:
+        for name in re.findall(r'[A-Za-z_]\w*', key):
+            for candidate in (name, name.rstrip('0123456789')):
+                if candidate.endswith('_dist'):
+                    candidate = candidate[:-len('_dist')]
+                    required.update(c for c in (candidate, candidate + '_init')
+                                    if c in available)
+                elif candidate in available:
+                    required.add(candidate)
+    return sorted(required)
+
+
+def read_pickled_dataframes(stage1_path: str = '.',
+                            keys: Sequence[str] = None,
+                            update_store: bool = False) -> Stage1Results:
+    """Read stage 1 results from the `stage1_store` HDF5 store if it is up to
+    date for `stage1_path`, otherwise unpickle every rank file. A stale store
+    is updated first if `update_store`. If `keys` are given, read only the
+    columns needed to evaluate them."""
+    store_path = default_store_path(stage1_path)
+    if os.path.exists(store_path) and \
+            refresh_stage1_store(stage1_path, update=update_store):
+        print(f'Reading stage 1 results from {store_path}')
+        columns = None if keys is None else \
+            required_columns(keys, stage1_store_columns(store_path))
+        df = read_stage1_store(store_path, columns)
+    else:
+        pickle_glob = stage1_path + '/**/hopper_results_rank*.pkl'
+        pickle_paths = glob.glob(pickle_glob, recursive=True)
+        stage1_dfs: List[pd.DataFrame] = []
+        for pickle_path in pickle_paths:
+            with open(pickle_path, 'rb') as pickle_file:
+                stage1_df = pd.read_pickle(pickle_file)
+            if keys is not None:
+                stage1_df = stage1_df[required_columns(keys, stage1_df.columns)]
+            stage1_dfs.append(stage1_df)
+        df = pd.concat(stage1_dfs, ignore_index=True)
     df['exp_name+exp_idx'] = df['exp_name'] + df['exp_idx'].astype(str)
     df.sort_values(by='exp_name+exp_idx', inplace=True)
     return df
@@ -338,18 +380,20 @@ def plot_heatmap(x: pd.Series,
 
 
 @lru_cache(maxsize=5)
-def prepare_dataframe(path: str) -> pd.DataFrame:
-    df = read_pickled_dataframes(path)
+def prepare_dataframe(path: str, keys: Tuple[str] = None,
+                      update_store: bool = False) -> pd.DataFrame:
+    df = read_pickled_dataframes(path, keys, update_store)
     df = split_tuple_columns(df)
     df = calculate_dist_columns(df)
     return df
 
 
-def prepare_series(parameters, default_path: str) -> pd.DataFrame:
+def prepare_series(parameters, default_path: str, keys: dict,
+                   update_store: bool = False) -> pd.DataFrame:
     if parameters.key is None:
         return None
     path = p if (p := parameters.stage1) else default_path
-    df = prepare_dataframe(path)
+    df = prepare_dataframe(path, keys[path], update_store)
     if (key := parameters.key) not in df:
         df[key] = df.eval(key)
     series = pd.Series(df[key], name=path + ': ' + key)
@@ -360,11 +404,14 @@ def prepare_series(parameters, default_path: str) -> pd.DataFrame:
 
 def main(parameters) -> None:
     stage1_path = p if (p := parameters.stage1) else '.'
-    x = prepare_series(parameters.x, stage1_path)
-    y = prepare_series(parameters.y, stage1_path)
-    r = prepare_series(parameters.r, stage1_path)
-    g = prepare_series(parameters.g, stage1_path)
-    b = prepare_series(parameters.b, stage1_path)
+    scopes = [parameters.x, parameters.y, parameters.r, parameters.g, parameters.b]
+    keys = {}
+    for scope in scopes:
+        if scope.key is not None:
+            path = p if (p := scope.stage1) else stage1_path
+            keys[path] = tuple(sorted(set(keys.get(path, ()) + (scope.key,))))
+    x, y, r, g, b = [prepare_series(scope, stage1_path, keys, parameters.update_store)
+                     for scope in scopes]
     plot_heatmap(x, y, r, g, b, bins=parameters.n_bins, heat=parameters.heat)
 
 